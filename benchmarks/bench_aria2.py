@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Benchmark of aria2 on a batch of mixed-size direct downloads served by
+# a local mock server (kvm48.mockapi): many small audio-sized files and
+# a few large video-sized ones, with per-connection bandwidth capped by
+# --bandwidth to emulate a CDN throttling each connection. Compares the
+# old manifest (global options only, i.e., aria2's default split of 5
+# and min-split-size of 20M) with per-target options derived from file
+# sizes (aria2.split_options). Requires aria2c.
+#
+# Usage: benchmarks/bench_aria2.py [--small N] [--small-size BYTES]
+#                                  [--large N] [--large-size BYTES]
+#                                  [--bandwidth BYTES/S]
+#                                  [--max-connections N]
+
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+from kvm48 import aria2
+from kvm48.mockapi import MockAPIServer
+
+
+def run(name, manifest, directory, total_size):
+    args = [
+        "aria2c",
+        *aria2.ARIA2C_OPTS,
+        "--max-concurrent-downloads=%d" % aria2.MAX_CONCURRENT_DOWNLOADS,
+        "--input-file",
+        manifest,
+        "--quiet",
+    ]
+    start = time.perf_counter()
+    subprocess.run(args, check=True)
+    elapsed = time.perf_counter() - start
+    print(
+        "%-10s %8.2f s %10.2f MiB/s" % (name, elapsed, total_size / elapsed / aria2.MIB)
+    )
+    for filename in os.listdir(directory):
+        os.unlink(os.path.join(directory, filename))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--small", type=int, default=20)
+    parser.add_argument("--small-size", type=int, default=4 * aria2.MIB)
+    parser.add_argument("--large", type=int, default=3)
+    parser.add_argument("--large-size", type=int, default=256 * aria2.MIB)
+    parser.add_argument(
+        "--bandwidth", type=int, default=2 * aria2.MIB, help="per connection"
+    )
+    parser.add_argument(
+        "--max-connections", type=int, default=aria2.DEFAULT_MAX_CONNECTIONS
+    )
+    args = parser.parse_args()
+
+    with MockAPIServer() as server, tempfile.TemporaryDirectory() as tmpdir:
+        server.bandwidth = args.bandwidth
+        sizes = {}
+        targets = []
+        for i in range(args.large + args.small):
+            live_id = "%04d" % i
+            size = args.large_size if i < args.large else args.small_size
+            server.mp4_sizes[live_id] = size
+            url = server.base_url + "/resource/live/%s.mp4" % live_id
+            sizes[url] = size
+            targets.append((url, live_id + ".mp4"))
+        total_size = sum(sizes.values())
+        directory = os.path.join(tmpdir, "downloads")
+        os.mkdir(directory)
+        manifest = os.path.join(tmpdir, "aria2.txt")
+
+        with open(manifest, "w", encoding="utf-8") as fp:
+            for url, filename in targets:
+                print("%s\n\tdir=%s\n\tout=%s" % (url, directory, filename), file=fp)
+        run("global", manifest, directory, total_size)
+
+        aria2.write_manifest(
+            targets,
+            manifest,
+            target_directory=directory,
+            sizes=sizes,
+            max_connections=args.max_connections,
+        )
+        run("adaptive", manifest, directory, total_size)
+
+
+if __name__ == "__main__":
+    main()
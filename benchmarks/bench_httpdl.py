@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark of the builtin HTTP downloader (kvm48.httpdl)
+# against a local mock server (kvm48.mockapi) serving mp4 files, over a
+# grid of worker counts and chunk sizes. Per-connection bandwidth of the
+# server can be capped with --bandwidth, to emulate a CDN throttling
+# each connection, which is where multiple connections pay off.
+#
+# Usage: benchmarks/bench_httpdl.py [--size BYTES] [--bandwidth BYTES/S]
+#                                   [--workers N,...] [--chunk-sizes BYTES,...]
+#                                   [--files N]
+
+import argparse
+import os
+import tempfile
+import time
+
+from kvm48 import httpdl
+from kvm48.mockapi import MockAPIServer
+
+
+def bench(server, directory, files, workers, chunk_size):
+    start = time.perf_counter()
+    total = 0
+    for i in range(files):
+        url = server.base_url + "/resource/live/%d.mp4" % i
+        path = os.path.join(directory, "%d-%d-%d.mp4" % (workers, chunk_size, i))
+        total += httpdl.download(url, path, workers=workers, chunk_size=chunk_size)
+        os.unlink(path)
+    elapsed = time.perf_counter() - start
+    print(
+        "workers %3d  chunk %10d  %8.2f s %10.2f MiB/s"
+        % (workers, chunk_size, elapsed, total / elapsed / 1048576)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=64 * 1048576, help="per file")
+    parser.add_argument(
+        "--bandwidth", type=int, default=0, help="per connection, in bytes/s"
+    )
+    parser.add_argument("--workers", default="1,2,4,8,16")
+    parser.add_argument(
+        "--chunk-sizes", default="%d,%d,%d" % (1 << 20, 4 << 20, 16 << 20)
+    )
+    parser.add_argument("--files", type=int, default=1)
+    args = parser.parse_args()
+
+    with MockAPIServer() as server, tempfile.TemporaryDirectory() as directory:
+        server.mp4_size = args.size
+        server.bandwidth = args.bandwidth
+        for workers in map(int, args.workers.split(",")):
+            for chunk_size in map(int, args.chunk_sizes.split(",")):
+                bench(server, directory, args.files, workers, chunk_size)
+
+
+if __name__ == "__main__":
+    main()
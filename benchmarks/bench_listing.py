@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+# Microbenchmark of the listing loops of koudai.list_member_vods and
+# koudai.list_perf_vods, with the API replaced by in-memory payloads,
+# reporting records per second.
+#
+# Payloads can be recorded getLiveList/getOpenLiveList responses, one
+# JSON response per line, passed through --member-payloads and
+# --perf-payloads; otherwise, synthetic payloads are generated.
+#
+# Usage: benchmarks/bench_listing.py [-n RECORDS] [--member-payloads FILE]
+#                                    [--perf-payloads FILE]
+
+import argparse
+import json
+import tempfile
+import time
+
+import arrow
+
+from kvm48 import koudai, persistence
+
+PAGE_SIZE = 20
+BASE_MS = 1555776000000
+
+
+def synthesize_member_pages(n):
+    return [
+        {
+            "status": 200,
+            "content": {
+                "liveList": [
+                    {
+                        "liveId": "%024d" % i,
+                        "title": "直播标题 %d" % i,
+                        "ctime": str(BASE_MS - i * 60000),
+                        "liveType": 1 + i % 2,
+                        "userInfo": {
+                            "userId": str(i % 300),
+                            "nickname": "SNH48-成员%d" % (i % 300),
+                        },
+                    }
+                    for i in range(offset, min(offset + PAGE_SIZE, n))
+                ],
+                "next": str(offset + PAGE_SIZE),
+            },
+        }
+        for offset in range(0, n, PAGE_SIZE)
+    ]
+
+
+def synthesize_perf_pages(n):
+    return [
+        {
+            "status": 200,
+            "content": {
+                "liveList": [
+                    {
+                        "liveId": "%018d" % i,
+                        "title": "《重生计划》剧场公演 %d" % i,
+                        "stime": str(BASE_MS - i * 60000),
+                        "teamList": [{"teamName": "TeamSⅡ"}],
+                    }
+                    for i in range(offset, min(offset + PAGE_SIZE, n))
+                ],
+                "next": str(offset + PAGE_SIZE),
+            },
+        }
+        for offset in range(0, n, PAGE_SIZE)
+    ]
+
+
+def load_pages(path):
+    with open(path, encoding="utf-8") as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+class FakeResponse:
+    def __init__(self, obj):
+        self._obj = obj
+
+    def json(self):
+        return self._obj
+
+
+def bench(name, list_func, pages):
+    it = iter(pages + [{"content": {"liveList": [], "next": "0"}}])
+    koudai.call_api = lambda endpoint, payload: FakeResponse(next(it))
+    start_times = [
+        int(v.get("ctime") or v.get("stime"))
+        for page in pages
+        for v in page["content"]["liveList"]
+    ]
+    from_ = arrow.get(min(start_times) / 1000)
+    to_ = arrow.get(max(start_times) / 1000 + 1)
+    start = time.perf_counter()
+    count = sum(1 for _ in list_func(from_, to_, fan_out=False))
+    elapsed = time.perf_counter() - start
+    print(
+        "%-8s %8d records %8.2f s %10.0f records/s"
+        % (name, count, elapsed, count / elapsed)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000, help="number of records")
+    parser.add_argument("--member-payloads", help="recorded getLiveList responses")
+    parser.add_argument("--perf-payloads", help="recorded getOpenLiveList responses")
+    args = parser.parse_args()
+
+    # Don't touch the user's member directory and cursor checkpoints.
+    persistence.USER_DATA_DIR = tempfile.mkdtemp()
+    koudai.ProgressReporter.threshold = float("inf")
+
+    member_pages = (
+        load_pages(args.member_payloads)
+        if args.member_payloads
+        else synthesize_member_pages(args.n)
+    )
+    perf_pages = (
+        load_pages(args.perf_payloads)
+        if args.perf_payloads
+        else synthesize_perf_pages(args.n)
+    )
+    bench("member", koudai.list_member_vods, member_pages)
+    bench("perf", koudai.list_perf_vods, perf_pages)
+
+
+if __name__ == "__main__":
+    main()
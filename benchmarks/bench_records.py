@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+# Benchmark VOD record construction from a synthetic stream of
+# getLiveList pages: attrdict.AttrDict records (as built by koudai before
+# MemberVOD was introduced; only if attrdict is installed) vs.
+# koudai.MemberVOD.
+#
+# Usage: benchmarks/bench_records.py [-n RECORDS]
+
+import argparse
+import json
+import re
+import time
+import tracemalloc
+
+import arrow
+
+from kvm48 import koudai
+
+PAGE_SIZE = 20
+
+
+def synthesize_pages(n):
+    base_ms = 1555776000000
+    pages = []
+    for offset in range(0, n, PAGE_SIZE):
+        live_list = [
+            {
+                "liveId": "%024d" % i,
+                "title": "直播标题 %d" % i,
+                "coverPath": "/mediasource/live/%d.jpg" % i,
+                "ctime": str(base_ms - i * 60000),
+                "liveType": 1 + i % 2,
+                "userInfo": {
+                    "userId": str(i % 300),
+                    "nickname": "SNH48-成员%d" % (i % 300),
+                    "avatar": "/mediasource/avatar/%d.jpg" % (i % 300),
+                },
+            }
+            for i in range(offset, min(offset + PAGE_SIZE, n))
+        ]
+        pages.append(
+            json.dumps({"status": 200, "content": {"liveList": live_list, "next": 0}})
+        )
+    return pages
+
+
+def attrdict_records(pages):
+    import attrdict
+
+    records = []
+    for page in pages:
+        for vod_obj in json.loads(page)["content"]["liveList"]:
+            v = attrdict.AttrDict(vod_obj)
+            start_time = arrow.get(int(v.ctime) / 1000).to("Asia/Shanghai")
+            m = re.match(r"^(?P<group>\w+)-(?P<member>\w+)$", v.userInfo.nickname)
+            if not m:
+                continue
+            records.append(
+                attrdict.AttrDict(
+                    {
+                        "id": v.liveId,
+                        "member_id": int(v.userInfo.userId),
+                        "type": "直播" if v.liveType == 1 else "电台",
+                        "name": m.group("member"),
+                        "title": v.title,
+                        "start_time": start_time,
+                        "vod_url": None,
+                        "danmaku_url": None,
+                    }
+                )
+            )
+    return records
+
+
+def slots_records(pages):
+    records = []
+    for page in pages:
+        for vod_obj in json.loads(page)["content"]["liveList"]:
+            start_time = arrow.get(int(vod_obj["ctime"]) / 1000).to("Asia/Shanghai")
+            name = koudai._parse_member_name(vod_obj["userInfo"]["nickname"])
+            if name:
+                records.append(
+                    koudai.MemberVOD(
+                        vod_obj["liveId"],
+                        int(vod_obj["userInfo"]["userId"]),
+                        "直播" if int(vod_obj["liveType"]) == 1 else "电台",
+                        name,
+                        vod_obj["title"],
+                        start_time,
+                    )
+                )
+    return records
+
+
+def bench(name, func, pages, n):
+    start = time.perf_counter()
+    func(pages)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    records = func(pages)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(records) == n
+    print(
+        "%-10s %8.2f s %10.1f us/record %8.0f B/record retained %8.1f MiB peak"
+        % (name, elapsed, elapsed / n * 1e6, retained / n, peak / 2 ** 20)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000, help="number of records")
+    args = parser.parse_args()
+
+    pages = synthesize_pages(args.n)
+    try:
+        import attrdict  # noqa: F401
+
+        bench("attrdict", attrdict_records, pages, args.n)
+    except ImportError:
+        print("attrdict not installed, skipping baseline")
+    bench("slots", slots_records, pages, args.n)
+
+
+if __name__ == "__main__":
+    main()
@@ -35,7 +35,6 @@ setuptools.setup(
     install_requires=[
         "PyYAML",
         "arrow",
-        "attrdict",
         "caterpillar-hls",
         "distlib",
         "psutil",
@@ -1,7 +1,19 @@
+import atexit
+import itertools
 import os
+import re
+import secrets
+import socket
 import subprocess
-import sys
-from typing import List, Optional, Tuple
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from . import bandwidth, jobs, supervisor, utils
+from .session import get_session
+
 
 # Override some bad defaults.
 ARIA2C_OPTS = [
@@ -13,11 +25,62 @@ ARIA2C_OPTS = [
 ]
 
 
+MIB = 1024 * 1024
+# Number of downloads aria2 runs at the same time (aria2's default,
+# enforced with --max-concurrent-downloads), and the default cap on the
+# total number of connections across them (which amounts to the old
+# fixed --max-connection-per-server=16 for each).
+MAX_CONCURRENT_DOWNLOADS = 5
+DEFAULT_MAX_CONNECTIONS = 80
+# Upper limit of --max-connection-per-server, and limits of
+# --min-split-size, imposed by aria2.
+MAX_CONNECTIONS_PER_SERVER = 16
+MIN_SPLIT_SIZE = 1 * MIB
+MAX_SPLIT_SIZE = 1024 * MIB
+# Each connection of a download is meant to fetch about this much, so
+# that small files (e.g., audio only 电台 VODs) don't waste time setting
+# up connections, while large ones get as many as allowed.
+SPLIT_TARGET_SIZE = 16 * MIB
+
+
+# Returns per-download aria2 options (split, min-split-size and
+# max-connection-per-server) for a file of the given size (None if
+# unknown), such that no more than max_connections connections are open
+# across MAX_CONCURRENT_DOWNLOADS concurrent downloads.
+def split_options(size: Optional[int], max_connections: int = None) -> Dict[str, str]:
+    max_connections = max_connections or DEFAULT_MAX_CONNECTIONS
+    limit = min(
+        max(max_connections // MAX_CONCURRENT_DOWNLOADS, 1),
+        MAX_CONNECTIONS_PER_SERVER,
+    )
+    if size is None:
+        split = limit
+        min_split_size = SPLIT_TARGET_SIZE
+    else:
+        split = min(max(-(-size // SPLIT_TARGET_SIZE), 1), limit)
+        # aria2 doesn't split ranges smaller than twice min-split-size,
+        # so this makes sure there are as many pieces as connections.
+        min_split_size = size // split // MIB * MIB
+    min_split_size = min(max(min_split_size, MIN_SPLIT_SIZE), MAX_SPLIT_SIZE)
+    return {
+        "split": str(split),
+        "max-connection-per-server": str(split),
+        "min-split-size": "%dM" % (min_split_size // MIB),
+    }
+
+
 # Returns the list of targets that are actually written (not already
-# downloaded).
+# downloaded). Each target gets the options of split_options, based on
+# its size in sizes (a dict mapping URLs to sizes), if any.
 def write_manifest(
-    targets: List[Tuple[str, str]], path: str, *, target_directory: str = None
+    targets: List[Tuple[str, str]],
+    path: str,
+    *,
+    target_directory: str = None,
+    sizes: Dict[str, Optional[int]] = None,
+    max_connections: int = None,
 ) -> List[Tuple[str, str]]:
+    sizes = sizes or {}
     written_targets = []
     with open(path, "w", encoding="utf-8") as fp:
         for target in targets:
@@ -35,15 +98,405 @@ def write_manifest(
             if filedir:
                 print("\tdir=%s" % filedir, file=fp)
             print("\tout=%s" % filename, file=fp)
+            for name, value in split_options(sizes.get(url), max_connections).items():
+                print("\t%s=%s" % (name, value), file=fp)
             written_targets.append(target)
     return written_targets
 
 
-# The return value is the exit status of aria2.
-def download(manifest: str) -> int:
-    args = ["aria2c", *ARIA2C_OPTS, "--input-file", manifest]
-    print(" ".join(args), file=sys.stderr)
+# The return value is the exit status of aria2. If log_prefix is
+# specified, output is relayed with the prefix (see supervisor.call);
+# otherwise aria2c runs attached to the terminal. If log_file is
+# specified, errors are logged to it (aria2c appends to an existing
+# file), for OutputErrors.read.
+def download(
+    manifest: str, *, log_prefix: Optional[str] = None, log_file: Optional[str] = None
+) -> int:
+    args = [
+        "aria2c",
+        *ARIA2C_OPTS,
+        "--max-concurrent-downloads=%d" % MAX_CONCURRENT_DOWNLOADS,
+        "--input-file",
+        manifest,
+    ]
+    if log_file:
+        args += ["--log", log_file, "--log-level=error"]
+    try:
+        return supervisor.call(args, log_prefix)
+    except FileNotFoundError:
+        raise RuntimeError("aria2c(1) not found")
+
+
+def is_finished(path: str) -> bool:
+    return os.path.exists(path) and not os.path.exists(path + ".aria2")
+
+
+# aria2 error codes (see EXIT STATUS in aria2c(1)) of failures that
+# won't go away by retrying: resource not found (3), max file not found
+# reached (4), not enough disk space (9), duplicate download (11), file
+# already exists (13), renaming failed (14), could not open or create
+# file (15, 16), could not create directory (18), too many redirects
+# (23), and HTTP authorization failed (24). Error code 22 (bad HTTP
+# response) covers both, and is classified by the HTTP status in the
+# message.
+PERMANENT_ERROR_CODES = {3, 4, 9, 11, 13, 14, 15, 16, 18, 23, 24}
+
+
+def is_permanent_error(code: Optional[int], message: str) -> bool:
+    return code in PERMANENT_ERROR_CODES or jobs.is_permanent_error(message)
+
+
+# Collects errors from aria2c output or error logs (see download), which
+# look like
+#
+#   [ERROR] CUID#7 - Download aborted. URI=http://example.com/a.mp4
+#   Exception: [AbstractCommand.cc:351] errorCode=3 URI=http://...
+#     -> [HttpSkipResponseCommand.cc:232] errorCode=3 Resource not found
+#
+# errors maps URIs to (error code, message) of the innermost (last)
+# error reported for them.
+class OutputErrors(object):
+    def __init__(self):
+        self.errors = {}  # type: Dict[str, Tuple[int, str]]
+        self._uri = None  # type: Optional[str]
+
+    def feed(self, line: str) -> None:
+        m = re.search(r"URI=(\S+)", line)
+        if m:
+            self._uri = m.group(1)
+        m = re.search(r"errorCode=(\d+) (?!URI=)(.+)", line)
+        if m and self._uri:
+            self.errors[self._uri] = (int(m.group(1)), m.group(2).strip())
+
+    # Feeds the lines of an error log, if it exists.
+    def read(self, path: str) -> None:
+        try:
+            with open(path, encoding="utf-8", errors="replace") as fp:
+                for line in fp:
+                    self.feed(line.rstrip("\n"))
+        except FileNotFoundError:
+            pass
+
+
+# The same options as ARIA2C_OPTS, as per-download options of RPC calls.
+RPC_OPTIONS = dict(opt[2:].split("=", 1) for opt in ARIA2C_OPTS)
+
+RPC_TIMEOUT = 10  # in seconds
+RPC_STARTUP_TIMEOUT = 10
+RPC_POLL_INTERVAL = 1
+RPC_PROGRESS_INTERVAL = 10
+RPC_STATUS_KEYS = [
+    "status",
+    "totalLength",
+    "completedLength",
+    "downloadSpeed",
+    "errorCode",
+    "errorMessage",
+]
+
+
+class RPCError(Exception):
+    pass
+
+
+# Client of the JSON-RPC interface of aria2c (aria2c --enable-rpc), see
+# https://aria2.github.io/manual/en/html/aria2c.html#rpc-interface.
+class RPCClient(object):
+    def __init__(self, url: str, secret: Optional[str] = None):
+        self.url = url
+        self._token = "token:%s" % secret if secret else None
+        self._ids = itertools.count()
+
+    def _params(self, params) -> List[Any]:
+        return [self._token, *params] if self._token else list(params)
+
+    def _post(self, method: str, params: List[Any]) -> Any:
+        payload = {
+            "jsonrpc": "2.0",
+            "id": str(next(self._ids)),
+            "method": method,
+            "params": params,
+        }
+        try:
+            # aria2 answers errors with 400 and an error object.
+            r = get_session().post(self.url, json=payload, timeout=RPC_TIMEOUT)
+            obj = r.json()
+        except (requests.RequestException, ValueError) as exc:
+            raise RPCError("%s failed: %s" % (method, exc))
+        if obj.get("error"):
+            raise RPCError("%s failed: %s" % (method, obj["error"].get("message")))
+        return obj["result"]
+
+    def call(self, method: str, *params) -> Any:
+        return self._post(method, self._params(params))
+
+    # Makes multiple calls in a single request. calls is a list of
+    # (method, params) pairs; returns a list of results, with RPCError
+    # instances in place of results of failed calls.
+    def multicall(self, calls: List[Tuple[str, List[Any]]]) -> List[Any]:
+        results = self._post(
+            "system.multicall",
+            [
+                [
+                    {"methodName": method, "params": self._params(params)}
+                    for method, params in calls
+                ]
+            ],
+        )
+        return [
+            result[0] if isinstance(result, list) else RPCError(result.get("message"))
+            for result in results
+        ]
+
+
+# The aria2c daemon is started on first use and kept around (e.g.,
+# across polls of watch mode) until exit; see get_rpc_client.
+_rpc_client = None  # type: Optional[RPCClient]
+_rpc_process = None  # type: Optional[subprocess.Popen]
+_rpc_lock = threading.Lock()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_daemon() -> Tuple[RPCClient, subprocess.Popen]:
+    port = _free_port()
+    secret = secrets.token_hex(16)
+    args = [
+        "aria2c",
+        *ARIA2C_OPTS,
+        "--max-concurrent-downloads=%d" % MAX_CONCURRENT_DOWNLOADS,
+        "--enable-rpc",
+        "--rpc-listen-port=%d" % port,
+        "--rpc-secret=%s" % secret,
+        # Exit along with us, even if we are killed.
+        "--stop-with-process=%d" % os.getpid(),
+        "--quiet",
+    ]
     try:
-        return subprocess.call(args)
+        process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
     except FileNotFoundError:
         raise RuntimeError("aria2c(1) not found")
+    client = RPCClient("http://127.0.0.1:%d/jsonrpc" % port, secret)
+    deadline = time.monotonic() + RPC_STARTUP_TIMEOUT
+    while True:
+        try:
+            client.call("aria2.getVersion")
+            return client, process
+        except RPCError:
+            if process.poll() is not None:
+                raise RuntimeError(
+                    "aria2c daemon exited with status %d" % process.returncode
+                )
+            if time.monotonic() >= deadline:
+                process.terminate()
+                raise RuntimeError("aria2c daemon failed to start")
+            time.sleep(0.1)
+
+
+def _stop_daemon() -> None:
+    global _rpc_client, _rpc_process
+    with _rpc_lock:
+        if _rpc_process is not None:
+            _rpc_process.terminate()
+            try:
+                _rpc_process.wait(5)
+            except subprocess.TimeoutExpired:
+                _rpc_process.kill()
+        _rpc_client = None
+        _rpc_process = None
+
+
+# Returns an RPC client of the aria2c daemon at url (with the secret
+# token, if any), or if url is None, of an aria2c daemon started by us,
+# which is restarted if it's gone.
+def get_rpc_client(
+    url: Optional[str] = None, secret: Optional[str] = None
+) -> RPCClient:
+    global _rpc_client, _rpc_process
+    with _rpc_lock:
+        if url:
+            if _rpc_client is None or _rpc_client.url != url:
+                _rpc_client = RPCClient(url, secret)
+                _rpc_client.call("aria2.getVersion")
+            return _rpc_client
+        if _rpc_process is None or _rpc_process.poll() is not None:
+            if _rpc_process is None:
+                atexit.register(_stop_daemon)
+            _rpc_client, _rpc_process = _start_daemon()
+        return _rpc_client
+
+
+# Downloads the jobs of queue (see jobs.RetryQueue) through the aria2
+# daemon behind rpc. Each job that is due is submitted as a separate
+# download (GID), and GIDs are polled until they are complete or have
+# failed; failed jobs are resubmitted once their backoff has elapsed,
+# unless the error is permanent. If polling fails altogether (e.g., the
+# daemon is gone), all downloads in flight are failed and retried the
+# same way. Downloads are tuned with sizes and max_connections as in
+# write_manifest (note that for an existing daemon, the connection cap
+# assumes MAX_CONCURRENT_DOWNLOADS).
+# Progress and errors are reported through log. Returns once every job
+# is done or has failed permanently.
+#
+# If limiter (a bandwidth.Share) is specified, the overall download
+# limit of the daemon (a global option, which also applies to downloads
+# of others on an existing daemon) is kept in sync with the limit of
+# the share, which may change over time; 0 means unlimited.
+def download_with_rpc(
+    rpc: RPCClient,
+    queue: jobs.RetryQueue,
+    *,
+    target_directory: str = None,
+    sizes: Dict[str, Optional[int]] = None,
+    max_connections: int = None,
+    log: Callable[[str], None] = supervisor.log,
+    poll_interval: float = None,
+    limiter: Optional[bandwidth.Share] = None,
+) -> None:
+    poll_interval = poll_interval or RPC_POLL_INTERVAL
+    sizes = sizes or {}
+    pending = {}  # type: Dict[str, jobs.Job]
+    # GIDs removed after failed polls, mapped to the poll errors.
+    lost = {}  # type: Dict[str, str]
+    # Limit last applied to the daemon; False if none yet.
+    applied_limit = False  # type: Any
+
+    def apply_limit():
+        nonlocal applied_limit
+        limit = limiter.limit()
+        if limit == applied_limit:
+            return
+        try:
+            rpc.call(
+                "aria2.changeGlobalOption",
+                {"max-overall-download-limit": str(limit or 0)},
+            )
+        except RPCError as exc:
+            log("[WARNING] failed to set bandwidth limit: %s\n" % exc)
+            return
+        applied_limit = limit
+        log("Bandwidth limit: %s\n" % bandwidth.format_rate(limit))
+
+    def fullpath(job):
+        filepath = job.target[1]
+        return (
+            os.path.join(target_directory, filepath) if target_directory else filepath
+        )
+
+    def submit(job):
+        path = fullpath(job)
+        if is_finished(path):
+            queue.succeed(job)
+            return
+        options = dict(
+            RPC_OPTIONS,
+            **split_options(sizes.get(job.target[0]), max_connections),
+            dir=os.path.dirname(os.path.abspath(path)),
+            out=os.path.basename(path),
+        )
+        try:
+            gid = rpc.call("aria2.addUri", [job.target[0]], options)
+        except RPCError as exc:
+            queue.fail(job, str(exc))
+            return
+        pending[gid] = job
+
+    last_report = time.monotonic()
+    while True:
+        if limiter:
+            apply_limit()
+        for job in queue.take_ready():
+            submit(job)
+        if not pending:
+            wait = queue.wait_time()
+            if wait is None:
+                return
+            if wait > 0:
+                log(
+                    "Retrying %d downloads in %.1f seconds...\n"
+                    % (queue.count(jobs.FAILED_RETRYABLE), wait)
+                )
+                time.sleep(wait)
+            continue
+
+        time.sleep(poll_interval)
+        gids = list(pending)
+        try:
+            statuses = rpc.multicall(
+                [("aria2.tellStatus", [gid, RPC_STATUS_KEYS]) for gid in gids]
+            )
+        except RPCError as exc:
+            log("[ERROR] failed to poll aria2: %s\n" % exc)
+            # The downloads may still be running on the daemon, and
+            # retries would clash with them (errorCode 11 or 13, which
+            # are permanent). So they are removed, and retried once a
+            # later poll shows that they have stopped; those that can't
+            # be removed (e.g., the daemon is gone) are retried as is.
+            for gid in gids:
+                try:
+                    rpc.call("aria2.forceRemove", gid)
+                except RPCError:
+                    lost.pop(gid, None)
+                    queue.fail(pending.pop(gid), str(exc))
+                else:
+                    lost[gid] = str(exc)
+            continue
+        speed = total = done = 0
+        for gid, status in zip(gids, statuses):
+            if not isinstance(status, RPCError) and status["status"] in (
+                "active",
+                "waiting",
+                "paused",
+            ):
+                speed += int(status.get("downloadSpeed") or 0)
+                total += int(status.get("totalLength") or 0)
+                done += int(status.get("completedLength") or 0)
+                continue
+            job = pending.pop(gid)
+            lost_error = lost.pop(gid, None)
+            if isinstance(status, RPCError):
+                # E.g., the daemon was restarted and forgot about the GID.
+                code, message = None, str(status)
+            else:
+                try:
+                    rpc.call("aria2.removeDownloadResult", gid)
+                except RPCError:
+                    pass
+                if status["status"] == "complete":
+                    queue.succeed(job)
+                    log("[#%s] downloaded %s\n" % (gid, job.target[1]))
+                    continue
+                code = int(status.get("errorCode") or 0) or None
+                message = status.get("errorMessage") or status["status"]
+                if status["status"] == "removed" and lost_error:
+                    code, message = None, lost_error
+            error = "%s (error code %s)" % (message, code) if code else message
+            queue.fail(job, error, permanent=is_permanent_error(code, message))
+            log(
+                "[#%s] attempt %d failed: %s: %s\n"
+                % (gid, job.attempts, job.target[1], error)
+            )
+        now = time.monotonic()
+        if pending and now - last_report >= RPC_PROGRESS_INTERVAL:
+            last_report = now
+            log(
+                "%d active, %s of %s, %s/s%s; %d done, %d failed\n"
+                % (
+                    len(pending),
+                    utils.format_size(done),
+                    utils.format_size(total),
+                    utils.format_size(speed),
+                    bandwidth.format_limit(limiter),
+                    queue.count(jobs.DONE),
+                    queue.count(jobs.FAILED_PERMANENT),
+                )
+            )
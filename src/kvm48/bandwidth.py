@@ -0,0 +1,209 @@
+import datetime
+import re
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from . import utils
+
+
+# Global download bandwidth budget, shared by download backends that run
+# at the same time.
+#
+# The limit in effect follows a Schedule: a default limit, overridden by
+# time-of-day windows (in local time). Backends join the budget for the
+# duration of their phase, and the limit in effect is split evenly
+# between the backends that have joined (see Share.limit). aria2 is
+# capped through its RPC interface, and the builtin downloaders throttle
+# themselves through Share.consume. caterpillar can't be capped, so M3U8
+# downloads are handed to the builtin HLS downloader while a limit is in
+# effect, and caterpillar processes are interrupted once one takes
+# effect (see kvm48.caterpillar_phase).
+
+UNITS = {"": 1, "K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+# Longest burst allowed by Share.consume after an idle period.
+BURST_SECONDS = 1
+
+
+# Parses a rate in bytes per second, e.g. 2097152, "2M", "2 MB/s" or
+# "500K" (units are multiples of 1024, as in aria2). None, 0 and
+# "unlimited" mean no limit, for which None is returned. ValueError is
+# raised for anything else.
+def parse_rate(value) -> Optional[int]:
+    if value is None or value == 0:
+        return None
+    if isinstance(value, bool):
+        raise ValueError("invalid rate: %s" % value)
+    if isinstance(value, (int, float)):
+        if value < 0:
+            raise ValueError("invalid rate: %s" % value)
+        return int(value)
+    if not isinstance(value, str):
+        raise ValueError("invalid rate: %s" % value)
+    if value.strip().lower() == "unlimited":
+        return None
+    m = re.match(
+        r"^(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?$", value.strip(), re.IGNORECASE
+    )
+    if not m:
+        raise ValueError("invalid rate: %s" % value)
+    rate = int(float(m.group(1)) * UNITS[m.group(2).upper()])
+    return rate or None
+
+
+def format_rate(rate: Optional[int]) -> str:
+    return "%s/s" % utils.format_size(rate) if rate else "unlimited"
+
+
+# Suffix of progress lines showing the limit in effect for a share (if
+# any).
+def format_limit(share: Optional["Share"]) -> str:
+    if share is None:
+        return ""
+    return " (limit %s)" % format_rate(share.limit())
+
+
+def _parse_clock(s: str) -> int:
+    m = re.match(r"^(\d{1,2}):(\d{2})$", s)
+    # 24:00 is allowed as the end of a window.
+    if not m or int(m.group(2)) > 59 or int(m.group(1)) * 60 + int(m.group(2)) > 1440:
+        raise ValueError("invalid time of day: %s" % s)
+    return int(m.group(1)) * 60 + int(m.group(2))
+
+
+# Parses a window of the form "HH:MM-HH:MM RATE", e.g. "01:00-08:00
+# unlimited". Returns (start, end, rate), with start and end in minutes
+# since midnight. ValueError is raised for malformed windows.
+def parse_window(s: str) -> Tuple[int, int, Optional[int]]:
+    if not isinstance(s, str):
+        raise ValueError("invalid window: %s" % s)
+    m = re.match(r"^\s*(\S+)\s*-\s*(\S+)\s+(.+)$", s)
+    if not m:
+        raise ValueError("invalid window: %s" % s)
+    start = _parse_clock(m.group(1))
+    end = _parse_clock(m.group(2))
+    if start == end:
+        raise ValueError("empty window: %s" % s)
+    return start, end, parse_rate(m.group(3))
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now()
+
+
+class Schedule(object):
+    # windows is a list of (start, end, rate) as returned by
+    # parse_window. Windows ending before they start wrap around
+    # midnight. If windows overlap, the first one listed wins.
+    def __init__(
+        self,
+        default: Optional[int] = None,
+        windows: List[Tuple[int, int, Optional[int]]] = None,
+    ):
+        self.default = default
+        self.windows = windows or []
+
+    # Whether any limit is configured at all.
+    @property
+    def enabled(self) -> bool:
+        return self.default is not None or any(
+            rate is not None for _, _, rate in self.windows
+        )
+
+    # Returns the limit in effect at a time of day (now if not
+    # specified), None if unlimited.
+    def limit_at(self, t: datetime.time = None) -> Optional[int]:
+        if t is None:
+            t = _now().time()
+        minutes = t.hour * 60 + t.minute
+        for start, end, rate in self.windows:
+            if start < end:
+                if start <= minutes < end:
+                    return rate
+            elif minutes >= start or minutes < end:
+                return rate
+        return self.default
+
+    # Returns the number of seconds from now until the limit in effect
+    # next changes (at a window boundary), None if it never does.
+    def seconds_to_change(self) -> Optional[float]:
+        now = _now()
+        current = self.limit_at(now.time())
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        boundaries = sorted(
+            set(m for start, end, _ in self.windows for m in (start, end))
+        )
+        for day in (0, 1):
+            for minutes in boundaries:
+                t = midnight + datetime.timedelta(days=day, minutes=minutes)
+                if t > now and self.limit_at(t.time()) != current:
+                    return (t - now).total_seconds()
+        return None
+
+
+class Budget(object):
+    def __init__(self, schedule: Schedule):
+        self.schedule = schedule
+        self.shares = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.schedule.enabled
+
+    def join(self) -> "Share":
+        with self._lock:
+            self.shares += 1
+        return Share(self)
+
+    def _leave(self) -> None:
+        with self._lock:
+            self.shares -= 1
+
+
+# A backend's share of a Budget. Use as a context manager, or call
+# leave() once the backend is done, so that the others get its share.
+class Share(object):
+    def __init__(self, budget: Budget):
+        self.budget = budget
+        self._left = False
+        self._allowance = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.leave()
+
+    def leave(self) -> None:
+        if not self._left:
+            self._left = True
+            self.budget._leave()
+
+    # The limit in effect for this share, None if unlimited.
+    def limit(self) -> Optional[int]:
+        rate = self.budget.schedule.limit_at()
+        if rate is None:
+            return None
+        return max(rate // max(self.budget.shares, 1), 1)
+
+    # Accounts for n bytes received, sleeping as long as needed to keep
+    # to the limit. May be called from multiple threads.
+    def consume(self, n: int) -> None:
+        rate = self.limit()
+        with self._lock:
+            now = time.monotonic()
+            if rate is None:
+                self._allowance = 0.0
+                self._updated = now
+                return
+            self._allowance = min(
+                self._allowance + (now - self._updated) * rate, rate * BURST_SECONDS
+            )
+            self._updated = now
+            self._allowance -= n
+            wait = -self._allowance / rate
+        if wait > 0:
+            time.sleep(wait)
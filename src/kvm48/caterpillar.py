@@ -1,10 +1,13 @@
 import os
+import re
 import subprocess
 import sys
-from typing import List, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 from distlib.version import NormalizedVersion, UnsupportedVersionError
 
+from . import supervisor
+
 
 # v1.0b1: --exist-ok
 MINIMUM_CATERPILLAR_VERSION = "1.0"
@@ -83,11 +86,59 @@ def write_manifest(
     return written_targets
 
 
-# The return value is the exit status of aria2.
-def download(manifest: str) -> int:
+# The return value is the exit status of caterpillar. If log_prefix is
+# specified, output is relayed with the prefix (see supervisor.call); if
+# log_file is specified, output is written to that file instead of being
+# relayed; otherwise caterpillar runs attached to the terminal. on_line
+# is called with each line of output in the first two cases. timeout is
+# passed on to supervisor.call, so subprocess.TimeoutExpired is raised if
+# caterpillar has to be terminated.
+def download(
+    manifest: str,
+    *,
+    log_prefix: Optional[str] = None,
+    on_line: Optional[Callable[[str], None]] = None,
+    log_file: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> int:
     args = ["caterpillar", "--batch", "--exist-ok", manifest]
-    print(" ".join(args), file=sys.stderr)
     try:
-        return subprocess.call(args)
+        if not log_file:
+            return supervisor.call(
+                args, log_prefix, on_line=on_line, timeout=timeout
+            )
+        with open(log_file, "w", encoding="utf-8") as fp:
+
+            def write(line):
+                fp.write(line + "\n")
+                if on_line:
+                    on_line(line)
+
+            return supervisor.call(
+                args, log_prefix, on_line=write, quiet=True, timeout=timeout
+            )
     except FileNotFoundError:
         raise RuntimeError("caterpillar(1) not found")
+
+
+# Collects errors from caterpillar console output, for reporting only.
+# caterpillar has no machine readable error output, so this is best
+# effort: an error-looking line is attributed to the target whose URL or
+# path it mentions (to the only target, if there's just one), and lines
+# naming no target are ignored. errors maps URLs to the last error
+# message reported for them.
+class OutputErrors(object):
+    def __init__(self, targets: List[Tuple[str, str]]):
+        self.targets = targets
+        self.errors = {}  # type: Dict[str, str]
+
+    def feed(self, line: str) -> None:
+        if not re.search(r"\b(?:error|failed)\b", line, re.I):
+            return
+        if len(self.targets) == 1:
+            self.errors[self.targets[0][0]] = line.strip()
+            return
+        for url, filepath in self.targets:
+            if url in line or os.path.basename(filepath) in line:
+                self.errors[url] = line.strip()
+                return
@@ -1,14 +1,15 @@
 import importlib
 import os
 import sys
-from typing import List, Optional
+from typing import List, Optional, Union
 
 import arrow
-import attrdict
 import yaml
 
+from . import bandwidth, scheduling
+from .aria2 import DEFAULT_MAX_CONNECTIONS as DEFAULT_ARIA2_MAX_CONNECTIONS
 from .dirs import USER_CONFIG_DIR, V10LEGACY_USER_CONFIG_DIR
-from .koudai import VOD
+from .koudai import DEFAULT_RESOLVE_WORKERS, VOD, MemberVOD
 from .utils import extension_from_url, sanitize_filename
 
 
@@ -19,6 +20,8 @@ else:
     DEFAULT_CONFIG_DIR = USER_CONFIG_DIR
 DEFAULT_CONFIG_FILE = os.path.join(DEFAULT_CONFIG_DIR, "config.yml")
 DEFAULT_FILTER_DIR = os.path.join(DEFAULT_CONFIG_DIR, "filters")
+API_BASE_URL_ENV = "KVM48_API_BASE_URL"
+DEFAULT_WATCH_INTERVAL = 300
 DEFAULT_NAMING_PATTERN = "%(date_c)s %(name)s口袋%(type)s %(title)s.%(ext)s"
 CONFIG_TEMPLATE = """\
 # ID of group to monitor, if all members you monitor are in a single
@@ -136,6 +139,116 @@ naming:
 # Whether to allow daily update checks for KVM48. Default is on.
 # update_checks: on
 
+# Number of VOD URLs to resolve concurrently through the Koudai48 API.
+# Default is 8. Set to 1 to resolve VODs one at a time.
+#resolve_workers: 8
+
+# Resolved VOD URLs are cached locally so that VODs are only resolved
+# through the API once. This option sets the number of days after which
+# cached URLs expire and are resolved again. Default is never. Run with
+# --refresh-urls to discard cached URLs of VODs in the date range.
+#resolve_cache_ttl:
+
+# Maximum total time, in seconds, to spend on Koudai48 API calls
+# (including retries) in a single run. Once the deadline is exceeded,
+# pending API calls fail instead of being retried. Default is no limit.
+#api_deadline:
+
+# Whether to hedge VOD URL resolution requests: when a request takes
+# longer than 95% of recent ones, a duplicate request is sent and
+# whichever answers first is used, so that a few stalled requests do not
+# hold up the whole run. At most 10% of requests are duplicated. Default
+# is on.
+#api_hedging: on
+
+# Base URL of Koudai48 API endpoints. Only change this to point KVM48 at
+# a mirror or a local mock server (python -m kvm48.mockapi). The
+# KVM48_API_BASE_URL environment variable, if set, takes precedence.
+# Default is https://pocketapi.48.cn/live/api/v1/live/.
+#api_base_url:
+
+# Interval, in seconds, between polls for new VODs in watch mode (kvm48
+# watch). Each interval is randomized by up to 10% either way. Default
+# is 300.
+#watch_interval: 300
+
+# How to drive aria2 for direct downloads. off (default): run aria2c
+# once per attempt on a batch input file. on: start an aria2c RPC daemon
+# (aria2c --enable-rpc, kept running across polls in watch mode), submit
+# each VOD as a separate download, and retry only failed ones. A URL,
+# e.g. http://127.0.0.1:6800/jsonrpc: use an existing aria2c RPC daemon
+# instead, with aria2_rpc_secret as the secret token (--rpc-secret), if
+# any. Note that paths are passed to an existing daemon as is, so it
+# should run on the same machine.
+#aria2_rpc: off
+#aria2_rpc_secret:
+
+# Downloader for direct (non-M3U8) downloads: aria2 (default), or
+# builtin, a downloader built into KVM48 that fetches ranges of each
+# file over multiple connections, for systems where aria2 is not
+# available. Interrupted downloads of the builtin downloader are kept
+# as .part files (with .part.json state files next to them) and resumed
+# in the next run.
+#direct_downloader: aria2
+
+# Maximum number of connections aria2 may open at the same time, across
+# all downloads. Each download gets a number of connections according to
+# the size of the file (one for every 16 MiB or so), up to a share of
+# this cap (aria2 runs 5 downloads at a time), and at most 16. Default
+# is 80.
+#aria2_max_connections: 80
+
+# Downloader for M3U8 VODs: caterpillar (default), or builtin, a
+# downloader built into KVM48 that fetches segments over multiple
+# connections, without caterpillar. Segments of interrupted downloads
+# are kept in .segments directories and reused in the next run. The
+# segments are concatenated, and MPEG-TS streams are remuxed into MP4
+# with ffmpeg, which is required just as with caterpillar. Unlike
+# caterpillar, the builtin downloader does not repair timestamp
+# discontinuities.
+#m3u8_downloader: caterpillar
+
+# Number of caterpillar processes to run at the same time. With more
+# than one, each M3U8 VOD is downloaded by a separate caterpillar
+# process, with its own manifest and log file in a directory next to
+# the m3u8 manifest (e.g. m3u8.d). Overridden by the -j, --jobs command
+# line option. Default is 1 (a single caterpillar process downloads all
+# VODs one after another).
+#caterpillar_jobs: 1
+
+# Order in which VODs are downloaded: chronological (default; oldest
+# first), smallest-first (smallest file first, so that as many files as
+# possible are complete early on, e.g. in case of interruption),
+# newest-first, or fair (round-robin across members). The number of
+# files completed per minute is reported after each batch, for comparing
+# orders.
+#download_order: chronological
+
+# Global download bandwidth limit, in bytes per second, with an optional
+# K, M or G suffix (multiples of 1024, e.g. 2M), or unlimited (default).
+# The limit is shared by all concurrent downloads, and shown in progress
+# output. Note that a limit changes how VODs are downloaded (with a
+# warning):
+#
+# - aria2 is always run as an RPC daemon (see aria2_rpc), so that the
+#   limit can be changed on the fly;
+# - caterpillar can't be throttled, so it is only run while unlimited
+#   (e.g. in an unlimited window of bandwidth_schedule), and terminated
+#   when a limit takes effect; M3U8 VODs are downloaded with the builtin
+#   downloader (see m3u8_downloader) while a limit is in effect, which
+#   doesn't repair timestamp discontinuities like caterpillar does.
+#bandwidth_limit: unlimited
+
+# Time-of-day windows (in local time) with limits of their own, which
+# override bandwidth_limit, each in the form "HH:MM-HH:MM LIMIT".
+# Windows may wrap around midnight. For instance, to download at full
+# speed from 01:00 to 08:00, and at 2 MiB/s otherwise:
+#
+#   bandwidth_limit: 2M
+#   bandwidth_schedule:
+#     - 01:00-08:00 unlimited
+#bandwidth_schedule: []
+
 # Perf mode specific settings (--mode perf).
 #
 # New in v1.0.
@@ -159,8 +272,7 @@ perf:
   # Default is on.
   #instructions: off
 """
-FILTER_TEMPLATE = """\
-# This module is imported to preprocess and exclude filenames/filepaths
+FILTER_TEMPLATE = r"""# This module is imported to preprocess and exclude filenames/filepaths
 # of VODS in perf mode.
 #
 # A single function named `filter` with the signature
@@ -183,7 +295,7 @@ FILTER_TEMPLATE = """\
 #IGNORES = [RE(r"生日会")]
 #SUBS = [
 #    # (pattern, repl)
-#    (RE(r"(S|N|H|X)II"), r"\\1Ⅱ"),
+#    (RE(r"(S|N|H|X)II"), r"\1Ⅱ"),
 #    (RE(r"Team Ft", re.I), r"Team Ft"),
 #    (RE(r"Team", re.I), r"Team"),
 #    (RE(r"\s+"), r" "),
@@ -223,6 +335,20 @@ class Config(object):
         self.editor = None  # type: str
         self.editor_opts = None  # type: List[str]
         self.update_checks = True  # type: bool
+        self.resolve_workers = DEFAULT_RESOLVE_WORKERS  # type: int
+        self.api_deadline = None  # type: Optional[float]
+        self.resolve_cache_ttl = None  # type: Optional[float]
+        self.api_base_url = None  # type: Optional[str]
+        self.api_hedging = True  # type: bool
+        self.watch_interval = DEFAULT_WATCH_INTERVAL  # type: float
+        self.aria2_rpc = False  # type: Union[bool, str]
+        self.aria2_rpc_secret = None  # type: Optional[str]
+        self.direct_downloader = "aria2"  # type: str
+        self.aria2_max_connections = DEFAULT_ARIA2_MAX_CONNECTIONS  # type: int
+        self.m3u8_downloader = "caterpillar"  # type: str
+        self.caterpillar_jobs = 1  # type: int
+        self.download_order = scheduling.CHRONOLOGICAL  # type: str
+        self.bandwidth = bandwidth.Schedule()  # type: bandwidth.Schedule
         self._perf = dict()  # type: Dict[str, Any]
         self._perf_group_id = 0  # type: int
         self._perf_span = 1  # type: int
@@ -244,7 +370,7 @@ class Config(object):
 
         try:
             self._group_id = int(obj.get("group_id") or 0)
-        except ValueError:
+        except (TypeError, ValueError):
             raise ConfigError("invalid group_id; must be an integer")
         if self._group_id not in (0, 10, 11, 12, 13, 14):
             raise ConfigError(
@@ -262,7 +388,7 @@ class Config(object):
 
         try:
             self._span = max(int(obj.get("span") or 1), 1)
-        except ValueError:
+        except (TypeError, ValueError):
             raise ConfigError("invalid span; must be an integer")
 
         directory = obj.get("directory")
@@ -309,6 +435,135 @@ class Config(object):
         if not isinstance(self.update_checks, bool):
             raise ConfigError("invalid update_checks; update_checks must be a boolean")
 
+        # Options below are checked against None rather than for
+        # truthiness, so that a configured 0 or off is validated instead of
+        # silently falling back to the default.
+        resolve_workers = obj.get("resolve_workers")
+        if resolve_workers is None:
+            resolve_workers = DEFAULT_RESOLVE_WORKERS
+        try:
+            self.resolve_workers = int(resolve_workers)
+        except (TypeError, ValueError):
+            raise ConfigError("invalid resolve_workers; must be an integer")
+        if self.resolve_workers <= 0:
+            raise ConfigError("invalid resolve_workers; must be positive")
+
+        self.api_deadline = obj.get("api_deadline")
+        if self.api_deadline is not None:
+            try:
+                self.api_deadline = float(self.api_deadline)
+            except (TypeError, ValueError):
+                raise ConfigError("invalid api_deadline; must be a number")
+            if self.api_deadline <= 0:
+                raise ConfigError("invalid api_deadline; must be positive")
+
+        resolve_cache_ttl = obj.get("resolve_cache_ttl")
+        if resolve_cache_ttl is None:
+            self.resolve_cache_ttl = None
+        else:
+            try:
+                resolve_cache_ttl = float(resolve_cache_ttl)
+            except (TypeError, ValueError):
+                raise ConfigError("invalid resolve_cache_ttl; must be a number")
+            if resolve_cache_ttl <= 0:
+                raise ConfigError("invalid resolve_cache_ttl; must be positive")
+            # In seconds.
+            self.resolve_cache_ttl = resolve_cache_ttl * 86400
+
+        self.api_hedging = obj.get("api_hedging", True)
+        if not isinstance(self.api_hedging, bool):
+            raise ConfigError("invalid api_hedging; api_hedging must be a boolean")
+
+        # An empty environment variable counts as unset.
+        self.api_base_url = os.environ.get(API_BASE_URL_ENV) or None
+        if self.api_base_url is None:
+            self.api_base_url = obj.get("api_base_url")
+        if self.api_base_url is not None and (
+            not isinstance(self.api_base_url, str)
+            or not self.api_base_url.startswith(("http://", "https://"))
+        ):
+            raise ConfigError("invalid api_base_url; must be an HTTP(S) URL")
+
+        watch_interval = obj.get("watch_interval")
+        if watch_interval is None:
+            watch_interval = DEFAULT_WATCH_INTERVAL
+        try:
+            self.watch_interval = float(watch_interval)
+        except (TypeError, ValueError):
+            raise ConfigError("invalid watch_interval; must be a number")
+        if self.watch_interval <= 0:
+            raise ConfigError("invalid watch_interval; must be positive")
+
+        self.aria2_rpc = obj.get("aria2_rpc")
+        if self.aria2_rpc is None:
+            self.aria2_rpc = False
+        if not (
+            isinstance(self.aria2_rpc, bool)
+            or isinstance(self.aria2_rpc, str)
+            and self.aria2_rpc.startswith(("http://", "https://"))
+        ):
+            raise ConfigError("invalid aria2_rpc; must be on, off, or an HTTP(S) URL")
+        self.aria2_rpc_secret = obj.get("aria2_rpc_secret")
+        if self.aria2_rpc_secret is not None:
+            self.aria2_rpc_secret = str(self.aria2_rpc_secret)
+
+        self.direct_downloader = obj.get("direct_downloader")
+        if self.direct_downloader is None:
+            self.direct_downloader = "aria2"
+        if self.direct_downloader not in ("aria2", "builtin"):
+            raise ConfigError("invalid direct_downloader; must be aria2 or builtin")
+        aria2_max_connections = obj.get("aria2_max_connections")
+        if aria2_max_connections is None:
+            aria2_max_connections = DEFAULT_ARIA2_MAX_CONNECTIONS
+        try:
+            self.aria2_max_connections = int(aria2_max_connections)
+        except (TypeError, ValueError):
+            raise ConfigError("invalid aria2_max_connections; must be an integer")
+        if self.aria2_max_connections <= 0:
+            raise ConfigError("invalid aria2_max_connections; must be positive")
+
+        self.m3u8_downloader = obj.get("m3u8_downloader")
+        if self.m3u8_downloader is None:
+            self.m3u8_downloader = "caterpillar"
+        if self.m3u8_downloader not in ("caterpillar", "builtin"):
+            raise ConfigError("invalid m3u8_downloader; must be caterpillar or builtin")
+
+        caterpillar_jobs = obj.get("caterpillar_jobs")
+        if caterpillar_jobs is None:
+            caterpillar_jobs = 1
+        try:
+            self.caterpillar_jobs = int(caterpillar_jobs)
+        except (TypeError, ValueError):
+            raise ConfigError("invalid caterpillar_jobs; must be an integer")
+        if self.caterpillar_jobs <= 0:
+            raise ConfigError("invalid caterpillar_jobs; must be positive")
+
+        self.download_order = obj.get("download_order")
+        if self.download_order is None:
+            self.download_order = scheduling.CHRONOLOGICAL
+        if self.download_order not in scheduling.POLICIES:
+            raise ConfigError(
+                "invalid download_order; must be one of %s"
+                % ", ".join(scheduling.POLICIES)
+            )
+
+        try:
+            bandwidth_limit = bandwidth.parse_rate(obj.get("bandwidth_limit"))
+        except (TypeError, ValueError):
+            raise ConfigError(
+                "invalid bandwidth_limit; must be a rate like 2M, or unlimited"
+            )
+        windows = obj.get("bandwidth_schedule")
+        if windows is None:
+            windows = []
+        if not isinstance(windows, list):
+            raise ConfigError("invalid bandwidth_schedule; must be a list of windows")
+        try:
+            windows = [bandwidth.parse_window(window) for window in windows]
+        except ValueError as exc:
+            raise ConfigError("invalid bandwidth_schedule: %s" % exc)
+        self.bandwidth = bandwidth.Schedule(bandwidth_limit, windows)
+
         self._perf = obj.get("perf") or dict()
         if not isinstance(self._perf, dict):
             raise ConfigError("invalid perf section; perf must be a dict")
@@ -321,12 +576,12 @@ class Config(object):
 
         try:
             self._perf_span = max(int(self._perf.get("span") or self._span), 1)
-        except ValueError:
+        except (TypeError, ValueError):
             raise ConfigError("invalid perf.span; must be an integer")
 
         try:
             self._perf_group_id = int(self._perf.get("group_id") or self._group_id)
-        except ValueError:
+        except (TypeError, ValueError):
             raise ConfigError("invalid group_id; must be an integer")
         if self._perf_group_id not in (0, 10, 11, 12, 13, 14):
             raise ConfigError(
@@ -436,8 +691,10 @@ class Config(object):
     def group_name(self) -> str:
         return self._get_group_name(self.group_id)
 
-    def filename(self, vod: VOD) -> str:
-        if hasattr(vod, "filename") and vod.filename:
+    # ext overrides the extension derived from vod.vod_url, which is
+    # useful for predicting filenames of unresolved VODs.
+    def filename(self, vod: VOD, *, ext: str = None) -> str:
+        if vod.filename:
             return vod.filename
         unsanitized = self.naming % {
             "date": vod.start_time.strftime("%Y-%m-%d"),
@@ -448,19 +705,21 @@ class Config(object):
             "name": vod.name,
             "type": vod.type,
             "title": vod.title.strip(),
-            "ext": extension_from_url(vod.vod_url),
+            "ext": ext if ext is not None else extension_from_url(vod.vod_url),
         }
         return self._sanitize_filename(unsanitized)
 
-    def filepath(self, vod: VOD) -> str:
-        if hasattr(vod, "filepath") and vod.filepath:
+    def filepath(self, vod: VOD, *, ext: str = None) -> str:
+        if vod.filepath:
             return vod.filepath
-        if self.named_subdirs and hasattr(vod, "name"):
+        if self.named_subdirs:
             return (
-                self._sanitize_filename(vod.name or "其它") + os.sep + self.filename(vod)
+                self._sanitize_filename(vod.name or "其它")
+                + os.sep
+                + self.filename(vod, ext=ext)
             )
         else:
-            return self.filename(vod)
+            return self.filename(vod, ext=ext)
 
     def filter(self, path: str) -> Optional[str]:
         if self.mode == "std":
@@ -477,17 +736,15 @@ class Config(object):
     def test_naming_pattern(self) -> None:
         try:
             self.filename(
-                VOD(
-                    {
-                        "id": "5a80219c0cf29aa343fbe009",
-                        "member_id": 35,
-                        "type": "直播",
-                        "name": "莫寒",
-                        "title": "一人吃火锅的人生成就(๑˙ー˙๑)",
-                        "start_time": arrow.get("2018-02-11T18:57:32.164000+08:00"),
-                        "vod_url": "https://mp4.48.cn/live/82b50b91-28f8-4182-8ac0-3ca4d0202636.mp4",
-                        "danmaku_url": "https://source.48.cn/mediasource/live/lrc/5a80219c0cf29aa343fbe009.lrc",
-                    }
+                MemberVOD(
+                    "5a80219c0cf29aa343fbe009",
+                    35,
+                    "直播",
+                    "莫寒",
+                    "一人吃火锅的人生成就(๑˙ー˙๑)",
+                    arrow.get("2018-02-11T18:57:32.164000+08:00"),
+                    vod_url="https://mp4.48.cn/live/82b50b91-28f8-4182-8ac0-3ca4d0202636.mp4",
+                    danmaku_url="https://source.48.cn/mediasource/live/lrc/5a80219c0cf29aa343fbe009.lrc",
                 )
             )
         except Exception:
@@ -0,0 +1,272 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import requests
+
+from . import bandwidth, jobs, utils
+from .httpdl import TIMEOUT, DownloadError
+from .session import get_session
+
+
+# Built-in HLS downloader, an alternative to caterpillar for M3U8 VODs.
+#
+# The playlist is resolved (for a master playlist, the variant with the
+# highest bandwidth is chosen), and segments of the media playlist are
+# fetched concurrently by `workers` threads over the pooled connections
+# of the shared session, each retried up to SEGMENT_ATTEMPTS times.
+# Segments are saved as separate files in a work directory next to the
+# output, path + WORK_DIR_SUFFIX, so that an interrupted download
+# resumes with the segments that are still missing. Once all segments
+# are there, they are concatenated into the output file by streaming
+# them one by one from disk. Since targets are named .mp4, concatenated
+# MPEG-TS streams are remuxed into MP4 with ffmpeg(1) (no transcoding).
+# Rather than writing an MPEG-TS stream to a .mp4 file, the download
+# fails upfront if ffmpeg is not available (fragmented MP4 streams and
+# outputs with other extensions are written as is).
+DEFAULT_WORKERS = 8
+SEGMENT_ATTEMPTS = 3
+COPY_BUFFER_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 10  # in seconds
+FFMPEG = "ffmpeg"
+
+WORK_DIR_SUFFIX = ".segments"
+
+
+# For streams using features not implemented here, e.g., encryption.
+# Retrying won't help.
+class UnsupportedStreamError(DownloadError):
+    pass
+
+
+class Playlist(object):
+    def __init__(self):
+        # (bandwidth, URL) of variant streams, if a master playlist.
+        self.variants = []  # type: List[Tuple[int, str]]
+        # Segment URLs, if a media playlist; the initialization section
+        # (EXT-X-MAP) of fragmented MP4 streams comes first.
+        self.segments = []  # type: List[str]
+        self.fragmented_mp4 = False
+
+
+def _attributes(line: str) -> dict:
+    _, _, attrs = line.partition(":")
+    return {
+        key: value.strip('"')
+        for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', attrs)
+    }
+
+
+def parse_playlist(text: str, url: str) -> Playlist:
+    lines = [line.strip() for line in text.lstrip("\ufeff").splitlines()]
+    if not lines or lines[0] != "#EXTM3U":
+        raise DownloadError("not an M3U8 playlist: %s" % url)
+    playlist = Playlist()
+    bandwidth = None
+    for line in lines[1:]:
+        if not line:
+            continue
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            bandwidth = int(_attributes(line).get("BANDWIDTH") or 0)
+        elif line.startswith("#EXT-X-KEY:"):
+            method = _attributes(line).get("METHOD", "NONE")
+            if method != "NONE":
+                raise UnsupportedStreamError(
+                    "encrypted HLS streams (%s) are not supported: %s" % (method, url)
+                )
+        elif line.startswith("#EXT-X-BYTERANGE"):
+            raise UnsupportedStreamError(
+                "byte range HLS segments are not supported: %s" % url
+            )
+        elif line.startswith("#EXT-X-MAP:"):
+            uri = _attributes(line).get("URI")
+            if uri and not playlist.fragmented_mp4:
+                playlist.segments.append(urllib.parse.urljoin(url, uri))
+                playlist.fragmented_mp4 = True
+        elif not line.startswith("#"):
+            uri = urllib.parse.urljoin(url, line)
+            if bandwidth is not None:
+                playlist.variants.append((bandwidth, uri))
+                bandwidth = None
+            else:
+                playlist.segments.append(uri)
+    return playlist
+
+
+def _fetch_text(session: requests.Session, url: str) -> str:
+    r = session.get(url, timeout=TIMEOUT)
+    if r.status_code != 200:
+        raise DownloadError("HTTP error %d for %s" % (r.status_code, url))
+    return r.content.decode("utf-8", errors="replace")
+
+
+# Returns the media playlist of url, following a master playlist to its
+# highest bandwidth variant.
+def resolve_playlist(session: requests.Session, url: str) -> Playlist:
+    playlist = parse_playlist(_fetch_text(session, url), url)
+    if playlist.variants:
+        _, url = max(playlist.variants)
+        playlist = parse_playlist(_fetch_text(session, url), url)
+        if playlist.variants:
+            raise DownloadError("nested master playlists: %s" % url)
+    if not playlist.segments:
+        raise DownloadError("no segments in playlist: %s" % url)
+    return playlist
+
+
+def _remux(source: str, dest: str) -> None:
+    proc = subprocess.run(
+        [
+            FFMPEG,
+            *("-nostdin", "-loglevel", "error", "-y", "-i", source),
+            *("-c", "copy", "-bsf:a", "aac_adtstoasc", "-f", "mp4", dest),
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if proc.returncode != 0:
+        message = proc.stderr.decode("utf-8", errors="replace").strip()
+        raise DownloadError(
+            "ffmpeg failed to remux %s: %s"
+            % (source, (message.splitlines() or [""])[-1])
+        )
+
+
+# Downloads the HLS stream at url to path, and returns the size of the
+# output file. See the top of this module for details. Progress is
+# reported through log (if specified) every PROGRESS_INTERVAL seconds
+# and upon completion. If limiter (a bandwidth.Share) is specified,
+# segments are fetched no faster than its limit.
+#
+# DownloadError (or UnsupportedStreamError) is raised for unexpected
+# responses and unsupported streams (including MPEG-TS streams to be
+# saved as .mp4 without ffmpeg); requests.RequestException and
+# OSError are passed through.
+def download(
+    url: str,
+    path: str,
+    *,
+    workers: int = None,
+    session: requests.Session = None,
+    log: Optional[Callable[[str], None]] = None,
+    limiter: Optional[bandwidth.Share] = None,
+) -> int:
+    workers = workers or DEFAULT_WORKERS
+    session = session or get_session()
+    work_dir = path + WORK_DIR_SUFFIX
+    state_path = os.path.join(work_dir, "state.json")
+    name = os.path.basename(path)
+
+    playlist = resolve_playlist(session, url)
+    remux = not playlist.fragmented_mp4 and path.lower().endswith(".mp4")
+    if remux and shutil.which(FFMPEG) is None:
+        raise UnsupportedStreamError(
+            "ffmpeg(1) not found, which is needed to remux MPEG-TS streams "
+            "into MP4: %s" % url
+        )
+    count = len(playlist.segments)
+    # Segments from a previous run are only reused if the playlist has
+    # the same number of segments (segment URLs themselves may carry
+    # expiring tokens).
+    try:
+        with open(state_path, encoding="utf-8") as fp:
+            if json.load(fp)["segments"] != count:
+                shutil.rmtree(work_dir)
+    except (OSError, ValueError, KeyError, TypeError):
+        shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir, exist_ok=True)
+    with open(state_path, "w", encoding="utf-8") as fp:
+        json.dump(dict(url=url, segments=count), fp)
+
+    def segment_path(index):
+        return os.path.join(work_dir, "%06d" % index)
+
+    pending = [i for i in range(count) if not os.path.exists(segment_path(i))]
+    lock = threading.Lock()
+    aborted = threading.Event()
+    start_time = time.monotonic()
+    progress = dict(done=count - len(pending), bytes=0, last_report=start_time)
+
+    def report():
+        now = time.monotonic()
+        if not log or now - progress["last_report"] < PROGRESS_INTERVAL:
+            return
+        progress["last_report"] = now
+        elapsed = now - start_time
+        log(
+            "%s: %d of %d segments, %s/s%s\n"
+            % (
+                name,
+                progress["done"],
+                count,
+                utils.format_size(progress["bytes"] / elapsed if elapsed > 0 else 0),
+                bandwidth.format_limit(limiter),
+            )
+        )
+
+    def fetch(index):
+        dest = segment_path(index)
+        for attempt in range(SEGMENT_ATTEMPTS):
+            if aborted.is_set():
+                return
+            try:
+                with session.get(
+                    playlist.segments[index], stream=True, timeout=TIMEOUT
+                ) as r:
+                    if r.status_code != 200:
+                        raise DownloadError(
+                            "HTTP error %d for %s" % (r.status_code, r.url)
+                        )
+                    length = r.headers.get("Content-Length")
+                    received = 0
+                    with open(dest + ".part", "wb") as fp:
+                        for data in r.iter_content(COPY_BUFFER_SIZE):
+                            fp.write(data)
+                            received += len(data)
+                            if limiter:
+                                limiter.consume(len(data))
+                if length is not None and received != int(length):
+                    raise DownloadError(
+                        "incomplete segment %s: received %d of %s bytes"
+                        % (r.url, received, length)
+                    )
+            except (DownloadError, requests.RequestException) as exc:
+                if attempt == SEGMENT_ATTEMPTS - 1 or jobs.is_permanent_error(str(exc)):
+                    aborted.set()
+                    raise
+                continue
+            os.replace(dest + ".part", dest)
+            with lock:
+                progress["done"] += 1
+                progress["bytes"] += received
+                report()
+            return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch, index) for index in pending]
+    for future in futures:
+        future.result()
+
+    # Concatenate.
+    concat_path = os.path.join(work_dir, "concat") if remux else path + ".part"
+    with open(concat_path, "wb") as out:
+        for index in range(count):
+            with open(segment_path(index), "rb") as fp:
+                shutil.copyfileobj(fp, out, COPY_BUFFER_SIZE)
+    if remux:
+        _remux(concat_path, path + ".part")
+    os.replace(path + ".part", path)
+    shutil.rmtree(work_dir)
+
+    size = os.path.getsize(path)
+    if log:
+        log("Downloaded %s (%s)\n" % (name, utils.format_size(size)))
+    return size
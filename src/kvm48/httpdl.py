@@ -0,0 +1,292 @@
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Set
+
+import requests
+
+from . import bandwidth, jobs, utils
+from .session import get_session
+
+
+# Built-in HTTP downloader, an alternative to aria2 for direct
+# downloads. Each file is split into ranges of chunk_size bytes, which
+# are fetched concurrently by `workers` threads over the pooled
+# connections of the shared session, and written in place (with
+# pwrite) to a partial file, path + PART_SUFFIX. The ranges completed so
+# far are recorded in a sidecar state file, path + STATE_SUFFIX, so an
+# interrupted download resumes where it left off. The partial file is
+# only renamed to path once its size has been verified, so the final
+# path never holds an incomplete file, and the usual skip-if-exists
+# checks (e.g. aria2.write_manifest) work as is.
+DEFAULT_WORKERS = 8
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_ATTEMPTS = 3
+READ_SIZE = 64 * 1024
+TIMEOUT = 30  # in seconds, for connecting and between reads
+PROGRESS_INTERVAL = 10  # in seconds
+
+PART_SUFFIX = ".part"
+STATE_SUFFIX = ".part.json"
+
+
+class DownloadError(Exception):
+    pass
+
+
+if hasattr(os, "pwrite"):
+
+    def _pwrite(fd: int, data: bytes, offset: int) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+
+else:
+    # No pwrite on Windows; emulate it with a seek and a write under a
+    # lock.
+    _pwrite_lock = threading.Lock()
+
+    def _pwrite(fd: int, data: bytes, offset: int) -> None:
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+
+
+def _check_status(r: requests.Response, expected: int) -> None:
+    if r.status_code != expected:
+        raise DownloadError("HTTP error %d for %s" % (r.status_code, r.url))
+
+
+# Returns (size, ranged): the size of the file, and whether the server
+# supports range requests. size is None if unknown.
+def _probe(session: requests.Session, url: str):
+    with session.get(
+        url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT
+    ) as r:
+        if r.status_code == 206:
+            m = re.match(r"bytes 0-0/(\d+)$", r.headers.get("Content-Range", ""))
+            if m:
+                return int(m.group(1)), True
+        _check_status(r, 200)
+        length = r.headers.get("Content-Length")
+        return (int(length) if length else None), False
+
+
+class _Progress(object):
+    def __init__(self, name, size, done, log, limiter=None):
+        self.name = name
+        self.size = size
+        self.done = done
+        self.log = log
+        self.limiter = limiter
+        self._start = time.monotonic()
+        self._start_done = done
+        self._last_report = self._start
+        self._lock = threading.Lock()
+
+    def add(self, n: int) -> None:
+        with self._lock:
+            self.done += n
+            now = time.monotonic()
+            if not self.log or now - self._last_report < PROGRESS_INTERVAL:
+                return
+            self._last_report = now
+        self.log(
+            "%s: %s of %s, %s/s%s\n"
+            % (
+                self.name,
+                utils.format_size(self.done),
+                utils.format_size(self.size) if self.size else "unknown size",
+                utils.format_size(self.speed()),
+                bandwidth.format_limit(self.limiter),
+            )
+        )
+
+    def speed(self) -> float:
+        elapsed = time.monotonic() - self._start
+        return (self.done - self._start_done) / elapsed if elapsed > 0 else 0
+
+
+class _State(object):
+    def __init__(self, path: str, url: str, size: int, chunk_size: int):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.chunk_size = chunk_size
+        self.done = set()  # type: Set[int]
+        self._lock = threading.Lock()
+
+    # Restores completed chunks from the state file, if the state file
+    # describes the same file (size) and chunking, and the partial file
+    # is still there.
+    def load(self, part_path: str) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as fp:
+                obj = json.load(fp)
+            if (
+                obj["size"] == self.size
+                and obj["chunk_size"] == self.chunk_size
+                and os.path.getsize(part_path) == self.size
+            ):
+                self.done = set(obj["done"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def complete(self, index: int) -> None:
+        with self._lock:
+            self.done.add(index)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fp:
+                json.dump(
+                    dict(
+                        url=self.url,
+                        size=self.size,
+                        chunk_size=self.chunk_size,
+                        done=sorted(self.done),
+                    ),
+                    fp,
+                )
+            os.replace(tmp, self.path)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+# Downloads url to path, and returns the size of the file. See the top
+# of this module for details. Progress is reported through log (if
+# specified) every PROGRESS_INTERVAL seconds and upon completion. If
+# limiter (a bandwidth.Share) is specified, the download is throttled
+# to its limit.
+#
+# DownloadError is raised if the server answers with an unexpected
+# status or the wrong number of bytes; requests.RequestException and
+# OSError are passed through.
+def download(
+    url: str,
+    path: str,
+    *,
+    workers: int = None,
+    chunk_size: int = None,
+    session: requests.Session = None,
+    log: Optional[Callable[[str], None]] = None,
+    limiter: Optional[bandwidth.Share] = None,
+) -> int:
+    workers = workers or DEFAULT_WORKERS
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    session = session or get_session()
+    part_path = path + PART_SUFFIX
+    state_path = path + STATE_SUFFIX
+    name = os.path.basename(path)
+
+    size, ranged = _probe(session, url)
+    if not ranged or not size:
+        # Can't split or resume; download in one go.
+        _remove(state_path)
+        progress = _Progress(name, size, 0, log, limiter)
+        with session.get(url, stream=True, timeout=TIMEOUT) as r:
+            _check_status(r, 200)
+            with open(part_path, "wb") as fp:
+                for data in r.iter_content(READ_SIZE):
+                    fp.write(data)
+                    progress.add(len(data))
+                    if limiter:
+                        limiter.consume(len(data))
+        received = os.path.getsize(part_path)
+        if size is not None and received != size:
+            raise DownloadError(
+                "size mismatch: received %d bytes, expected %d" % (received, size)
+            )
+    else:
+        state = _State(state_path, url, size, chunk_size)
+        state.load(part_path)
+        chunks = [
+            (i, start, min(start + chunk_size, size) - 1)
+            for i, start in enumerate(range(0, size, chunk_size))
+            if i not in state.done
+        ]
+        progress = _Progress(
+            name,
+            size,
+            size - sum(end - start + 1 for _, start, end in chunks),
+            log,
+            limiter,
+        )
+        aborted = threading.Event()
+
+        def fetch(chunk):
+            index, start, end = chunk
+            for attempt in range(CHUNK_ATTEMPTS):
+                if aborted.is_set():
+                    return
+                offset = start
+                try:
+                    with session.get(
+                        url,
+                        headers={"Range": "bytes=%d-%d" % (start, end)},
+                        stream=True,
+                        timeout=TIMEOUT,
+                    ) as r:
+                        _check_status(r, 206)
+                        for data in r.iter_content(READ_SIZE):
+                            if offset + len(data) > end + 1:
+                                raise DownloadError("server sent excess bytes")
+                            _pwrite(fd, data, offset)
+                            offset += len(data)
+                            progress.add(len(data))
+                            if limiter:
+                                limiter.consume(len(data))
+                    if offset != end + 1:
+                        raise DownloadError(
+                            "incomplete range %d-%d: received %d bytes"
+                            % (start, end, offset - start)
+                        )
+                except (DownloadError, requests.RequestException) as exc:
+                    progress.add(start - offset)
+                    if attempt == CHUNK_ATTEMPTS - 1 or jobs.is_permanent_error(
+                        str(exc)
+                    ):
+                        aborted.set()
+                        raise
+                    continue
+                state.complete(index)
+                return
+
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0))
+        try:
+            os.ftruncate(fd, size)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(fetch, chunk) for chunk in chunks]
+            for future in futures:
+                future.result()
+            received = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if received != size or len(state.done) != len(range(0, size, chunk_size)):
+            _remove(state_path)
+            raise DownloadError(
+                "size mismatch: received %d bytes, expected %d" % (received, size)
+            )
+
+    os.replace(part_path, path)
+    _remove(state_path)
+    if log:
+        log(
+            "Downloaded %s (%s, %s/s)\n"
+            % (
+                name,
+                utils.format_size(progress.done),
+                utils.format_size(progress.speed()),
+            )
+        )
+    return progress.done
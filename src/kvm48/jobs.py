@@ -0,0 +1,212 @@
+import random
+import re
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+# Job states.
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED_RETRYABLE = "failed-retryable"
+FAILED_PERMANENT = "failed-permanent"
+
+DEFAULT_MAX_ATTEMPTS = 3
+BACKOFF_BASE = 5  # in seconds
+BACKOFF_CAP = 120  # in seconds
+
+# HTTP statuses in error messages that are not worth retrying (the
+# resource is gone or off limits), i.e., 4xx except 408 Request Timeout
+# and 429 Too Many Requests.
+PERMANENT_STATUS_PATTERN = re.compile(
+    r"(?:status=|status code:? |HTTP error |Server returned |HTTP/1\.[01] )"
+    r"4(?!08|29)\d\d\b"
+    r"|\b(?:Not Found|Forbidden|Gone|Unauthorized)\b",
+    re.I,
+)
+# Local conditions that retrying won't fix.
+PERMANENT_LOCAL_PATTERN = re.compile(
+    r"No space left|not enough disk space|Permission denied|already exist", re.I
+)
+
+
+# Whether an error message (of any backend) indicates a failure that
+# won't go away by retrying.
+def is_permanent_error(message: str) -> bool:
+    return bool(
+        PERMANENT_STATUS_PATTERN.search(message)
+        or PERMANENT_LOCAL_PATTERN.search(message)
+    )
+
+
+# A download target (a (url, filepath) pair) and its retry state.
+class Job(object):
+    def __init__(self, target: Tuple[str, str]):
+        self.target = target
+        self.state = PENDING
+        self.attempts = 0
+        self.error = None  # type: Optional[str]
+        # time.monotonic() values.
+        self.not_before = 0.0
+        self.finished_at = None  # type: Optional[float]
+
+    def __repr__(self):
+        return "<Job %s %s attempts=%d>" % (self.target[1], self.state, self.attempts)
+
+
+# Per-target retry queue. Jobs start out pending; take_ready() hands out
+# jobs that are due (pending, or retryable with their backoff elapsed)
+# and marks them running; each running job is then reported back with
+# succeed() or fail(). A failed job is retried after exponential backoff
+# with full jitter (a random delay between 0 and min(backoff_cap,
+# backoff_base * 2 ** (attempts - 1)) seconds), unless the error is
+# permanent or max_attempts is reached.
+class RetryQueue(object):
+    def __init__(
+        self,
+        targets: List[Tuple[str, str]],
+        *,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        backoff_base: float = None,
+        backoff_cap: float = None,
+    ):
+        self.jobs = [Job(target) for target in targets]
+        self.max_attempts = max_attempts
+        self.backoff_base = BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_cap = BACKOFF_CAP if backoff_cap is None else backoff_cap
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take_ready(self) -> List[Job]:
+        now = time.monotonic()
+        with self._lock:
+            ready = [
+                job
+                for job in self.jobs
+                if job.state in (PENDING, FAILED_RETRYABLE) and job.not_before <= now
+            ]
+            for job in ready:
+                job.state = RUNNING
+                job.attempts += 1
+        return ready
+
+    def succeed(self, job: Job) -> None:
+        with self._lock:
+            job.state = DONE
+            job.error = None
+            job.finished_at = time.monotonic()
+
+    def fail(self, job: Job, error: str, *, permanent: bool = False) -> None:
+        with self._lock:
+            job.error = error
+            if permanent or job.attempts >= self.max_attempts:
+                job.state = FAILED_PERMANENT
+            else:
+                job.state = FAILED_RETRYABLE
+                delay = random.uniform(
+                    0,
+                    min(self.backoff_cap, self.backoff_base * 2 ** (job.attempts - 1)),
+                )
+                job.not_before = time.monotonic() + delay
+
+    # Puts a running job back as pending, without counting the attempt,
+    # e.g., when it was interrupted on purpose.
+    def release(self, job: Job) -> None:
+        with self._lock:
+            job.state = PENDING
+            job.attempts -= 1
+            job.not_before = 0.0
+
+    # Seconds until the next job is due (0 if one is due now), or None
+    # if there are no more jobs to take (running jobs aside).
+    def wait_time(self) -> Optional[float]:
+        with self._lock:
+            due = [
+                job.not_before
+                for job in self.jobs
+                if job.state in (PENDING, FAILED_RETRYABLE)
+            ]
+        if not due:
+            return None
+        return max(min(due) - time.monotonic(), 0)
+
+    def finished(self) -> bool:
+        with self._lock:
+            return all(job.state in (DONE, FAILED_PERMANENT) for job in self.jobs)
+
+    def failed(self) -> List[Job]:
+        with self._lock:
+            return [job for job in self.jobs if job.state == FAILED_PERMANENT]
+
+    def count(self, state: str) -> int:
+        with self._lock:
+            return sum(1 for job in self.jobs if job.state == state)
+
+
+# Drives the jobs of a queue in rounds until all of them are finished:
+# each round, run_round is called with the jobs that are due, and must
+# report each of them back to the queue (succeed or fail). Backoff is
+# waited out in between rounds, with a message through log.
+def run_rounds(
+    queue: RetryQueue,
+    run_round: Callable[[List[Job]], None],
+    *,
+    log: Callable[[str], None],
+) -> None:
+    while True:
+        wait = queue.wait_time()
+        if wait is None:
+            return
+        if wait > 0:
+            log(
+                "Retrying %d downloads in %.1f seconds...\n"
+                % (queue.count(FAILED_RETRYABLE), wait)
+            )
+            time.sleep(wait)
+        run_round(queue.take_ready())
+
+
+# Formats the final report of failed jobs: the URL and path of each,
+# followed by the last error and the number of attempts.
+def format_failures(jobs: List[Job]) -> str:
+    return "".join(
+        "\t%s\t%s\n\t\t%s (%d attempt%s)\n"
+        % (
+            job.target[0],
+            job.target[1],
+            job.error,
+            job.attempts,
+            "" if job.attempts == 1 else "s",
+        )
+        for job in jobs
+    )
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return "%dm%02ds" % (minutes, seconds) if minutes else "%ds" % seconds
+
+
+# Summarizes how fast jobs of a queue were completed, for comparing
+# download orders: the number of jobs done since the queue was created,
+# per minute, and the mean time it took for a job to be done (which
+# rewards finishing many jobs early, e.g., before an interruption).
+def format_completions(queue: RetryQueue) -> str:
+    now = time.monotonic()
+    times = [
+        job.finished_at - queue.started_at
+        for job in queue.jobs
+        if job.finished_at is not None
+    ]
+    elapsed = now - queue.started_at
+    msg = "%d of %d files completed in %s" % (
+        len(times),
+        len(queue.jobs),
+        _format_duration(elapsed),
+    )
+    if times and elapsed > 0:
+        msg += " (%.2f files/min, mean time to completion %s)" % (
+            len(times) / elapsed * 60,
+            _format_duration(sum(times) / len(times)),
+        )
+    return msg
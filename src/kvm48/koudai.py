@@ -1,28 +1,209 @@
 import datetime
 import json
+import multiprocessing.pool
+import queue
+import random
 import re
 import sys
+import threading
 import time
 import urllib.parse
-from typing import Any, Dict, Generator, List, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import arrow
-import attrdict
 import requests
 
+from . import persistence
+from .ratelimit import (
+    AIMDLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    LatencyTracker,
+    RateLimitTimeout,
+    TokenBucket,
+)
+from .pipeline import merge_concurrently
+from .session import get_session
+
 
 # Types
 Datetime = Union[datetime.datetime, arrow.Arrow]
-VOD = attrdict.AttrDict
 
-# API constants
-MEMBER_VOD_LIST_URL = "https://pocketapi.48.cn/live/api/v1/live/getLiveList"
-MEMBER_VOD_RESOLVE_URL = "https://pocketapi.48.cn/live/api/v1/live/getLiveOne"
-PERF_VOD_LIST_URL = "https://pocketapi.48.cn/live/api/v1/live/getOpenLiveList"
-PERF_VOD_RESOLVE_URL = "https://pocketapi.48.cn/live/api/v1/live/getOpenLiveOne"
+
+# VOD records are plain __slots__ classes rather than dicts, since a
+# long listing creates lots of them. filename and filepath are
+# optional overrides of config-derived names (see Config.filename and
+# Config.filepath).
+class MemberVOD:
+    __slots__ = (
+        "id",
+        "member_id",
+        "type",
+        "name",
+        "title",
+        "start_time",
+        "vod_url",
+        "danmaku_url",
+        "filename",
+        "filepath",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        member_id: int,
+        type: str,
+        name: str,
+        title: str,
+        start_time: arrow.Arrow,
+        vod_url: Optional[str] = None,
+        danmaku_url: Optional[str] = None,
+    ):
+        self.id = id
+        self.member_id = member_id
+        self.type = type
+        self.name = name
+        self.title = title
+        self.start_time = start_time
+        self.vod_url = vod_url
+        self.danmaku_url = danmaku_url
+        self.filename = None  # type: Optional[str]
+        self.filepath = None  # type: Optional[str]
+
+    def __repr__(self) -> str:
+        return "MemberVOD(id=%r, name=%r, title=%r, start_time=%r)" % (
+            self.id,
+            self.name,
+            self.title,
+            self.start_time,
+        )
+
+
+class PerfVOD:
+    __slots__ = (
+        "id",
+        "teams",
+        "title",
+        "name",
+        "start_time",
+        "vod_url",
+        "filename",
+        "filepath",
+    )
+
+    def __init__(
+        self,
+        id: str,
+        teams: List[str],
+        title: str,
+        name: Optional[str],
+        start_time: arrow.Arrow,
+        vod_url: Optional[str] = None,
+    ):
+        self.id = id
+        self.teams = teams
+        self.title = title
+        self.name = name
+        self.start_time = start_time
+        self.vod_url = vod_url
+        self.filename = None  # type: Optional[str]
+        self.filepath = None  # type: Optional[str]
+
+    def __repr__(self) -> str:
+        return "PerfVOD(id=%r, title=%r, start_time=%r)" % (
+            self.id,
+            self.title,
+            self.start_time,
+        )
+
+
+VOD = Union[MemberVOD, PerfVOD]
+
+# API constants. Endpoint URLs are relative to the API base URL, which
+# can be changed with set_api_base_url (e.g., to point at a local
+# kvm48.mockapi server).
+DEFAULT_API_BASE_URL = "https://pocketapi.48.cn/live/api/v1/live/"
+MEMBER_VOD_LIST_URL = DEFAULT_API_BASE_URL + "getLiveList"
+MEMBER_VOD_RESOLVE_URL = DEFAULT_API_BASE_URL + "getLiveOne"
+PERF_VOD_LIST_URL = DEFAULT_API_BASE_URL + "getOpenLiveList"
+PERF_VOD_RESOLVE_URL = DEFAULT_API_BASE_URL + "getOpenLiveOne"
 API_HEADERS = {"Content-Type": "application/json"}
 RESOURCE_BASE_URL = "https://source.48.cn/"
 
+# Retry policy of API calls. Timeouts, connection errors and the
+# following HTTP statuses are retried (all API calls are read-only and
+# hence safe to retry) with exponential backoff and full jitter.
+API_MAX_ATTEMPTS = 5
+API_BACKOFF_BASE = 0.5  # in seconds
+API_BACKOFF_CAP = 8  # in seconds
+API_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Flow control of API calls, shared by all threads (see ratelimit.py):
+# - at most API_RATE_LIMIT requests per second, with bursts of up to
+#   API_RATE_BURST requests;
+# - an AIMD window of concurrent requests, starting at API_WINDOW_INITIAL
+#   and kept between API_WINDOW_MIN and API_WINDOW_MAX, which shrinks on
+#   timeouts and API_RETRY_STATUSES, and grows while requests complete
+#   within API_LATENCY_THRESHOLD seconds;
+# - a circuit breaker per endpoint, opened for API_CIRCUIT_COOLDOWN
+#   seconds after API_CIRCUIT_THRESHOLD consecutive timeouts, connection
+#   errors or 5xx responses, during which calls fail immediately.
+API_RATE_LIMIT = 20  # requests per second
+API_RATE_BURST = 20
+API_WINDOW_INITIAL = 8
+API_WINDOW_MIN = 1
+API_WINDOW_MAX = 32
+API_LATENCY_THRESHOLD = 2  # in seconds
+API_CIRCUIT_THRESHOLD = 5
+API_CIRCUIT_COOLDOWN = 30  # in seconds
+
+# Hedging of idempotent calls (the resolve endpoints): if no response
+# arrives within the API_HEDGE_PERCENTILE latency of the endpoint
+# (estimated from its last API_LATENCY_SAMPLES calls, once there are at
+# least API_HEDGE_MIN_SAMPLES), a duplicate request is sent and the
+# first response wins. Hedges are capped at API_HEDGE_MAX_RATIO of
+# hedgeable calls, and are only sent if the rate limiter and the AIMD
+# window have room for them.
+API_HEDGE_PERCENTILE = 95
+API_HEDGE_MIN_SAMPLES = 20
+API_HEDGE_MAX_RATIO = 0.1
+API_HEDGE_MIN_DELAY = 0.05  # in seconds
+API_LATENCY_SAMPLES = 200
+
+# Member VODs younger than this many seconds may still be missing from
+# getLiveList (VODs are listed by starting time, but only show up once
+# the livestream is over), so the most recent window is never considered
+# fully indexed.
+MEMBER_VOD_INDEX_SETTLE_TIME = 6 * 3600
+
+# IDs of groups listed separately (and concurrently) when listing VODs
+# of all groups, i.e., with group_id 0; see list_member_vods.
+FAN_OUT_GROUP_IDS = (10, 11, 12, 13, 14)
+
+# Number of VODs resolved concurrently by resolve_member_vods and
+# resolve_perf_vods.
+DEFAULT_RESOLVE_WORKERS = 8
+
+# Timezone of all VOD start times. Resolved once, since converting each
+# listed record through arrow.Arrow.to("Asia/Shanghai") dominates the
+# cost of the listing loops.
+SHANGHAI_TZ = arrow.now("Asia/Shanghai").tzinfo
+
+# Member nicknames are in the form GROUP-NAME, e.g., SNH48-莫寒.
+MEMBER_NICKNAME_PATTERN = re.compile(r"^(?P<group>\w+)-(?P<member>\w+)$")
+# Performance VOD titles contain the name of the stage, e.g., 《美丽48区》.
+PERF_TITLE_STAGE_PATTERN = re.compile(r"《(?P<name>.*?)》")
+
 
 class APIException(Exception):
     def __init__(self, endpoint: str, payload: Dict[str, Any], exc: Exception):
@@ -39,6 +220,16 @@ class APIException(Exception):
         return "%s: %s" % (http_part, exc_part)
 
 
+class APIDeadlineExceeded(Exception):
+    pass
+
+
+# Raised by call_api without contacting the server when the circuit of
+# the endpoint is open.
+class APICircuitOpen(CircuitOpenError):
+    pass
+
+
 class ProgressReporter:
     disabled = False
     threshold = 5  # show progress threshold, in seconds
@@ -83,17 +274,292 @@ class ProgressReporter:
         self.finalized = time.time()
 
 
-def call_api(endpoint, payload):
-    # Gradually increase timeout, and only raise on the third
-    # consecutive timeout.
-    for attempt in range(3):
+# Monotonic time after which no more API calls (or retries) are
+# attempted; None for no deadline. Set through set_api_deadline.
+_api_deadline = None
+
+
+# Limit the total time spent on API calls in this run to `seconds`
+# (counting from now); None removes the limit.
+def set_api_deadline(seconds: Optional[float]) -> None:
+    global _api_deadline
+    _api_deadline = time.monotonic() + seconds if seconds else None
+
+
+# Set the base URL of API endpoints; None restores the default.
+def set_api_base_url(base_url: Optional[str]) -> None:
+    global MEMBER_VOD_LIST_URL, MEMBER_VOD_RESOLVE_URL
+    global PERF_VOD_LIST_URL, PERF_VOD_RESOLVE_URL
+    base_url = base_url or DEFAULT_API_BASE_URL
+    if not base_url.endswith("/"):
+        base_url += "/"
+    MEMBER_VOD_LIST_URL = base_url + "getLiveList"
+    MEMBER_VOD_RESOLVE_URL = base_url + "getLiveOne"
+    PERF_VOD_LIST_URL = base_url + "getOpenLiveList"
+    PERF_VOD_RESOLVE_URL = base_url + "getOpenLiveOne"
+
+
+def _api_time_remaining() -> Optional[float]:
+    if _api_deadline is None:
+        return None
+    return _api_deadline - time.monotonic()
+
+
+_api_bucket = None  # type: TokenBucket
+_api_limiter = None  # type: AIMDLimiter
+_api_breakers = {}  # type: Dict[str, CircuitBreaker]
+_api_latencies = {}  # type: Dict[str, LatencyTracker]
+_api_throttled = 0  # number of 429 responses
+_api_hedging = True
+_api_hedgeable = 0  # number of calls eligible for hedging
+_api_hedged = 0  # number of hedge requests sent
+_api_hedge_wins = 0  # number of hedge requests answering first
+_api_stragglers = []  # type: List[threading.Thread]
+_api_flow_lock = threading.Lock()
+
+
+# (Re)initialize flow control state from the API_* settings above.
+def reset_api_flow_control() -> None:
+    global _api_bucket, _api_limiter, _api_breakers, _api_latencies
+    global _api_throttled, _api_hedgeable, _api_hedged, _api_hedge_wins
+    with _api_flow_lock:
+        _api_bucket = TokenBucket(API_RATE_LIMIT, API_RATE_BURST)
+        _api_limiter = AIMDLimiter(
+            API_WINDOW_INITIAL,
+            minimum=API_WINDOW_MIN,
+            maximum=API_WINDOW_MAX,
+            latency_threshold=API_LATENCY_THRESHOLD,
+        )
+        _api_breakers = {}
+        _api_latencies = {}
+        _api_throttled = 0
+        _api_hedgeable = 0
+        _api_hedged = 0
+        _api_hedge_wins = 0
+
+
+reset_api_flow_control()
+
+
+def set_api_hedging(enabled: bool) -> None:
+    global _api_hedging
+    _api_hedging = enabled
+
+
+def _api_breaker(endpoint: str) -> CircuitBreaker:
+    with _api_flow_lock:
+        breaker = _api_breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(API_CIRCUIT_THRESHOLD, API_CIRCUIT_COOLDOWN)
+            _api_breakers[endpoint] = breaker
+        return breaker
+
+
+def _api_latency(endpoint: str) -> LatencyTracker:
+    with _api_flow_lock:
+        tracker = _api_latencies.get(endpoint)
+        if tracker is None:
+            tracker = LatencyTracker(API_LATENCY_SAMPLES)
+            _api_latencies[endpoint] = tracker
+        return tracker
+
+
+# Snapshot of flow control state: current AIMD window and requests in
+# flight, number of window decreases, 429 responses, requests delayed
+# by the rate limiter, requests rejected by open circuits (along with
+# the list of endpoints whose circuits are not closed), hedge requests
+# sent and won (out of hedgeable calls), and the latency percentile used
+# as the hedging delay of each endpoint.
+def get_api_stats() -> Dict[str, Any]:
+    with _api_flow_lock:
+        breakers = dict(_api_breakers)
+        latencies = dict(_api_latencies)
+        throttled = _api_throttled
+        hedgeable = _api_hedgeable
+        hedged = _api_hedged
+        hedge_wins = _api_hedge_wins
+    return {
+        "window": _api_limiter.window,
+        "in_flight": _api_limiter.in_flight,
+        "window_decreases": _api_limiter.decreases,
+        "throttled": throttled,
+        "rate_limited": _api_bucket.waits,
+        "circuit_rejections": sum(b.rejections for b in breakers.values()),
+        "open_circuits": sorted(e for e, b in breakers.items() if b.state != "closed"),
+        "hedgeable": hedgeable,
+        "hedged": hedged,
+        "hedge_wins": hedge_wins,
+        "latency_percentile": {
+            e: t.percentile(API_HEDGE_PERCENTILE) for e, t in latencies.items()
+        },
+    }
+
+
+# If hedge is True, the call is idempotent and may be hedged (see
+# API_HEDGE_* above).
+def call_api(endpoint, payload, *, hedge=False):
+    global _api_throttled, _api_hedgeable
+    session = get_session()
+    breaker = _api_breaker(endpoint)
+    attempt = 0
+    while True:
         try:
-            return requests.post(
-                endpoint, headers=API_HEADERS, json=payload, timeout=5 + 2 * attempt
-            )
-        except requests.Timeout:
-            if attempt == 2:
-                raise
+            breaker.before_request()
+        except CircuitOpenError as e:
+            raise APICircuitOpen("%s: %s" % (endpoint, e))
+        # Waiting for the rate limiter counts towards the deadline.
+        deadline = _api_deadline
+        try:
+            _api_bucket.acquire(deadline)
+            start = _api_limiter.acquire(deadline)
+        except RateLimitTimeout:
+            breaker.record(True)  # Release a possible half-open trial.
+            raise APIDeadlineExceeded("API deadline exceeded")
+
+        # Gradually increase timeout (5, 7, 9 seconds), capped by the
+        # time remaining before the deadline.
+        timeout = 5 + 2 * min(attempt, 2)
+        remaining = _api_time_remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                _api_limiter.release(start, None)
+                breaker.record(True)
+                raise APIDeadlineExceeded("API deadline exceeded")
+            timeout = min(timeout, remaining)
+
+        retry_after = 0.0
+        server_ok = True
+        try:
+            hedge_delay = None
+            if hedge and _api_hedging:
+                with _api_flow_lock:
+                    _api_hedgeable += 1
+                tracker = _api_latency(endpoint)
+                if len(tracker) >= API_HEDGE_MIN_SAMPLES:
+                    hedge_delay = max(
+                        tracker.percentile(API_HEDGE_PERCENTILE), API_HEDGE_MIN_DELAY
+                    )
+            if hedge_delay is not None:
+                r = _post_hedged(session, endpoint, payload, timeout, start, hedge_delay)
+            else:
+                r = _post(session, endpoint, payload, timeout, start)
+            server_ok = r.status_code < 500
+            if r.status_code not in API_RETRY_STATUSES:
+                return r
+            if r.status_code == 429:
+                with _api_flow_lock:
+                    _api_throttled += 1
+                try:
+                    retry_after = float(r.headers.get("Retry-After") or 0)
+                except ValueError:
+                    pass
+            exc = requests.HTTPError(
+                "%d %s" % (r.status_code, r.reason), response=r
+            )  # type: Exception
+        except (requests.Timeout, requests.ConnectionError) as e:
+            server_ok = False
+            exc = e
+        finally:
+            breaker.record(server_ok)
+
+        attempt += 1
+        if attempt >= API_MAX_ATTEMPTS:
+            raise exc
+        delay = random.uniform(0, min(API_BACKOFF_CAP, API_BACKOFF_BASE * 2 ** attempt))
+        delay = max(delay, min(retry_after, API_BACKOFF_CAP))
+        remaining = _api_time_remaining()
+        if remaining is not None and remaining <= delay:
+            raise exc
+        time.sleep(delay)
+
+
+# A single request, holding the AIMD slot acquired at `start`, which is
+# released with the congestion signal of the outcome. The latency of
+# every completed request is recorded.
+def _post(session, endpoint, payload, timeout, start):
+    congested = None  # type: Optional[bool]
+    try:
+        r = session.post(endpoint, headers=API_HEADERS, json=payload, timeout=timeout)
+        congested = r.status_code in API_RETRY_STATUSES
+        if not congested:
+            _api_latency(endpoint).add(time.monotonic() - start)
+        return r
+    except (requests.Timeout, requests.ConnectionError):
+        congested = True
+        raise
+    finally:
+        _api_limiter.release(start, congested)
+
+
+# Send the request in the background, plus a hedge request if there is
+# no response within `delay` seconds; the first response wins (errors
+# only win when both requests fail). The losing request is left to
+# finish in the background (it can't be cancelled; see
+# _join_api_stragglers), and its response is discarded.
+def _post_hedged(session, endpoint, payload, timeout, start, delay):
+    global _api_hedge_wins
+    results = queue.Queue()  # type: queue.Queue
+    threads = []
+
+    def send(start, is_hedge):
+        try:
+            r = _post(session, endpoint, payload, timeout, start)
+            results.put((is_hedge, r, None))
+        except Exception as exc:
+            results.put((is_hedge, None, exc))
+
+    def spawn(start, is_hedge):
+        thread = threading.Thread(target=send, args=(start, is_hedge), daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    spawn(start, False)
+    try:
+        is_hedge, r, exc = results.get(timeout=delay)
+    except queue.Empty:
+        hedge_start = _try_acquire_hedge()
+        if hedge_start is not None:
+            spawn(hedge_start, True)
+        is_hedge, r, exc = results.get()
+    pending = len(threads) - 1
+    while exc is not None and pending:
+        is_hedge, r, exc = results.get()
+        pending -= 1
+    if pending:
+        with _api_flow_lock:
+            _api_stragglers.extend(threads)
+    if exc is not None:
+        raise exc
+    if is_hedge:
+        with _api_flow_lock:
+            _api_hedge_wins += 1
+    return r
+
+
+# Waits for losing hedged requests still in flight, so that none outlives
+# the batch of calls that sent it.
+def _join_api_stragglers() -> None:
+    with _api_flow_lock:
+        stragglers = _api_stragglers[:]
+        del _api_stragglers[:]
+    for thread in stragglers:
+        thread.join()
+
+
+# Returns the start time of the hedge request (see AIMDLimiter.acquire),
+# or None if the hedge is not allowed.
+def _try_acquire_hedge() -> Optional[float]:
+    global _api_hedged
+    with _api_flow_lock:
+        if _api_hedged + 1 > API_HEDGE_MAX_RATIO * _api_hedgeable:
+            return None
+        if not _api_bucket.try_acquire():
+            return None
+        start = _api_limiter.try_acquire()
+        if start is None:
+            return None
+        _api_hedged += 1
+        return start
 
 
 def _resolve_resource_url(url: str) -> str:
@@ -110,6 +576,12 @@ def _resolve_resource_url(url: str) -> str:
 # - vod_url: str, to be populated by resolve_member_vods;
 # - danmaku_url: str, to be populated by resolve_member_vods.
 # VODs are generated in reverse chronological order.
+#
+# Without any of member_id, team_id and group_id, i.e., when listing
+# VODs of all groups, the single global cursor (which interleaves all
+# groups and has to be walked serially) is avoided if fan_out is True:
+# each group in FAN_OUT_GROUP_IDS is listed concurrently instead, and
+# the results are merged.
 def list_member_vods(
     from_: Datetime,
     to_: Datetime,
@@ -117,29 +589,50 @@ def list_member_vods(
     member_id: int = 0,
     team_id: int = 0,
     group_id: int = 0,
+    use_index: bool = False,
+    fan_out: bool = True,
 ) -> Generator[VOD, None, None]:
-    from_ = arrow.get(from_).to("Asia/Shanghai")
-    to_ = arrow.get(to_).to("Asia/Shanghai")
-    next_id = 0
-    earliest_start_time = to_
+    if fan_out and not (member_id or team_id or group_id):
+        yield from _merge_group_listings(
+            lambda group_id: list_member_vods(
+                from_, to_, group_id=group_id, use_index=use_index
+            )
+        )
+        return
+
+    from_ms = _timestamp_ms(from_)
+    to_ms = _timestamp_ms(to_)
+    # If use_index is True, every page is recorded in the local member
+    # VOD index, and paging stops as soon as the rest of the date range
+    # is known to be fully indexed (see persistence.py), in which case
+    # the rest is served from the index.
+    scope = "%d:%d:%d" % (member_id, team_id, group_id)
+    settled_ms = int((time.time() - MEMBER_VOD_INDEX_SETTLE_TIME) * 1000)
+    # Paging starts from the nearest cursor checkpoint at or after to_,
+    # if any, instead of from the top (see _seek_checkpoint).
+    next_id, seek_ms = _seek_checkpoint("member", scope, to_ms)
+    validate_seek = seek_ms is not None
+    # Start times are compared as integer timestamps in milliseconds;
+    # only VODs actually yielded are converted to arrow.Arrow.
+    horizon_ms = to_ms
+    earliest_ms = None
+    seen_ids = set()
     with ProgressReporter() as reporter:
-        while earliest_start_time > from_:
+        while horizon_ms > from_ms:
             reporter.report(
                 "Searching for VODs before %s"
-                % earliest_start_time.strftime("%Y-%m-%d %H:%M:%S")
+                % _arrow_from_ms(horizon_ms).strftime("%Y-%m-%d %H:%M:%S")
             )
 
+            payload = {
+                "type": 0,
+                "memberId": member_id,
+                "teamId": team_id,
+                "groupId": group_id,
+                "next": next_id,
+            }
             try:
-                r = call_api(
-                    MEMBER_VOD_LIST_URL,
-                    {
-                        "type": 0,
-                        "memberId": member_id,
-                        "teamId": team_id,
-                        "groupId": group_id,
-                        "next": next_id,
-                    },
-                )
+                r = call_api(MEMBER_VOD_LIST_URL, payload)
                 content = r.json()["content"]
                 vod_objs = content["liveList"]
                 next_id = content["next"]
@@ -147,51 +640,280 @@ def list_member_vods(
                 reporter.finalize()
                 raise APIException(MEMBER_VOD_LIST_URL, payload, exc)
 
+            if validate_seek:
+                validate_seek = False
+                if not _checkpoint_valid(vod_objs, "ctime", seek_ms):
+                    persistence.remove_list_checkpoint("member", scope, payload["next"])
+                    next_id, seek_ms = 0, None
+                    continue
+
             if not vod_objs:
+                # Reached the very beginning.
+                earliest_ms = 0
                 break
 
+            if use_index:
+                persistence.insert_member_vods(scope, vod_objs)
+            directory = []
+            vods = []
+            page_earliest_ms = None
             for vod_obj in vod_objs:
-                v = attrdict.AttrDict(vod_obj)
-                start_time = arrow.get(int(v.ctime) / 1000).to("Asia/Shanghai")
-                earliest_start_time = min(earliest_start_time, start_time)
-                if not from_ <= start_time < to_:
+                user_info = vod_obj["userInfo"]
+                name = _parse_member_name(user_info["nickname"])
+                if name:
+                    directory.append((name, int(user_info["userId"])))
+                start_ms = int(vod_obj["ctime"])
+                if page_earliest_ms is None or start_ms < page_earliest_ms:
+                    page_earliest_ms = start_ms
+                if not from_ms <= start_ms < to_ms or not name:
                     continue
-
-                m = re.match(r"^(?P<group>\w+)-(?P<member>\w+)$", v.userInfo.nickname)
-                if not m:
+                live_id = vod_obj["liveId"]
+                if live_id in seen_ids:
                     continue
-                name = m.group("member")
-                yield attrdict.AttrDict(
-                    {
-                        "id": v.liveId,
-                        "member_id": int(v.userInfo.userId),
-                        "type": "直播" if v.liveType == 1 else "电台",
-                        "name": name,
-                        "title": v.title,
-                        "start_time": start_time,
-                        "vod_url": None,
-                        "danmaku_url": None,
-                    }
-                )
+                seen_ids.add(live_id)
+                vods.append(_member_vod_from_obj(vod_obj, name, start_ms))
+            if earliest_ms is None or page_earliest_ms < earliest_ms:
+                earliest_ms = page_earliest_ms
+            horizon_ms = min(horizon_ms, earliest_ms)
+            persistence.update_member_directory(directory)
+            persistence.add_list_checkpoint("member", scope, next_id, page_earliest_ms)
+            yield from vods
+
+            if use_index:
+                coverage = persistence.get_member_vod_coverage(scope, earliest_ms)
+                if coverage and coverage[0] <= from_ms:
+                    # Everything between from_ and where we are now has
+                    # been seen before.
+                    for vod_obj in persistence.query_member_vods(
+                        scope, from_ms, earliest_ms
+                    ):
+                        live_id = vod_obj["liveId"]
+                        start_ms = int(vod_obj["ctime"])
+                        if not start_ms < to_ms or live_id in seen_ids:
+                            continue
+                        name = _parse_member_name(vod_obj["userInfo"]["nickname"])
+                        if not name:
+                            continue
+                        seen_ids.add(live_id)
+                        yield _member_vod_from_obj(vod_obj, name, start_ms)
+                    persistence.add_member_vod_coverage(
+                        scope, coverage[0], _covered_upper(settled_ms, seek_ms)
+                    )
+                    return
+
+            if next_id == payload["next"]:
+                # No progress; don't loop forever on a misbehaving cursor.
+                break
+
+    if use_index and earliest_ms is not None:
+        # VODs starting exactly at earliest_ms may continue on the next
+        # page, hence the + 1.
+        persistence.add_member_vod_coverage(
+            scope,
+            earliest_ms + 1 if earliest_ms else 0,
+            _covered_upper(settled_ms, seek_ms),
+        )
+
+
+# Returns the (cursor, earliest start time) checkpoint to start paging
+# from in order to list VODs starting before to_ms, i.e., the checkpoint
+# with the smallest earliest start time no less than to_ms (see
+# persistence.add_list_checkpoint), or (0, None) to page from the top.
+# This way, listing a date range in the distant past takes a number of
+# pages proportional to the length of the range, rather than to its
+# distance from the present.
+def _seek_checkpoint(kind: str, scope: str, to_ms: int) -> Tuple[Any, Optional[int]]:
+    checkpoint = persistence.find_list_checkpoint(kind, scope, to_ms)
+    return checkpoint if checkpoint else (0, None)
+
+
+# A checkpoint is stale (e.g., the cursor is no longer recognized) if the
+# first page fetched from it is empty or has VODs starting after the
+# checkpoint's earliest start time. An empty page could also mean the
+# end of the list, but it is safer to start over from the top.
+def _checkpoint_valid(vod_objs: List[Dict[str, Any]], time_key: str, seek_ms: int) -> bool:
+    return bool(vod_objs) and all(int(v[time_key]) <= seek_ms for v in vod_objs)
+
+
+# Upper bound of the index coverage of a listing: VODs after seek_ms
+# (the earliest start time of the checkpoint paging started from) were
+# skipped, and VODs starting exactly at seek_ms may have been on the
+# page before the checkpoint.
+def _covered_upper(settled_ms: int, seek_ms: Optional[int]) -> int:
+    return settled_ms if seek_ms is None else min(settled_ms, seek_ms - 1)
+
+
+# Merge listings of FAN_OUT_GROUP_IDS, each generated by list_group(group_id)
+# concurrently, into a single reverse chronological listing without
+# duplicates.
+def _merge_group_listings(
+    list_group: Callable[[int], Iterable[VOD]]
+) -> Generator[VOD, None, None]:
+    seen_ids = set()
+    for vod in merge_concurrently(
+        [list_group(group_id) for group_id in FAN_OUT_GROUP_IDS],
+        key=lambda vod: vod.start_time,
+        reverse=True,
+    ):
+        if vod.id not in seen_ids:
+            seen_ids.add(vod.id)
+            yield vod
+
+
+# Timestamp in milliseconds of a datetime-like object, rounded up, so
+# that t >= dt and t < dt are equivalent to t >= _timestamp_ms(dt) and
+# t < _timestamp_ms(dt) for integer timestamps t.
+def _timestamp_ms(dt: Datetime) -> int:
+    dt = arrow.get(dt)
+    return dt.int_timestamp * 1000 + (dt.microsecond + 999) // 1000
+
+
+def _arrow_from_ms(ms: int) -> arrow.Arrow:
+    return arrow.Arrow.fromtimestamp(ms / 1000, tzinfo=SHANGHAI_TZ)
+
+
+# Nicknames of members are in the form GROUP-NAME, e.g., SNH48-莫寒.
+# Returns None if the nickname is not a member's.
+def _parse_member_name(nickname: str) -> Optional[str]:
+    m = MEMBER_NICKNAME_PATTERN.match(nickname)
+    return m.group("member") if m else None
+
+
+def _member_vod_from_obj(
+    vod_obj: Dict[str, Any], name: str, start_ms: int
+) -> MemberVOD:
+    return MemberVOD(
+        vod_obj["liveId"],
+        int(vod_obj["userInfo"]["userId"]),
+        "直播" if int(vod_obj["liveType"]) == 1 else "电台",
+        name,
+        vod_obj["title"],
+        _arrow_from_ms(start_ms),
+    )
+
+
+# Generator function for VOD objects of the specified members, in the
+# same format as list_member_vods. Each member is listed separately
+# (server-side filtered by memberId), all of them concurrently (see
+# pipeline.merge_concurrently; concurrent API calls are still subject to
+# the shared flow control above), and the results are merged in reverse
+# chronological order as pages arrive, so that the first VODs are
+# yielded as soon as the first page of each member is in.
+def list_vods_of_members(
+    from_: Datetime, to_: Datetime, member_ids: List[int], *, use_index: bool = False
+) -> Generator[VOD, None, None]:
+    yield from merge_concurrently(
+        [
+            list_member_vods(from_, to_, member_id=member_id, use_index=use_index)
+            for member_id in member_ids
+        ],
+        key=lambda vod: vod.start_time,
+        reverse=True,
+    )
 
 
 # Populate vod_url and danmaku_url attributes to each VOD object, given
-# a list of performance VOD objects.
-def resolve_member_vods(vods: List[VOD]) -> None:
-    with ProgressReporter() as reporter:
-        for vod in vods:
-            reporter.report()
+# a list of member VOD objects.
+#
+# VODs are resolved concurrently by up to `workers` threads. A VOD that
+# fails to resolve does not abort the batch; instead, the list of
+# (vod, exception) pairs of failed VODs (in the original order) is
+# returned, and vod_url of failed VODs is left as None.
+#
+# If use_cache is True, URLs are looked up in the persistent resolved
+# URL cache first (ignoring entries older than cache_ttl seconds, if
+# specified), and only cache misses are resolved through the API;
+# newly resolved URLs are then added to the cache.
+def resolve_member_vods(
+    vods: List[VOD],
+    *,
+    workers: int = DEFAULT_RESOLVE_WORKERS,
+    use_cache: bool = False,
+    cache_ttl: Optional[float] = None,
+) -> List[Tuple[VOD, APIException]]:
+    return _resolve_vods(
+        vods,
+        _resolve_member_vod,
+        workers=workers,
+        cache_kind="member" if use_cache else None,
+        cache_ttl=cache_ttl,
+    )
 
-            try:
-                r = call_api(MEMBER_VOD_RESOLVE_URL, {"liveId": vod.id})
-                content = r.json()["content"]
-            except Exception as exc:
-                reporter.finalize()
-                raise APIException(PERF_VOD_RESOLVE_URL, payload, exc)
 
-            vod.vod_url = _resolve_resource_url(content["playStreamPath"])
-            if "msgFilePath" in content:
-                vod.danmaku_url = _resolve_resource_url(content["msgFilePath"])
+def _resolve_member_vod(vod: VOD) -> None:
+    payload = {"liveId": vod.id}
+    try:
+        r = call_api(MEMBER_VOD_RESOLVE_URL, payload, hedge=True)
+        content = r.json()["content"]
+        vod_url = _resolve_resource_url(content["playStreamPath"])
+    except Exception as exc:
+        raise APIException(MEMBER_VOD_RESOLVE_URL, payload, exc)
+
+    vod.vod_url = vod_url
+    if "msgFilePath" in content:
+        vod.danmaku_url = _resolve_resource_url(content["msgFilePath"])
+
+
+# Run resolve_one on each VOD with a bounded thread pool. Results are
+# consumed in order, so progress is reported as the batch advances and
+# errors are collected in the same order as the input.
+#
+# cache_kind, if not None, is the kind of VODs in the resolved URL cache
+# (see persistence.py), and enables the cache.
+def _resolve_vods(
+    vods: List[VOD],
+    resolve_one: Callable[[VOD], None],
+    *,
+    workers: int,
+    cache_kind: Optional[str] = None,
+    cache_ttl: Optional[float] = None,
+) -> List[Tuple[VOD, APIException]]:
+    def resolve(vod: VOD) -> Optional[APIException]:
+        try:
+            resolve_one(vod)
+            return None
+        except APIException as exc:
+            return exc
+
+    errors = []
+    if cache_kind:
+        cached = persistence.get_resolved_urls(
+            cache_kind, (vod.id for vod in vods), ttl=cache_ttl
+        )
+        for vod in vods:
+            if vod.id in cached:
+                vod.vod_url, danmaku_url = cached[vod.id]
+                if danmaku_url:
+                    vod.danmaku_url = danmaku_url
+        vods = [vod for vod in vods if vod.id not in cached]
+    if not vods:
+        return errors
+    # Don't bother with a thread pool for a single worker (or VOD).
+    processes = max(min(workers, len(vods)), 1)
+    pool = multiprocessing.pool.ThreadPool(processes) if processes > 1 else None
+    resolved = []
+    try:
+        results = pool.imap(resolve, vods) if pool else map(resolve, vods)
+        with ProgressReporter() as reporter:
+            for vod, exc in zip(vods, results):
+                reporter.report()
+                if exc is not None:
+                    errors.append((vod, exc))
+                else:
+                    resolved.append(vod)
+    finally:
+        if pool:
+            pool.terminate()
+        _join_api_stragglers()
+    if cache_kind:
+        persistence.insert_resolved_urls(
+            cache_kind,
+            (
+                (vod.id, vod.vod_url, getattr(vod, "danmaku_url", None))
+                for vod in resolved
+            ),
+        )
+    return errors
 
 
 # Generator function for performance VOD objects, each containing the
@@ -201,26 +923,35 @@ def resolve_member_vods(vods: List[VOD]) -> None:
 #
 # "name" is the title of the stage (None if cannot be determined), e.g.,
 # "美丽48区".
+#
+# As with list_member_vods, group_id 0 is fanned out to concurrent
+# listings of FAN_OUT_GROUP_IDS, unless fan_out is False.
 def list_perf_vods(
-    from_: Datetime, to_: Datetime, *, group_id: int = 0
+    from_: Datetime, to_: Datetime, *, group_id: int = 0, fan_out: bool = True
 ) -> Generator[VOD, None, None]:
-    from_ = arrow.get(from_).to("Asia/Shanghai")
-    to_ = arrow.get(to_).to("Asia/Shanghai")
-    next_id = 0
-    earliest_start_time = to_
+    if fan_out and not group_id:
+        yield from _merge_group_listings(
+            lambda group_id: list_perf_vods(from_, to_, group_id=group_id)
+        )
+        return
+
+    from_ms = _timestamp_ms(from_)
+    to_ms = _timestamp_ms(to_)
+    scope = str(group_id)
+    next_id, seek_ms = _seek_checkpoint("perf", scope, to_ms)
+    validate_seek = seek_ms is not None
+    horizon_ms = to_ms
     seen_ids = set()  # used for deduplication, because the API is crap
     with ProgressReporter() as reporter:
-        while earliest_start_time > from_:
+        while horizon_ms > from_ms:
             reporter.report(
                 "Searching for VODs before %s"
-                % earliest_start_time.strftime("%Y-%m-%d %H:%M:%S")
+                % _arrow_from_ms(horizon_ms).strftime("%Y-%m-%d %H:%M:%S")
             )
 
+            payload = {"groupId": group_id, "next": next_id, "record": True}
             try:
-                r = call_api(
-                    PERF_VOD_LIST_URL,
-                    {"groupId": group_id, "next": next_id, "record": True},
-                )
+                r = call_api(PERF_VOD_LIST_URL, payload)
                 content = r.json()["content"]
                 vod_objs = content["liveList"]
                 next_id = content["next"]
@@ -228,48 +959,77 @@ def list_perf_vods(
                 reporter.finalize()
                 raise APIException(PERF_VOD_LIST_URL, payload, exc)
 
+            if validate_seek:
+                validate_seek = False
+                if not _checkpoint_valid(vod_objs, "stime", seek_ms):
+                    persistence.remove_list_checkpoint("perf", scope, payload["next"])
+                    next_id, seek_ms = 0, None
+                    continue
+
             if not vod_objs:
                 break
 
+            persistence.add_list_checkpoint(
+                "perf", scope, next_id, min(int(v["stime"]) for v in vod_objs)
+            )
+
             for vod_obj in vod_objs:
-                v = attrdict.AttrDict(vod_obj)
-                if v.liveId in seen_ids:
+                live_id = vod_obj["liveId"]
+                if live_id in seen_ids:
                     continue
-                start_time = arrow.get(int(v.stime) / 1000).to("Asia/Shanghai")
-                earliest_start_time = min(earliest_start_time, start_time)
-                if not from_ <= start_time < to_:
+                start_ms = int(vod_obj["stime"])
+                if start_ms < horizon_ms:
+                    horizon_ms = start_ms
+                if not from_ms <= start_ms < to_ms:
                     continue
 
-                m = re.search(r"《(?P<name>.*?)》", v.title)
+                title = vod_obj["title"]
+                m = PERF_TITLE_STAGE_PATTERN.search(title)
                 name = m.group("name") if m else None
                 # TODO: refine teams attribute.
-                yield attrdict.AttrDict(
-                    {
-                        "id": v.liveId,
-                        "teams": [t.teamName for t in v.teamList],
-                        "title": v.title.strip(),
-                        "name": name,
-                        "start_time": start_time,
-                    }
+                yield PerfVOD(
+                    live_id,
+                    [t["teamName"] for t in vod_obj["teamList"]],
+                    title.strip(),
+                    name,
+                    _arrow_from_ms(start_ms),
                 )
-                seen_ids.add(v.liveId)
+                seen_ids.add(live_id)
+
+            if next_id == payload["next"]:
+                # No progress; don't loop forever on a misbehaving cursor.
+                break
 
 
 # Add vod_url attribute to each VOD object, given a list of performance
-# VOD objects.
-def resolve_perf_vods(vods: List[VOD]) -> None:
-    with ProgressReporter() as reporter:
-        for vod in vods:
-            reporter.report()
+# VOD objects. Concurrency, caching and error handling are the same as
+# resolve_member_vods.
+def resolve_perf_vods(
+    vods: List[VOD],
+    *,
+    workers: int = DEFAULT_RESOLVE_WORKERS,
+    use_cache: bool = False,
+    cache_ttl: Optional[float] = None,
+) -> List[Tuple[VOD, APIException]]:
+    return _resolve_vods(
+        vods,
+        _resolve_perf_vod,
+        workers=workers,
+        cache_kind="perf" if use_cache else None,
+        cache_ttl=cache_ttl,
+    )
 
-            try:
-                r = call_api(PERF_VOD_RESOLVE_URL, {"liveId": vod.id})
-                content = r.json()["content"]
-            except Exception as exc:
-                reporter.finalize()
-                raise APIException(PERF_VOD_RESOLVE_URL, payload, exc)
 
-            streams = {s["streamName"]: s["streamPath"] for s in content["playStreams"]}
-            vod.vod_url = _resolve_resource_url(
-                streams.get("超清") or streams.get("高清") or streams.get("标清")
-            )
+def _resolve_perf_vod(vod: VOD) -> None:
+    payload = {"liveId": vod.id}
+    try:
+        r = call_api(PERF_VOD_RESOLVE_URL, payload, hedge=True)
+        content = r.json()["content"]
+        streams = {s["streamName"]: s["streamPath"] for s in content["playStreams"]}
+        vod_url = _resolve_resource_url(
+            streams.get("超清") or streams.get("高清") or streams.get("标清")
+        )
+    except Exception as exc:
+        raise APIException(PERF_VOD_RESOLVE_URL, payload, exc)
+
+    vod.vod_url = vod_url
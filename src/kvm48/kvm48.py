@@ -1,31 +1,52 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import os
+import random
 import re
+import shutil
+import signal
+import subprocess
 import sys
 import tempfile
 import textwrap
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import arrow
+import requests
 
 from . import (
     aria2,
+    bandwidth,
     caterpillar,
     config,
     edit,
+    hls,
+    httpdl,
+    jobs,
     koudai,
     lock,
     peek,
     persistence,
+    planning,
+    scheduling,
+    supervisor,
     update,
     utils,
 )
 from .config import DEFAULT_CONFIG_FILE, ConfigError
+from .pipeline import Pipeline
 from .version import __version__
 
 
+DEFAULT_BACKFILL_WINDOW = 7
+# Watch mode poll intervals are randomized by up to this fraction either
+# way, so that watchers started together don't poll in lockstep.
+WATCH_INTERVAL_JITTER = 0.1
+
+
 HELP = (
     """\
 KVM48, the Koudai48 VOD Manager.
@@ -67,9 +88,25 @@ YYYY-MM-DD or MM-DD format.
 - If neither --from nor --to is specified, use today (in UTC+08:00) as
   the to date, and determine span in the same way as above.
 
-KVM48 uses aria2 for direct downloads. Certain aria2c options, e.g.,
---max-connection-per-server=16, are enforced within kvm48; most options
-should be configured directly in the aria2 config file.
+For archiving long date ranges, `kvm48 backfill' processes the date
+range in windows of --window days (7 by default), oldest first: each
+window is searched, resolved and downloaded before the next one. Once a
+window is fully downloaded it is recorded as done, so if the backfill is
+interrupted or some downloads fail, rerunning the same command resumes
+at the first incomplete window.
+
+`kvm48 watch' keeps running instead, polling for new VODs of monitored
+members every `watch_interval' seconds and downloading them right away.
+The first poll covers the date range as usual; later polls only cover
+recent VODs. The config file is reloaded when changed. Send SIGTERM to
+stop watching once the current poll is finished.
+
+KVM48 uses aria2 for direct downloads. The number of connections and
+pieces per download (aria2c's --split, --min-split-size and
+--max-connection-per-server) is computed by kvm48 for each file from its
+size, within the aria2_max_connections cap of the config file, and a few
+other aria2c options are enforced as well; most options should be
+configured directly in the aria2 config file.
 
 KVM48 optionally uses caterpillar[1] as the M3U8/HLS downloader.
 caterpillar is built on top of FFmpeg, the Swiss army knife of
@@ -81,6 +118,11 @@ caterpillar is either not found or does not meet the minimum version
 requirement, the URLs and supposed paths are written to disk for
 postprocessing at the user's discretion.
 
+Alternatively, KVM48 comes with builtin downloaders for direct and
+M3U8/HLS downloads, which can be used in place of aria2 and caterpillar
+respectively through the direct_downloader and m3u8_downloader config
+options.
+
 [1] https://github.com/zmwangx/caterpillar
 """
     % DEFAULT_CONFIG_FILE
@@ -152,6 +194,974 @@ def dump_environment():
     sys.stderr.write("\n")
 
 
+# Report VODs that failed to resolve, and return the list of VODs that
+# were successfully resolved.
+def drop_unresolved_vods(vods, errors):
+    if not errors:
+        return vods
+    sys.stderr.write("\n[ERROR] failed to resolve the following VODs:\n\n")
+    for vod, exc in errors:
+        sys.stderr.write("\t%s\t%s\n" % (vod.id, exc))
+    sys.stderr.write("\n")
+    failed_ids = set(vod.id for vod, _ in errors)
+    return [vod for vod in vods if vod.id not in failed_ids]
+
+
+# Report notable flow control events of API calls (throttling, hedging
+# and unavailable endpoints), if any.
+def report_api_stats():
+    stats = koudai.get_api_stats()
+    if stats["throttled"]:
+        sys.stderr.write(
+            "[WARNING] API throttled %d requests; concurrency reduced to %d\n"
+            % (stats["throttled"], stats["window"])
+        )
+    if stats["hedged"]:
+        sys.stderr.write(
+            "Hedged %d of %d VOD URL requests (%d answered first by the hedge)\n"
+            % (stats["hedged"], stats["hedgeable"], stats["hedge_wins"])
+        )
+    if stats["circuit_rejections"]:
+        sys.stderr.write(
+            "[WARNING] %d API calls rejected, unavailable endpoints: %s\n"
+            % (stats["circuit_rejections"], ", ".join(stats["open_circuits"]) or "none")
+        )
+
+
+# Std mode listing, resolution and size peeking, run as a streaming
+# pipeline so that resolving and peeking the newest VODs overlaps with
+# paging for older ones.
+#
+# VODs whose targets may already exist are set aside and only resolved
+# (if at all) once listing is complete, when their exact target paths
+# can be determined (see planning.may_be_finished and
+# planning.find_finished_vods). Exact target paths are determined
+# without VODs that failed to resolve, just as they are planned for
+# download once those are dropped; since dropping a VOD may renumber
+# deduplicated filenames of others, the finished set is recomputed
+# whenever resolving set-aside VODs fails.
+#
+# Returns a tuple (vod_list, source_exts, finished_ids, resolve_errors,
+# peeked_sizes), where vod_list is in chronological order, source_exts
+# and finished_ids are as in the planning module, resolve_errors is in
+# the format returned by koudai.resolve_member_vods, and peeked_sizes
+# maps peeked URLs to their sizes (None if unknown). reserved_filepaths
+# is as in planning.plan_filepaths.
+def collect_member_vods(conf, vods, *, refresh_urls=False, reserved_filepaths=None):
+    all_vods = []
+    deferred_vods = []
+    source_exts = {}
+    resolve_errors = []
+    peeked_sizes = {}
+
+    def triage(vod):
+        all_vods.append(vod)
+        if refresh_urls:
+            persistence.invalidate_resolved_urls("member", [vod.id])
+        source_exts.update(
+            planning.predict_source_extensions([vod], cache_ttl=conf.resolve_cache_ttl)
+        )
+        if planning.may_be_finished(conf, vod, source_exts.get(vod.id)):
+            deferred_vods.append(vod)
+            return []
+        return [vod]
+
+    def resolve(vod):
+        if not vod.vod_url:
+            errors = koudai.resolve_member_vods(
+                [vod], workers=1, use_cache=True, cache_ttl=conf.resolve_cache_ttl
+            )
+            if errors:
+                resolve_errors.extend(errors)
+                return []
+        return [vod]
+
+    def peek_size(vod):
+        if utils.extension_from_url(vod.vod_url, dot=True) != ".m3u8":
+            peeked_sizes[vod.vod_url] = peek.peek_content_length(vod.vod_url)
+        return [vod]
+
+    sys.stderr.write("Searching for and resolving VODs...\n")
+    pipeline = (
+        Pipeline(vods)
+        .add_stage(triage)
+        .add_stage(resolve, workers=conf.resolve_workers)
+        .add_stage(peek_size, workers=peek.DEFAULT_WORKERS)
+    )
+    with koudai.ProgressReporter() as reporter:
+        for _ in pipeline:
+            reporter.report()
+
+    vod_list = list(reversed(all_vods))
+    while True:
+        failed_ids = set(vod.id for vod, _ in resolve_errors)
+        finished_ids = planning.find_finished_vods(
+            conf,
+            [vod for vod in vod_list if vod.id not in failed_ids],
+            source_exts,
+            reserved_filepaths=reserved_filepaths,
+        )
+        pending_vods = [
+            vod
+            for vod in reversed(deferred_vods)
+            if not vod.vod_url
+            and vod.id not in finished_ids
+            and vod.id not in failed_ids
+        ]
+        if not pending_vods:
+            break
+        sys.stderr.write("Resolving %d more VOD URLs...\n" % len(pending_vods))
+        errors = koudai.resolve_member_vods(
+            pending_vods,
+            workers=conf.resolve_workers,
+            use_cache=True,
+            cache_ttl=conf.resolve_cache_ttl,
+        )
+        if not errors:
+            break
+        resolve_errors.extend(errors)
+    resolve_errors.sort(key=lambda error: error[0].start_time)
+    planning.record_source_extensions(vod_list)
+    return vod_list, source_exts, finished_ids, resolve_errors, peeked_sizes
+
+
+# Std mode search for VODs of monitored members in the date range from_
+# to to_ (both inclusive), skipping VODs with IDs in exclude_ids.
+# Returns a tuple (vod_list, source_exts, resolve_errors, peeked_sizes)
+# as returned by collect_member_vods, except that VODs that failed to
+# resolve are dropped from vod_list.
+def search_member_vods(
+    conf, from_, to_, *, refresh_urls=False, exclude_ids=(), reserved_filepaths=None
+):
+    # If user IDs of all monitored members are known, list each member
+    # separately; otherwise, scan the entire group (which also populates
+    # the member directory for the next run).
+    member_ids = persistence.get_member_ids(conf.names)
+    if len(member_ids) == len(set(conf.names)):
+        vods = koudai.list_vods_of_members(
+            from_, to_.shift(days=1), member_ids.values(), use_index=True
+        )
+    else:
+        vods = koudai.list_member_vods(
+            from_, to_.shift(days=1), group_id=conf.group_id, use_index=True
+        )
+    vod_list, source_exts, _, resolve_errors, peeked_sizes = collect_member_vods(
+        conf,
+        (vod for vod in vods if vod.name in conf.names and vod.id not in exclude_ids),
+        refresh_urls=refresh_urls,
+        reserved_filepaths=reserved_filepaths,
+    )
+    vod_list = drop_unresolved_vods(vod_list, resolve_errors)
+    return vod_list, source_exts, resolve_errors, peeked_sizes
+
+
+# Plans target paths of resolved VODs (in chronological order), prints
+# the URL and path of each target, reports download sizes, and (unless
+# dry) downloads unfinished targets with aria2 and caterpillar (or the
+# builtin downloaders, http and hls, depending on direct_downloader and
+# m3u8_downloader). If there are both direct and M3U8 downloads, the two
+# backends are run at the same time, with output lines prefixed by their
+# names, e.g. [aria2] and [caterpillar].
+#
+# Unfinished targets are handed to backends in the order of the
+# conf.download_order policy (see scheduling.schedule).
+#
+# Manifests are written to aria2.txt and m3u8.txt in the target
+# directory, or aria2-<tag>.txt and m3u8-<tag>.txt if manifest_tag is
+# specified; manifests of failed downloads are left in place.
+#
+# reserved_filepaths is as in planning.plan_filepaths.
+#
+# Returns a tuple (a2_failed, m3u8_failed, downloaded_files), where the
+# first two are lists of (url, filepath) targets that failed to download
+# (M3U8 targets also count as failed if caterpillar is unavailable), and
+# downloaded_files is a list of full paths of downloaded files.
+def download_vods(
+    conf,
+    vod_list,
+    *,
+    source_exts,
+    peeked_sizes,
+    dry=False,
+    manifest_tag=None,
+    reserved_filepaths=None,
+):
+    targets = []
+    a2_targets = []
+    m3u8_targets = []
+    # *_unfinished_targets store targets that aren't already downloaded.
+    a2_unfinished_targets = []
+    m3u8_unfinished_targets = []
+    vods = {}
+    for vod, src_ext, filepath in planning.plan_filepaths(
+        conf, vod_list, source_exts=source_exts, reserved_filepaths=reserved_filepaths
+    ):
+        url = vod.vod_url
+        fullpath = os.path.join(conf.directory, filepath)
+
+        entry = (url, filepath)
+        targets.append(entry)
+        vods[entry] = vod
+        if url is None:
+            # Already downloaded, and resolution was skipped.
+            continue
+        if src_ext == ".m3u8":
+            m3u8_targets.append(entry)
+            if not os.path.exists(fullpath):
+                m3u8_unfinished_targets.append(entry)
+        else:
+            a2_targets.append(entry)
+            if not os.path.exists(fullpath) or os.path.exists(fullpath + ".aria2"):
+                a2_unfinished_targets.append(entry)
+
+    new_urls = set(url for url, _ in a2_unfinished_targets + m3u8_unfinished_targets)
+    for url, filepath in targets:
+        if url in new_urls:
+            print("%s\t%s\t*" % (url, filepath))
+        else:
+            print("%s\t%s" % (url or "", filepath))
+
+    # Make subdirectories.
+    if not dry:
+        subdirs = set(
+            os.path.dirname(filepath)
+            for url, filepath in a2_unfinished_targets + m3u8_unfinished_targets
+        )
+        for subdir in subdirs:
+            os.makedirs(os.path.join(conf.directory, subdir), exist_ok=True)
+
+    # Report download sizes. Sizes are also used to tune aria2 options
+    # of each target (see aria2.split_options).
+    sizes = {
+        url: peeked_sizes[url]
+        for url, _ in a2_unfinished_targets
+        if url in peeked_sizes
+    }
+    sizes.update(
+        peek.peek_sizes(
+            url for url, _ in a2_unfinished_targets if url not in peeked_sizes
+        )
+    )
+    if a2_unfinished_targets:
+        total_size = sum(size for size in sizes.values() if size is not None)
+        unknown_files = sum(1 for size in sizes.values() if size is None)
+        msg = "{} direct downloads, total size: {:,} bytes".format(
+            len(a2_unfinished_targets), total_size
+        )
+        if unknown_files > 0:
+            msg += " (size of %d files could not be determined)" % unknown_files
+        msg += "\n"
+        sys.stderr.write(msg)
+    else:
+        sys.stderr.write("No new direct downloads.\n")
+
+    if m3u8_unfinished_targets:
+        sys.stderr.write(
+            "%d M3U8 VODs to download, total size unknown\n"
+            % len(m3u8_unfinished_targets)
+        )
+    else:
+        sys.stderr.write("No new M3U8 downloads.\n")
+
+    if dry:
+        return [], [], []
+
+    a2_unfinished_targets = scheduling.schedule(
+        a2_unfinished_targets, conf.download_order, vods=vods, sizes=sizes
+    )
+    m3u8_unfinished_targets = scheduling.schedule(
+        m3u8_unfinished_targets, conf.download_order, vods=vods
+    )
+
+    suffix = "-%s.txt" % manifest_tag if manifest_tag else ".txt"
+    a2_manifest = os.path.join(conf.directory, "aria2" + suffix)
+    m3u8_manifest = os.path.join(conf.directory, "m3u8" + suffix)
+    phases = {}
+    direct = "http" if conf.direct_downloader == "builtin" else "aria2"
+    m3u8 = "hls" if conf.m3u8_downloader == "builtin" else "caterpillar"
+    if a2_unfinished_targets:
+        if direct == "http":
+            phases[direct] = functools.partial(
+                builtin_phase,
+                conf,
+                a2_unfinished_targets,
+                a2_manifest,
+                download=httpdl.download,
+                write_manifest=aria2.write_manifest,
+            )
+        else:
+            phases[direct] = functools.partial(
+                aria2_phase, conf, a2_unfinished_targets, a2_manifest, sizes=sizes
+            )
+    if m3u8_unfinished_targets:
+        if m3u8 == "hls":
+            phases[m3u8] = functools.partial(
+                builtin_phase,
+                conf,
+                m3u8_unfinished_targets,
+                m3u8_manifest,
+                download=hls.download,
+                write_manifest=caterpillar.write_manifest,
+            )
+        else:
+            phases[m3u8] = functools.partial(
+                caterpillar_phase, conf, m3u8_unfinished_targets, m3u8_manifest
+            )
+    # Hand out shares of the bandwidth budget before any phase starts, so
+    # that the budget is split between phases from the start.
+    budget = bandwidth.Budget(conf.bandwidth)
+    for name in phases:
+        phases[name] = functools.partial(phases[name], share=budget.join())
+    if len(phases) > 1:
+        # Run the two backends side by side, with prefixed output.
+        results = supervisor.run_concurrently(
+            {
+                name: functools.partial(phase, log_prefix=name)
+                for name, phase in phases.items()
+            }
+        )
+    else:
+        results = {name: phase() for name, phase in phases.items()}
+
+    a2_failed, a2_downloaded = results.get(direct, ([], []))
+    m3u8_failed, m3u8_downloaded = results.get(m3u8, ([], []))
+    return a2_failed, m3u8_failed, a2_downloaded + m3u8_downloaded
+
+
+# Download phases of download_vods. Each downloads targets (a list of
+# (url, filepath) pairs) with its backend, and returns a tuple
+# (failed_targets, downloaded_files). Targets are retried one by one
+# with backoff (see jobs.RetryQueue), each round of a manifest based
+# backend running only the targets that are due; targets with permanent
+# errors (as classified from aria2 error codes and builtin downloader
+# errors) aren't retried. Messages are logged with log_prefix (see
+# supervisor.log); without one, aria2c and caterpillar run attached to
+# the terminal.
+#
+# Phases keep to the limit of share, their share of the bandwidth budget
+# (a bandwidth.Share, left once the phase is over), which follows the
+# schedule as it moves; without one, the phase has the whole budget to
+# itself.
+#
+# aria2_phase tunes aria2 options of each target by its size (sizes maps
+# URLs to sizes, see aria2.split_options). With a bandwidth limit
+# configured, aria2 is always driven through RPC (by a daemon of our own
+# if aria2_rpc is off), so that the limit can be changed on the fly.
+# Errors of each aria2c run are taken from its error log, written next
+# to the manifest (e.g. aria2.log) and removed once read.
+def aria2_phase(conf, targets, manifest, *, sizes=None, share=None, log_prefix=None):
+    def log(msg):
+        supervisor.log(msg, log_prefix)
+
+    def fullpath(job):
+        return os.path.join(conf.directory, job.target[1])
+
+    error_log = os.path.splitext(manifest)[0] + ".log"
+
+    def remove_error_log():
+        if os.path.exists(error_log):
+            os.unlink(error_log)
+
+    def run_round(batch):
+        written = aria2.write_manifest(
+            [job.target for job in batch],
+            manifest,
+            target_directory=conf.directory,
+            sizes=sizes,
+            max_connections=conf.aria2_max_connections,
+        )
+        errors = aria2.OutputErrors()
+        status = 0
+        if written:
+            remove_error_log()
+            status = aria2.download(manifest, log_prefix=log_prefix, log_file=error_log)
+            errors.read(error_log)
+            remove_error_log()
+        for job in batch:
+            url = job.target[0]
+            if aria2.is_finished(fullpath(job)):
+                queue.succeed(job)
+            elif url in errors.errors:
+                code, message = errors.errors[url]
+                queue.fail(
+                    job,
+                    "%s (error code %d)" % (message, code),
+                    permanent=aria2.is_permanent_error(code, message),
+                )
+            else:
+                queue.fail(job, "aria2 exited with status %d" % status)
+
+    queue = jobs.RetryQueue(targets)
+    share = share or bandwidth.Budget(conf.bandwidth).join()
+    limiter = share if conf.bandwidth.enabled else None
+    with share:
+        if conf.aria2_rpc or limiter:
+            if not conf.aria2_rpc:
+                log(
+                    "\n[WARNING] Running aria2 as an RPC daemon, which is "
+                    "required for a bandwidth limit (see bandwidth_limit)\n"
+                )
+            log("\nProcessing direct downloads with aria2 (RPC)...\n\n")
+            rpc = aria2.get_rpc_client(
+                conf.aria2_rpc if isinstance(conf.aria2_rpc, str) else None,
+                conf.aria2_rpc_secret,
+            )
+            aria2.download_with_rpc(
+                rpc,
+                queue,
+                target_directory=conf.directory,
+                sizes=sizes,
+                max_connections=conf.aria2_max_connections,
+                log=log,
+                limiter=limiter,
+            )
+        else:
+            log("\nProcessing direct downloads with aria2...\n\n")
+            jobs.run_rounds(queue, run_round, log=log)
+
+    log(
+        "\n%s; download order: %s\n"
+        % (jobs.format_completions(queue), conf.download_order)
+    )
+    failed = queue.failed()
+    targets = [job.target for job in failed]
+    if failed:
+        aria2.write_manifest(targets, manifest, target_directory=conf.directory)
+        log("\n[ERROR] aria2 failed to download the following VODs:\n\n")
+        log(jobs.format_failures(failed))
+        log(
+            "\naria2 batch input file have been written to '%s' "
+            "in case you want to retry manually.\n\n" % manifest
+        )
+    elif os.path.exists(manifest):
+        os.unlink(manifest)
+
+    downloaded_files = [
+        fullpath(job) for job in queue.jobs if aria2.is_finished(fullpath(job))
+    ]
+    return targets, downloaded_files
+
+
+# Downloads the target of a job of queue to path with a builtin
+# downloader (httpdl.download or hls.download), and reports the outcome
+# to queue.
+def builtin_download(queue, job, path, *, download, limiter, log):
+    if aria2.is_finished(path):
+        queue.succeed(job)
+        return
+    try:
+        download(job.target[0], path, log=log, limiter=limiter)
+    except (httpdl.DownloadError, requests.RequestException, OSError) as exc:
+        error = str(exc)
+        permanent = isinstance(
+            exc, hls.UnsupportedStreamError
+        ) or jobs.is_permanent_error(error)
+        queue.fail(job, error, permanent=permanent)
+        log("[ERROR] %s: %s\n" % (job.target[1], error))
+        return
+    # Leftover of an interrupted aria2 download of the same file.
+    if os.path.exists(path + ".aria2"):
+        os.unlink(path + ".aria2")
+    queue.succeed(job)
+
+
+# Phase of the builtin downloaders: httpdl for direct downloads, and
+# hls for M3U8 VODs (download is httpdl.download or hls.download).
+# Targets are downloaded one at a time, each over multiple connections.
+# Failed targets are written to a manifest for aria2 or caterpillar
+# (write_manifest), in case the user wants to retry with those; the
+# manifest (e.g. of an earlier run) is removed if none failed.
+def builtin_phase(
+    conf, targets, manifest, *, download, write_manifest, share=None, log_prefix=None
+):
+    def log(msg):
+        supervisor.log(msg, log_prefix)
+
+    def fullpath(job):
+        return os.path.join(conf.directory, job.target[1])
+
+    def run_round(batch):
+        for job in batch:
+            builtin_download(
+                queue, job, fullpath(job), download=download, limiter=limiter, log=log
+            )
+
+    queue = jobs.RetryQueue(targets)
+    share = share or bandwidth.Budget(conf.bandwidth).join()
+    limiter = share if conf.bandwidth.enabled else None
+    log("\nProcessing %d downloads with the builtin downloader...\n\n" % len(targets))
+    with share:
+        jobs.run_rounds(queue, run_round, log=log)
+
+    log(
+        "\n%s; download order: %s\n"
+        % (jobs.format_completions(queue), conf.download_order)
+    )
+    failed = queue.failed()
+    targets = [job.target for job in failed]
+    if failed:
+        write_manifest(targets, manifest, target_directory=conf.directory)
+        log("\n[ERROR] failed to download the following VODs:\n\n")
+        log(jobs.format_failures(failed))
+        log(
+            "\nBatch manifest has been written to '%s' "
+            "in case you want to retry manually.\n\n" % manifest
+        )
+    elif os.path.exists(manifest):
+        os.unlink(manifest)
+
+    downloaded_files = [
+        fullpath(job) for job in queue.jobs if aria2.is_finished(fullpath(job))
+    ]
+    return targets, downloaded_files
+
+
+# With conf.caterpillar_jobs > 1, each target of a round is downloaded
+# by its own caterpillar process, up to caterpillar_jobs at a time, with
+# its own manifest and log file in a work directory next to the manifest
+# (e.g. m3u8.d/0001.txt and m3u8.d/0001.log for the first target). The
+# work directory is removed once all targets are downloaded.
+#
+# caterpillar can't be throttled, so with a bandwidth limit configured,
+# targets are also downloaded one per caterpillar process, which is
+# terminated when a limit takes effect; each target that starts while a
+# limit is in effect is downloaded with the builtin HLS downloader
+# instead, within the share of the phase.
+def caterpillar_phase(conf, targets, manifest, *, share=None, log_prefix=None):
+    def log(msg):
+        supervisor.log(msg, log_prefix)
+
+    def fullpath(job):
+        return os.path.join(conf.directory, job.target[1])
+
+    # Errors scraped from caterpillar output may be misattributed, so
+    # they are only reported, and failed targets are always retried.
+    def settle(job, status, errors):
+        url = job.target[0]
+        if os.path.exists(fullpath(job)):
+            queue.succeed(job)
+        elif url in errors.errors:
+            queue.fail(job, errors.errors[url])
+        else:
+            queue.fail(job, "caterpillar exited with status %d" % status)
+
+    def run_round(batch):
+        written = caterpillar.write_manifest(
+            [job.target for job in batch], manifest, target_directory=conf.directory
+        )
+        errors = caterpillar.OutputErrors(written)
+        status = (
+            caterpillar.download(manifest, log_prefix=log_prefix, on_line=errors.feed)
+            if written
+            else 0
+        )
+        for job in batch:
+            settle(job, status, errors)
+
+    work_dir = os.path.splitext(manifest)[0] + ".d"
+
+    def run_job(job, timeout=None):
+        number = queue.jobs.index(job) + 1
+        base = os.path.join(work_dir, "%04d" % number)
+        errors = caterpillar.OutputErrors([job.target])
+        if not caterpillar.write_manifest(
+            [job.target], base + ".txt", target_directory=conf.directory
+        ):
+            return 0, errors
+        status = caterpillar.download(
+            base + ".txt",
+            log_prefix=log_prefix,
+            on_line=errors.feed,
+            log_file=base + ".log",
+            timeout=timeout,
+        )
+        if status == 0:
+            outcome = "done"
+        else:
+            outcome = "exited with status %d, see %s.log" % (status, base)
+        log("[%d/%d] %s: %s\n" % (number, len(queue.jobs), job.target[1], outcome))
+        return status, errors
+
+    def run_round_concurrently(batch):
+        os.makedirs(work_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=conf.caterpillar_jobs) as executor:
+            results = list(executor.map(run_job, batch))
+        for job, (status, errors) in zip(batch, results):
+            settle(job, status, errors)
+
+    # caterpillar can't be throttled, so it only runs while unlimited,
+    # and is terminated once a limit takes effect; the job is then put
+    # back (without counting the attempt) to be resumed within budget.
+    def run_job_within_budget(job):
+        limit = limiter.limit()
+        if limit is None:
+            timeout = limiter.budget.schedule.seconds_to_change()
+            try:
+                settle(job, *run_job(job, timeout=timeout))
+            except subprocess.TimeoutExpired:
+                log(
+                    "Bandwidth limit about to take effect; caterpillar "
+                    "interrupted while downloading %s\n" % job.target[1]
+                )
+                queue.release(job)
+            return
+        log(
+            "[WARNING] Bandwidth limit %s in effect; downloading %s with the "
+            "builtin HLS downloader instead of caterpillar (see "
+            "bandwidth_limit)\n" % (bandwidth.format_rate(limit), job.target[1])
+        )
+        builtin_download(
+            queue, job, fullpath(job), download=hls.download, limiter=limiter, log=log
+        )
+
+    def run_round_within_budget(batch):
+        os.makedirs(work_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=conf.caterpillar_jobs) as executor:
+            list(executor.map(run_job_within_budget, batch))
+
+    # Write the manifest first, so that it's there even if caterpillar
+    # is unavailable.
+    targets = caterpillar.write_manifest(
+        targets, manifest, target_directory=conf.directory
+    )
+    if not targets:
+        return [], []
+    if not caterpillar.check_caterpillar_requirement():
+        log(
+            "\n[ERROR] caterpillar requirement not met, cannot download M3U8 VODs.\n"
+            "caterpillar batch manifest has been written to '%s'.\n\n" % manifest
+        )
+        return targets, []
+
+    queue = jobs.RetryQueue(targets)
+    share = share or bandwidth.Budget(conf.bandwidth).join()
+    limiter = share if conf.bandwidth.enabled else None
+    with share:
+        if limiter:
+            log(
+                "\nProcessing M3U8 downloads with caterpillar while unlimited, "
+                "or the builtin HLS downloader while a bandwidth limit is in "
+                "effect...\n\n"
+            )
+            jobs.run_rounds(queue, run_round_within_budget, log=log)
+        elif conf.caterpillar_jobs > 1:
+            log(
+                "\nProcessing M3U8 downloads with %d concurrent caterpillar "
+                "jobs...\n\n" % conf.caterpillar_jobs
+            )
+            jobs.run_rounds(queue, run_round_concurrently, log=log)
+        else:
+            log("\nProcessing M3U8 downloads with caterpillar...\n\n")
+            jobs.run_rounds(queue, run_round, log=log)
+
+    log(
+        "\n%s; download order: %s\n"
+        % (jobs.format_completions(queue), conf.download_order)
+    )
+    failed = queue.failed()
+    targets = [job.target for job in failed]
+    if failed:
+        caterpillar.write_manifest(targets, manifest, target_directory=conf.directory)
+        log("\n[ERROR] caterpillar failed to download the following VODs:\n\n")
+        log(jobs.format_failures(failed))
+        log(
+            "\ncaterpillar batch manifest have been written to '%s' "
+            "in case you want to retry manually.\n\n" % manifest
+        )
+    else:
+        if os.path.exists(manifest):
+            os.unlink(manifest)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    downloaded_files = [
+        fullpath(job) for job in queue.jobs if os.path.exists(fullpath(job))
+    ]
+    return targets, downloaded_files
+
+
+# Splits the date range from_ to to_ (both inclusive) into consecutive
+# windows of `days` days each (the last one may be shorter). Returns a
+# list of (first_day, last_day) pairs in chronological order.
+def plan_backfill_windows(from_, to_, days):
+    windows = []
+    lower = from_
+    while lower <= to_:
+        upper = min(lower.shift(days=days - 1), to_)
+        windows.append((lower, upper))
+        lower = upper.shift(days=1)
+    return windows
+
+
+# Backfill progress is recorded per scope: windows completed for one set
+# of monitored members shouldn't be skipped for another.
+def backfill_scope(conf):
+    return "%s:%d:%s" % (conf.mode, conf.group_id, ",".join(sorted(set(conf.names))))
+
+
+# Backfill mode: std mode over a (long) date range, split into windows
+# of window_days days that are listed, resolved and downloaded one after
+# another in chronological order, so that memory use and manifest sizes
+# are bounded by the size of a window. The outcome of each window is
+# recorded in the backfill database (unless dry), and windows completed
+# in previous runs are skipped, so a rerun after a crash or interruption
+# resumes at the first incomplete window.
+#
+# Target paths of each window are recorded as well, and filenames are
+# deduplicated against those of all other windows (planned earlier in
+# this run, or completed in previous runs), as they would be if the
+# whole date range were downloaded at once.
+#
+# Returns the exit status.
+def backfill(conf, from_, to_, *, window_days, refresh_urls=False, dry=False):
+    windows = plan_backfill_windows(from_, to_, window_days)
+    scope = backfill_scope(conf)
+    recorded = persistence.get_backfill_windows(scope)
+    keys = [(str(lower.date()), str(upper.date())) for lower, upper in windows]
+    previously_done = [
+        key for key in keys if recorded.get(key, {}).get("status") == "done"
+    ]
+    recorded_filepaths = persistence.get_backfill_filepaths(scope)
+    reserved_filepaths = set()
+    for key in previously_done:
+        reserved_filepaths.update(recorded_filepaths.get(key, ()))
+
+    sys.stderr.write(
+        "Backfilling the date range %s to %s in %d windows of %d days for: %s\n"
+        % (from_.date(), to_.date(), len(windows), window_days, ", ".join(conf.names))
+    )
+    if previously_done:
+        sys.stderr.write(
+            "%d windows completed in previous runs will be skipped\n"
+            % len(previously_done)
+        )
+
+    results = {}
+    for i, ((lower, upper), key) in enumerate(zip(windows, keys), 1):
+        if key in previously_done:
+            results[key] = recorded[key]
+            continue
+        sys.stderr.write(
+            "\n[%d/%d] Searching for VODs in the date range %s to %s\n"
+            % (i, len(windows), key[0], key[1])
+        )
+        if not dry:
+            persistence.set_backfill_window(scope, *key, "started")
+        vod_list, source_exts, resolve_errors, peeked_sizes = search_member_vods(
+            conf,
+            lower,
+            upper,
+            refresh_urls=refresh_urls,
+            reserved_filepaths=reserved_filepaths,
+        )
+        filepaths = [
+            filepath
+            for _, _, filepath in planning.plan_filepaths(
+                conf,
+                vod_list,
+                source_exts=source_exts,
+                reserved_filepaths=reserved_filepaths,
+            )
+        ]
+        a2_failed, m3u8_failed, downloaded_files = download_vods(
+            conf,
+            vod_list,
+            source_exts=source_exts,
+            peeked_sizes=peeked_sizes,
+            dry=dry,
+            manifest_tag="%s-%s" % (lower.format("YYYYMMDD"), upper.format("YYYYMMDD")),
+            reserved_filepaths=reserved_filepaths,
+        )
+        reserved_filepaths.update(filepaths)
+        failed = len(resolve_errors) + len(a2_failed) + len(m3u8_failed)
+        result = dict(
+            status="failed" if failed else "done",
+            vods=len(vod_list) + len(resolve_errors),
+            downloaded=len(downloaded_files),
+            failed=failed,
+        )
+        if not dry:
+            persistence.set_backfill_window(scope, *key, filepaths=filepaths, **result)
+        results[key] = result
+        sys.stderr.write(
+            "[%d/%d] %s to %s: %s, %d VODs, %d downloaded, %d failed\n"
+            % (
+                i,
+                len(windows),
+                key[0],
+                key[1],
+                result["status"],
+                result["vods"],
+                result["downloaded"],
+                result["failed"],
+            )
+        )
+    report_api_stats()
+
+    failed_keys = [key for key in keys if results[key]["status"] != "done"]
+    sys.stderr.write(
+        "\n[SUMMARY] %d windows: %d done (%d in previous runs), %d failed; "
+        "%d VODs, %d downloaded, %d failed\n"
+        % (
+            len(windows),
+            len(windows) - len(failed_keys),
+            len(previously_done),
+            len(failed_keys),
+            sum(result["vods"] for result in results.values()),
+            sum(result["downloaded"] for result in results.values()),
+            sum(result["failed"] for result in results.values()),
+        )
+    )
+    if failed_keys:
+        sys.stderr.write("Incomplete windows (rerun to retry):\n")
+        for lower, upper in failed_keys:
+            sys.stderr.write("\t%s to %s\n" % (lower, upper))
+        return 1
+    sys.stderr.write("All is well.\n")
+    return 0
+
+
+def apply_api_config(conf):
+    koudai.set_api_deadline(conf.api_deadline)
+    koudai.set_api_base_url(conf.api_base_url)
+    koudai.set_api_hedging(conf.api_hedging)
+
+
+# Loads config_file into a new Config (of the same mode as conf). If the
+# new config is invalid, a warning is printed and conf is returned.
+def reload_config(conf, config_file):
+    new_conf = config.Config()
+    new_conf.mode = conf.mode
+    try:
+        new_conf.load(config_file)
+        if not new_conf.names:
+            raise ConfigError("names not specified")
+    except ConfigError as exc:
+        sys.stderr.write(
+            "[WARNING] failed to reload config, keeping the old one: %s\n" % exc
+        )
+        return conf
+    sys.stderr.write("Reloaded config from %s\n" % config_file)
+    return new_conf
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+# State of watch mode across polls.
+#
+# The watermark is the time the last successful poll started. Since
+# member VODs only show up in listings once the livestream is over, VODs
+# starting up to koudai.MEMBER_VOD_INDEX_SETTLE_TIME before the
+# watermark may still be new, so each poll lists from there (but never
+# before `since', the start of the initial date range), and skips VODs
+# that have already been taken care of (seen).
+class WatchState(object):
+    def __init__(self, since):
+        self.since = since
+        self.watermark = None
+        # Maps IDs of VODs taken care of to their start times.
+        self.seen = {}
+
+    def lower_bound(self):
+        if self.watermark is None:
+            return self.since
+        return max(
+            self.since,
+            self.watermark.shift(seconds=-koudai.MEMBER_VOD_INDEX_SETTLE_TIME),
+        )
+
+    # Records the poll started at `now', which took care of vods.
+    def advance(self, now, vods):
+        for vod in vods:
+            self.seen[vod.id] = vod.start_time
+        self.watermark = now
+        lower = self.lower_bound()
+        self.seen = {id: start for id, start in self.seen.items() if start >= lower}
+
+
+# A single poll of watch mode: searches for VODs of monitored members
+# newer than the watermark, and downloads them right away. VODs that
+# failed to resolve or download are retried in the next poll.
+def watch_poll(conf, state, *, dry=False):
+    now = arrow.now("Asia/Shanghai")
+    today = arrow.get(now.date(), "Asia/Shanghai")
+    vod_list, source_exts, resolve_errors, peeked_sizes = search_member_vods(
+        conf, state.lower_bound(), today, exclude_ids=state.seen
+    )
+    failed_urls = set()
+    if vod_list:
+        a2_failed, m3u8_failed, downloaded_files = download_vods(
+            conf,
+            vod_list,
+            source_exts=source_exts,
+            peeked_sizes=peeked_sizes,
+            dry=dry,
+            manifest_tag="watch",
+        )
+        failed_urls = set(url for url, _ in a2_failed + m3u8_failed)
+        for filepath in downloaded_files:
+            print(os.path.normpath(filepath), file=sys.stderr)
+    state.advance(now, [vod for vod in vod_list if vod.vod_url not in failed_urls])
+    sys.stderr.write(
+        "[%s] %d new VODs, %d failed\n"
+        % (
+            now.format("YYYY-MM-DD HH:mm:ss"),
+            len(vod_list) + len(resolve_errors),
+            len(failed_urls) + len(resolve_errors),
+        )
+    )
+
+
+# Watch mode: keeps running and polls for new VODs of monitored members
+# every conf.watch_interval seconds (with jitter), starting from the
+# date `since'. The config file is reloaded whenever it is modified
+# (with overrides, a dict of config attributes set from the command
+# line, applied on top). Errors of individual polls are reported and
+# otherwise ignored. On SIGTERM, exits once the current poll is
+# finished.
+#
+# Returns the exit status.
+def watch(conf, config_file, since, *, dry=False, overrides=None):
+    stop = threading.Event()
+
+    def handle_sigterm(signum, frame):
+        sys.stderr.write("Received SIGTERM, shutting down...\n")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    state = WatchState(since)
+    config_mtime = _mtime(config_file)
+    sys.stderr.write(
+        "Watching for VODs since %s every %d seconds for: %s\n"
+        % (since.date(), conf.watch_interval, ", ".join(conf.names))
+    )
+    while not stop.is_set():
+        mtime = _mtime(config_file)
+        if mtime != config_mtime:
+            config_mtime = mtime
+            conf = reload_config(conf, config_file)
+            for name, value in (overrides or {}).items():
+                setattr(conf, name, value)
+        apply_api_config(conf)
+        try:
+            watch_poll(conf, state, dry=dry)
+        except Exception as exc:
+            sys.stderr.write(
+                "[ERROR] poll failed: %s: %s\n" % (type(exc).__name__, exc)
+            )
+        stop.wait(
+            conf.watch_interval
+            * random.uniform(1 - WATCH_INTERVAL_JITTER, 1 + WATCH_INTERVAL_JITTER)
+        )
+    report_api_stats()
+    return 0
+
+
 def main():
     try:
         debug = True
@@ -166,6 +1176,14 @@ def main():
             formatter_class=argparse.RawDescriptionHelpFormatter,
         )
         newarg = parser.add_argument
+        newarg(
+            "command",
+            nargs="?",
+            choices=["backfill", "watch"],
+            help="backfill: download VODs in the date range window by window, "
+            "resuming where the last backfill of the same range left off; "
+            "watch: keep running and download new VODs as they show up",
+        )
         newarg(
             "-m",
             "--mode",
@@ -193,12 +1211,33 @@ def main():
             help="ending day of date range",
         )
         newarg("-s", "--span", type=int, help="number of days in date range")
+        newarg(
+            "--window",
+            type=int,
+            default=DEFAULT_BACKFILL_WINDOW,
+            metavar="DAYS",
+            help="number of days in each backfill window (default %d)"
+            % DEFAULT_BACKFILL_WINDOW,
+        )
+        newarg(
+            "-j",
+            "--jobs",
+            type=int,
+            metavar="N",
+            help="number of concurrent caterpillar processes "
+            "(overrides caterpillar_jobs in the config file)",
+        )
         newarg(
             "-n",
             "--dry",
             action="store_true",
             help="print URL & filename combos but do not download",
         )
+        newarg(
+            "--refresh-urls",
+            action="store_true",
+            help="discard cached URLs of VODs in the date range and resolve them again",
+        )
         newarg("--config", help="use this config file instead of the default")
         newarg(
             "--filter",
@@ -250,9 +1289,19 @@ def main():
 
         conf.mode = mode
         conf.load(args.config)
+        apply_api_config(conf)
+        overrides = {}
+        if args.jobs is not None:
+            if args.jobs <= 0:
+                raise ValueError("jobs should be positive")
+            overrides["caterpillar_jobs"] = args.jobs
+        for name, value in overrides.items():
+            setattr(conf, name, value)
 
         if args.span is not None and args.span <= 0:
             raise ValueError("span should be positive")
+        if args.window <= 0:
+            raise ValueError("window should be positive")
         span = args.span or conf.span
         today = arrow.get(arrow.now("Asia/Shanghai").date(), "Asia/Shanghai")
         if args.from_ and args.to_:
@@ -281,6 +1330,33 @@ def main():
         if not args.multiple_instances:
             lock.lock_to_one_instance()
 
+        if args.command:
+            if mode != "std":
+                raise ValueError("%s is only available in std mode" % args.command)
+            if not conf.names:
+                raise ConfigError("names not specified")
+        if args.command == "watch":
+            sys.exit(
+                watch(
+                    conf,
+                    args.config or config.DEFAULT_CONFIG_FILE,
+                    from_,
+                    dry=args.dry,
+                    overrides=overrides,
+                )
+            )
+        if args.command == "backfill":
+            sys.exit(
+                backfill(
+                    conf,
+                    from_,
+                    to_,
+                    window_days=args.window,
+                    refresh_urls=args.refresh_urls,
+                    dry=args.dry,
+                )
+            )
+
         if mode == "std":
             if not conf.names:
                 raise ConfigError("names not specified")
@@ -288,19 +1364,9 @@ def main():
                 "Searching for VODs in the date range %s to %s for: %s\n"
                 % (from_.date(), to_.date(), ", ".join(conf.names))
             )
-            vod_list = list(
-                reversed(
-                    [
-                        vod
-                        for vod in koudai.list_member_vods(
-                            from_, to_.shift(days=1), group_id=conf.group_id
-                        )
-                        if vod.name in conf.names
-                    ]
-                )
+            vod_list, source_exts, resolve_errors, peeked_sizes = search_member_vods(
+                conf, from_, to_, refresh_urls=args.refresh_urls
             )
-            sys.stderr.write("Resolving %d VOD URLs...\n" % len(vod_list))
-            koudai.resolve_member_vods(vod_list)
         elif mode == "perf":
             conf.load_filter("perf", args.filter)
             sys.stderr.write(
@@ -379,195 +1445,34 @@ def main():
                     vod.filepath = filepath
                     vod_list.append(vod)
                     seen.add(id)
+            if args.refresh_urls:
+                persistence.invalidate_resolved_urls(
+                    "perf", [vod.id for vod in vod_list]
+                )
+            source_exts = {}
+            peeked_sizes = {}
             sys.stderr.write("Resolving %d VOD URLs...\n" % len(vod_list))
-            koudai.resolve_perf_vods(vod_list)
+            resolve_errors = koudai.resolve_perf_vods(
+                vod_list,
+                workers=conf.resolve_workers,
+                use_cache=True,
+                cache_ttl=conf.resolve_cache_ttl,
+            )
+            vod_list = drop_unresolved_vods(vod_list, resolve_errors)
         else:
             raise ValueError("unrecognized mode %s" % repr(mode))
-
-        targets = []
-        a2_targets = []
-        m3u8_targets = []
-        # *_unfinished_targets store targets that aren't already downloaded.
-        a2_unfinished_targets = []
-        m3u8_unfinished_targets = []
-        existing_filepaths = set()
-        for vod in vod_list:
-            url = vod.vod_url
-            src_ext = utils.extension_from_url(vod.vod_url, dot=True)
-            base, _ = os.path.splitext(conf.filepath(vod))
-
-            # If source extension is .m3u8, use .mp4 as output
-            # extension; otherwise, use the source extension as the
-            # output extension.
-            ext = ".mp4" if src_ext == ".m3u8" else src_ext
-
-            # Filename deduplication
-            filepath = base + ext
-            number = 0
-            while filepath in existing_filepaths:
-                number += 1
-                filepath = "%s (%d)%s" % (base, number, ext)
-            existing_filepaths.add(filepath)
-
-            fullpath = os.path.join(conf.directory, filepath)
-
-            entry = (url, filepath)
-            targets.append(entry)
-            if src_ext == ".m3u8":
-                m3u8_targets.append(entry)
-                if not os.path.exists(fullpath):
-                    m3u8_unfinished_targets.append(entry)
-            else:
-                a2_targets.append(entry)
-                if not os.path.exists(fullpath) or os.path.exists(fullpath + ".aria2"):
-                    a2_unfinished_targets.append(entry)
-
-        new_urls = set(
-            url for url, _ in a2_unfinished_targets + m3u8_unfinished_targets
+        report_api_stats()
+
+        a2_failed, m3u8_failed, downloaded_files = download_vods(
+            conf,
+            vod_list,
+            source_exts=source_exts,
+            peeked_sizes=peeked_sizes,
+            dry=args.dry,
         )
-        for url, filepath in targets:
-            if url in new_urls:
-                print("%s\t%s\t*" % (url, filepath))
-            else:
-                print("%s\t%s" % (url, filepath))
-
-        # Make subdirectories.
-        if not args.dry:
-            subdirs = set(
-                os.path.dirname(filepath)
-                for url, filepath in a2_unfinished_targets + m3u8_unfinished_targets
-            )
-            for subdir in subdirs:
-                os.makedirs(os.path.join(conf.directory, subdir), exist_ok=True)
-
-        # Report download sizes.
-        if a2_unfinished_targets:
-            total_size, unknown_files = peek.peek_total_size(
-                url for url, _ in a2_unfinished_targets
-            )
-            msg = "{} direct downloads, total size: {:,} bytes".format(
-                len(a2_unfinished_targets), total_size
-            )
-            if unknown_files > 0:
-                msg += " (size of %d files could not be determined)" % unknown_files
-            msg += "\n"
-            sys.stderr.write(msg)
-        else:
-            sys.stderr.write("No new direct downloads.\n")
-
-        if m3u8_unfinished_targets:
-            sys.stderr.write(
-                "%d M3U8 VODs to download, total size unknown\n"
-                % len(m3u8_unfinished_targets)
-            )
-        else:
-            sys.stderr.write("No new M3U8 downloads.\n")
-
         if args.dry:
-            sys.exit(0)
-
-        exit_status = 0
-        downloaded_files = []
-
-        # Write the caterpillar manifest first so that we don't need to
-        # wait until aria2 is finished.
-        m3u8_manifest = os.path.join(conf.directory, "m3u8.txt")
-        if m3u8_unfinished_targets:
-            m3u8_unfinished_targets = caterpillar.write_manifest(
-                m3u8_unfinished_targets, m3u8_manifest, target_directory=conf.directory
-            )
-
-        if a2_unfinished_targets:
-            a2_manifest = os.path.join(conf.directory, "aria2.txt")
-            a2_dest_files = [
-                os.path.join(conf.directory, path) for _, path in a2_unfinished_targets
-            ]
-            for attempt in range(3):
-                if attempt == 0:
-                    sys.stderr.write("\nProcessing direct downloads with aria2...\n\n")
-                else:
-                    sys.stderr.write("\nRetrying direct downloads with aria2...\n\n")
-                a2_unfinished_targets = aria2.write_manifest(
-                    a2_unfinished_targets, a2_manifest, target_directory=conf.directory
-                )
-                a2_exit_status = aria2.download(a2_manifest)
-                if a2_exit_status == 0:
-                    os.unlink(a2_manifest)
-                    a2_unfinished_targets = []
-                    break
-            else:
-                a2_unfinished_targets = aria2.write_manifest(
-                    a2_unfinished_targets, a2_manifest, target_directory=conf.directory
-                )
-                sys.stderr.write(
-                    "\n[ERROR] aria2 failed to download the following VODs:\n\n"
-                )
-                for url, filepath in a2_unfinished_targets:
-                    sys.stderr.write("\t%s\t%s\n" % (url, filepath))
-                sys.stderr.write(
-                    "\naria2 batch input file have been written to '%s' "
-                    "in case you want to retry manually.\n\n" % a2_manifest
-                )
-                exit_status = 1
-                time.sleep(5)
-
-            for filepath in a2_dest_files:
-                if os.path.exists(filepath) and not os.path.exists(filepath + ".aria2"):
-                    downloaded_files.append(filepath)
-
-        if m3u8_unfinished_targets:
-            requirement_met = caterpillar.check_caterpillar_requirement()
-            if not requirement_met:
-                sys.stderr.write(
-                    "\n[ERROR] caterpillar requirement not met, cannot download M3U8 VODs.\n"
-                    "caterpillar batch manifest has been written to '%s'.\n\n"
-                    % m3u8_manifest
-                )
-                exit_status = 1
-            else:
-                m3u8_dest_files = [
-                    os.path.join(conf.directory, path)
-                    for _, path in m3u8_unfinished_targets
-                ]
-                for attempt in range(3):
-                    if attempt == 0:
-                        sys.stderr.write(
-                            "\nProcessing M3U8 downloads with caterpillar...\n\n"
-                        )
-                    else:
-                        sys.stderr.write(
-                            "\nRetrying M3U8 downloads with caterpillar...\n\n"
-                        )
-                    m3u8_unfinished_targets = caterpillar.write_manifest(
-                        m3u8_unfinished_targets,
-                        m3u8_manifest,
-                        target_directory=conf.directory,
-                    )
-                    caterpillar_exit_status = caterpillar.download(m3u8_manifest)
-                    if caterpillar_exit_status == 0:
-                        os.unlink(m3u8_manifest)
-                        m3u8_unfinished_targets = []
-                        break
-                else:
-                    m3u8_unfinished_targets = caterpillar.write_manifest(
-                        m3u8_unfinished_targets,
-                        m3u8_manifest,
-                        target_directory=conf.directory,
-                    )
-                    sys.stderr.write(
-                        "\n[ERROR] caterpillar failed to download the following VODs:\n\n"
-                    )
-                    for url, filepath in m3u8_unfinished_targets:
-                        sys.stderr.write("\t%s\t%s\n" % (url, filepath))
-                    sys.stderr.write(
-                        "\ncaterpillar batch manifest have been written to '%s' "
-                        "in case you want to retry manually.\n\n" % m3u8_manifest
-                    )
-                    exit_status = 1
-
-                for filepath in m3u8_dest_files:
-                    if os.path.exists(filepath):
-                        downloaded_files.append(filepath)
+            sys.exit(1 if resolve_errors else 0)
+        exit_status = 1 if resolve_errors or a2_failed or m3u8_failed else 0
 
         if mode == "perf":
             persistence.insert_perf_ids([vod.id for vod in vod_list])
@@ -581,8 +1486,13 @@ def main():
             sys.stderr.write("All is well.\n")
         else:
             sys.stderr.write(
-                "[SUMMARY] %d direct downloads failed, %d M3U8 downloads failed\n"
-                % (len(a2_unfinished_targets), len(m3u8_unfinished_targets))
+                "[SUMMARY] %d VODs failed to resolve, "
+                "%d direct downloads failed, %d M3U8 downloads failed\n"
+                % (
+                    len(resolve_errors),
+                    len(a2_failed),
+                    len(m3u8_failed),
+                )
             )
 
         sys.exit(exit_status)
@@ -0,0 +1,620 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the Koudai48 API, for offline integration tests
+# and load benchmarks.
+#
+# The server implements the getLiveList, getLiveOne, getOpenLiveList
+# and getOpenLiveOne endpoints under API_PATH over synthetic data, with
+# the same cursor paging as the real API, and serves matching mp4, m3u8
+# (master and media playlists), ts and lrc resources. Latency, errors,
+# timeouts and duplicate records (consecutive pages overlapping, as
+# observed on the real API) can be injected.
+#
+# Run it with
+#
+#   python -m kvm48.mockapi --port 8048
+#
+# and point kvm48 at it with the api_base_url config option or the
+# KVM48_API_BASE_URL environment variable, e.g.
+#
+#   KVM48_API_BASE_URL=http://127.0.0.1:8048/live/api/v1/live/ kvm48 ...
+
+import argparse
+import http.server
+import json
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, List, Optional, Tuple
+
+API_PATH = "/live/api/v1/live/"
+RESOURCE_PATH = "/resource/"
+
+# (group ID, group name, team IDs) of synthetic members.
+GROUPS = [
+    (10, "SNH48", [101, 102, 103, 104]),
+    (11, "BEJ48", [201, 202, 203]),
+    (12, "GNZ48", [301, 302, 303]),
+    (13, "SHY48", [401, 402]),
+    (14, "CKG48", [501, 502]),
+]
+STAGES = ["美丽48区", "重生计划", "心的旅程", "第48区", "梦想的旗帜"]
+MEMBERS_PER_TEAM = 12
+
+DEFAULT_PAGE_SIZE = 20
+DEFAULT_HANG_TIME = 30  # in seconds
+DEFAULT_ERROR_STATUSES = (500, 502, 503)
+DEFAULT_MP4_SIZE = 1024 * 1024
+DEFAULT_SEGMENT_SIZE = 128 * 1024
+DEFAULT_SEGMENTS = 8
+
+CHUNK_SIZE = 64 * 1024
+
+
+def make_member_vod_obj(
+    live_id: str,
+    start_ms: int,
+    member_id: int = 35,
+    nickname: str = "SNH48-莫寒",
+    *,
+    live_type: int = 1,
+    team_id: int = 101,
+    group_id: int = 10,
+) -> Dict[str, Any]:
+    return {
+        "liveId": live_id,
+        "title": "直播 %s" % live_id,
+        "liveType": live_type,
+        "ctime": str(start_ms),
+        "userInfo": {
+            "userId": str(member_id),
+            "nickname": nickname,
+            "teamId": str(team_id),
+            "groupId": str(group_id),
+        },
+    }
+
+
+def make_perf_vod_obj(
+    live_id: str, start_ms: int, stage: str = "美丽48区", *, group_id: int = 10
+) -> Dict[str, Any]:
+    return {
+        "liveId": live_id,
+        "title": "《%s》剧场公演" % stage,
+        "subTitle": "",
+        "stime": str(start_ms),
+        "groupId": str(group_id),
+        "teamList": [{"teamName": "Team %d" % group_id}],
+    }
+
+
+# List of (member_id, nickname, team_id, group_id) of synthetic members.
+def synthetic_members() -> List[Tuple[int, str, int, int]]:
+    members = []
+    for group_id, group_name, team_ids in GROUPS:
+        for team_id in team_ids:
+            for i in range(MEMBERS_PER_TEAM):
+                member_id = team_id * 100 + i
+                members.append(
+                    (member_id, "%s-成员%d" % (group_name, member_id), team_id, group_id)
+                )
+    return members
+
+
+# Synthetic member VOD objects in reverse chronological order, the
+# latest starting at end_ms, spaced interval_ms apart.
+def generate_member_vods(
+    count: int, *, end_ms: int = None, interval_ms: int = 3600 * 1000, seed: int = 0
+) -> List[Dict[str, Any]]:
+    if end_ms is None:
+        end_ms = int(time.time() * 1000)
+    rng = random.Random(seed)
+    members = synthetic_members()
+    vods = []
+    for i in range(count):
+        member_id, nickname, team_id, group_id = rng.choice(members)
+        vods.append(
+            make_member_vod_obj(
+                "m%023d" % i,
+                end_ms - i * interval_ms,
+                member_id,
+                nickname,
+                live_type=1 if rng.random() < 0.8 else 2,
+                team_id=team_id,
+                group_id=group_id,
+            )
+        )
+    return vods
+
+
+def generate_perf_vods(
+    count: int, *, end_ms: int = None, interval_ms: int = 86400 * 1000, seed: int = 0
+) -> List[Dict[str, Any]]:
+    if end_ms is None:
+        end_ms = int(time.time() * 1000)
+    rng = random.Random(seed)
+    return [
+        make_perf_vod_obj(
+            "%018d" % i,
+            end_ms - i * interval_ms,
+            rng.choice(STAGES),
+            group_id=rng.choice(GROUPS)[0],
+        )
+        for i in range(count)
+    ]
+
+
+class MockAPIServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        *,
+        member_vods: List[Dict[str, Any]] = None,
+        perf_vods: List[Dict[str, Any]] = None,
+        seed: int = 0,
+    ):
+        super().__init__((host, port), MockAPIRequestHandler)
+        # VOD objects returned by getLiveList and getOpenLiveList, in
+        # reverse chronological order.
+        self.member_vods = member_vods if member_vods is not None else []
+        self.perf_vods = perf_vods if perf_vods is not None else []
+        self.page_size = DEFAULT_PAGE_SIZE
+        # Injected faults. Latency (in seconds) applies to API calls.
+        # Random errors are answered with one of error_statuses, and
+        # random timeouts hang for hang_time seconds before answering.
+        # With probability duplicate_rate, a page also repeats the last
+        # record of the previous page.
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.error_statuses = DEFAULT_ERROR_STATUSES
+        self.timeout_rate = 0.0
+        self.hang_time = DEFAULT_HANG_TIME
+        self.duplicate_rate = 0.0
+        # liveIds that always fail to resolve (with 404).
+        self.failing_ids = set()
+        # liveIds whose first resolve call hangs for hang_time seconds
+        # (later calls are answered normally), i.e., stalled requests.
+        self.stalled_ids = set()
+        # Number of upcoming API calls to answer with 503.
+        self.transient_failures = 0
+        # Resources.
+        self.mp4_size = DEFAULT_MP4_SIZE
+        # Per-liveId overrides of mp4_size.
+        self.mp4_sizes = {}  # type: Dict[str, int]
+        self.segment_size = DEFAULT_SEGMENT_SIZE
+        self.segments = DEFAULT_SEGMENTS
+        # Per-connection bandwidth of resources, in bytes per second; 0
+        # for unlimited.
+        self.bandwidth = 0
+        # Statistics.
+        self.request_count = 0  # API calls
+        self.list_requests = 0  # getLiveList and getOpenLiveList calls
+        self.resource_requests = 0
+        self.resource_bytes = 0
+        self.client_ports = set()
+
+        self.lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._closing = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    @property
+    def api_base_url(self) -> str:
+        return self.base_url + API_PATH
+
+    def start(self) -> "MockAPIServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self._closing.set()
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def __enter__(self) -> "MockAPIServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def random(self) -> float:
+        with self.lock:
+            return self._rng.random()
+
+
+class MockAPIRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        try:
+            self._handle_api_call()
+        except ConnectionError:
+            # Client gave up, e.g., after an injected timeout.
+            self.close_connection = True
+
+    def do_GET(self):
+        try:
+            self._handle_resource(head=False)
+        except ConnectionError:
+            self.close_connection = True
+
+    def do_HEAD(self):
+        try:
+            self._handle_resource(head=True)
+        except ConnectionError:
+            self.close_connection = True
+
+    def _handle_api_call(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            payload = {}
+        path = urllib.parse.urlsplit(self.path).path
+        endpoint = path[len(API_PATH) :] if path.startswith(API_PATH) else None
+
+        with server.lock:
+            server.request_count += 1
+            server.client_ports.add(self.client_address[1])
+            if endpoint in ("getLiveList", "getOpenLiveList"):
+                server.list_requests += 1
+            transient_failure = server.transient_failures > 0
+            if transient_failure:
+                server.transient_failures -= 1
+        if server.latency:
+            time.sleep(server.latency)
+        if transient_failure:
+            self.send_empty_response(503)
+            return
+        if server.error_rate and server.random() < server.error_rate:
+            self.send_empty_response(
+                server.error_statuses[int(server.random() * len(server.error_statuses))]
+            )
+            return
+        if server.timeout_rate and server.random() < server.timeout_rate:
+            if server._closing.wait(server.hang_time):
+                return
+
+        if endpoint == "getLiveList":
+            self.send_json_response(self._list_page(server.member_vods, payload))
+        elif endpoint == "getOpenLiveList":
+            self.send_json_response(self._list_page(server.perf_vods, payload))
+        elif endpoint in ("getLiveOne", "getOpenLiveOne"):
+            live_id = str(payload.get("liveId"))
+            if live_id in server.failing_ids:
+                self.send_empty_response(404)
+                return
+            with server.lock:
+                stalled = live_id in server.stalled_ids
+                server.stalled_ids.discard(live_id)
+            if stalled and server._closing.wait(server.hang_time):
+                return
+            if endpoint == "getLiveOne":
+                content = self._member_vod_content(live_id)
+            else:
+                content = self._perf_vod_content(live_id)
+            self.send_json_response({"status": 200, "content": content})
+        else:
+            self.send_empty_response(404)
+
+    def _list_page(self, vods: List[Dict[str, Any]], payload: Dict[str, Any]):
+        server = self.server
+
+        def match(vod_obj, key, value):
+            if not value:
+                return True
+            obj = vod_obj.get("userInfo", vod_obj)
+            return str(obj.get(key)) == str(value)
+
+        # Filtering is server-side, so pages of filtered lists are full.
+        if payload.get("memberId") or payload.get("teamId") or payload.get("groupId"):
+            vods = [
+                vod_obj
+                for vod_obj in vods
+                if match(vod_obj, "userId", payload.get("memberId"))
+                and match(vod_obj, "teamId", payload.get("teamId"))
+                and match(vod_obj, "groupId", payload.get("groupId"))
+            ]
+
+        # The cursor is the liveId of the last VOD of the previous page
+        # ("0" for the first page), so cursors stay valid as new VODs
+        # are added to the front of the list.
+        cursor = str(payload.get("next") or "0")
+        if cursor == "0":
+            offset = 0
+        else:
+            offset = len(vods)
+            for i, vod_obj in enumerate(vods):
+                if vod_obj["liveId"] == cursor:
+                    offset = i + 1
+                    break
+        start = offset
+        if 0 < offset < len(vods) and server.duplicate_rate:
+            if server.random() < server.duplicate_rate:
+                start -= 1
+        live_list = vods[start : offset + server.page_size]
+        return {
+            "status": 200,
+            "content": {
+                "liveList": live_list,
+                "next": live_list[-1]["liveId"] if live_list else cursor,
+            },
+        }
+
+    def _member_vod_content(self, live_id: str) -> Dict[str, Any]:
+        resource_url = self.server.base_url + RESOURCE_PATH
+        live_type = 1
+        for vod_obj in self.server.member_vods:
+            if vod_obj["liveId"] == live_id:
+                live_type = int(vod_obj["liveType"])
+                break
+        if live_type == 1:
+            play_stream_path = resource_url + "live/%s.mp4" % live_id
+        else:
+            play_stream_path = resource_url + "hls/%s/media.m3u8" % live_id
+        return {
+            "liveId": live_id,
+            "playStreamPath": play_stream_path,
+            "msgFilePath": resource_url + "lrc/%s.lrc" % live_id,
+        }
+
+    def _perf_vod_content(self, live_id: str) -> Dict[str, Any]:
+        resource_url = self.server.base_url + RESOURCE_PATH
+        return {
+            "liveId": live_id,
+            "playStreams": [
+                {
+                    "streamName": "标清",
+                    "streamPath": resource_url + "hls/%s/media.m3u8" % live_id,
+                },
+                {
+                    "streamName": "高清",
+                    "streamPath": resource_url + "hls/%s/master.m3u8" % live_id,
+                },
+            ],
+        }
+
+    def _handle_resource(self, head: bool):
+        server = self.server
+        path = urllib.parse.urlsplit(self.path).path
+        if not path.startswith(RESOURCE_PATH):
+            self.send_empty_response(404)
+            return
+        resource = path[len(RESOURCE_PATH) :]
+        with server.lock:
+            server.resource_requests += 1
+
+        m = re.match(r"^live/(?P<id>[^/]+)\.mp4$", resource)
+        if m:
+            size = server.mp4_sizes.get(m.group("id"), server.mp4_size)
+            self._send_blob(m.group("id"), size, "video/mp4", head)
+            return
+        m = re.match(r"^hls/(?P<id>[^/]+)/(?P<seq>\d+)\.ts$", resource)
+        if m and int(m.group("seq")) < server.segments:
+            self._send_blob(resource, server.segment_size, "video/MP2T", head)
+            return
+        m = re.match(r"^hls/(?P<id>[^/]+)/master\.m3u8$", resource)
+        if m:
+            playlist = (
+                "#EXTM3U\n"
+                "#EXT-X-STREAM-INF:BANDWIDTH=1280000,RESOLUTION=1280x720\n"
+                "media.m3u8\n"
+            )
+            self._send_text(playlist, "application/vnd.apple.mpegurl", head)
+            return
+        m = re.match(r"^hls/(?P<id>[^/]+)/media\.m3u8$", resource)
+        if m:
+            lines = [
+                "#EXTM3U",
+                "#EXT-X-VERSION:3",
+                "#EXT-X-TARGETDURATION:10",
+                "#EXT-X-MEDIA-SEQUENCE:0",
+            ]
+            for seq in range(server.segments):
+                lines.extend(["#EXTINF:10.000,", "%d.ts" % seq])
+            lines.append("#EXT-X-ENDLIST")
+            self._send_text(
+                "\n".join(lines) + "\n", "application/vnd.apple.mpegurl", head
+            )
+            return
+        m = re.match(r"^lrc/(?P<id>[^/]+)\.lrc$", resource)
+        if m:
+            self._send_text("[00:00.000]弹幕 %s\n" % m.group("id"), "text/plain", head)
+            return
+        self.send_empty_response(404)
+
+    # Serve `size` bytes of deterministic content derived from `key`,
+    # honoring single byte ranges.
+    def _send_blob(self, key: str, size: int, content_type: str, head: bool):
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if range_header:
+            m = re.match(r"^bytes=(\d*)-(\d*)$", range_header.strip())
+            if not m or (not m.group(1) and not m.group(2)):
+                self.send_empty_response(416)
+                return
+            if m.group(1):
+                start = int(m.group(1))
+                if m.group(2):
+                    end = min(int(m.group(2)), size - 1)
+            else:
+                start = max(size - int(m.group(2)), 0)
+            if start > end:
+                self.send_empty_response(416)
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        self.end_headers()
+        if head:
+            return
+
+        pattern = _blob_pattern(key)
+        bandwidth = self.server.bandwidth
+        offset = start
+        while offset <= end:
+            length = min(CHUNK_SIZE, end - offset + 1)
+            i = offset % len(pattern)
+            chunk = (pattern[i:] + pattern * (length // len(pattern) + 1))[:length]
+            chunk_start = time.monotonic()
+            self.wfile.write(chunk)
+            offset += length
+            with self.server.lock:
+                self.server.resource_bytes += length
+            if bandwidth:
+                delay = length / bandwidth - (time.monotonic() - chunk_start)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def _send_text(self, text: str, content_type: str, head: bool):
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_json_response(self, obj: Any):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty_response(self, code: int):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Content of blob `key` is this 4KiB pattern repeated, so that resumed
+# or ranged downloads can be verified byte by byte with blob_bytes.
+def _blob_pattern(key: str) -> bytes:
+    rng = random.Random(key)
+    return bytes(rng.getrandbits(8) for _ in range(4096))
+
+
+def blob_bytes(key: str, size: int) -> bytes:
+    pattern = _blob_pattern(key)
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m kvm48.mockapi",
+        description="Local stand-in for the Koudai48 API over synthetic data.",
+    )
+    add = parser.add_argument
+    add("--host", default="127.0.0.1")
+    add("--port", type=int, default=8048)
+    add("--member-vods", type=int, default=1000, help="number of member VODs")
+    add(
+        "--member-interval",
+        type=float,
+        default=1,
+        help="hours between consecutive member VODs",
+    )
+    add("--perf-vods", type=int, default=200, help="number of performance VODs")
+    add(
+        "--perf-interval",
+        type=float,
+        default=24,
+        help="hours between consecutive performance VODs",
+    )
+    add("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    add("--latency", type=float, default=0, help="API latency in seconds")
+    add("--error-rate", type=float, default=0, help="fraction of API calls failing")
+    add(
+        "--error-statuses",
+        default=",".join(map(str, DEFAULT_ERROR_STATUSES)),
+        help="comma-separated HTTP statuses of injected errors",
+    )
+    add("--timeout-rate", type=float, default=0, help="fraction of API calls hanging")
+    add("--hang-time", type=float, default=DEFAULT_HANG_TIME)
+    add(
+        "--duplicate-rate",
+        type=float,
+        default=0,
+        help="fraction of pages repeating the last record of the previous page",
+    )
+    add("--mp4-size", type=int, default=DEFAULT_MP4_SIZE, help="in bytes")
+    add("--segment-size", type=int, default=DEFAULT_SEGMENT_SIZE, help="in bytes")
+    add("--segments", type=int, default=DEFAULT_SEGMENTS)
+    add("--bandwidth", type=int, default=0, help="per connection, in bytes/s")
+    add("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = MockAPIServer(
+        args.host,
+        args.port,
+        member_vods=generate_member_vods(
+            args.member_vods,
+            interval_ms=int(args.member_interval * 3600 * 1000),
+            seed=args.seed,
+        ),
+        perf_vods=generate_perf_vods(
+            args.perf_vods,
+            interval_ms=int(args.perf_interval * 3600 * 1000),
+            seed=args.seed,
+        ),
+        seed=args.seed,
+    )
+    server.page_size = args.page_size
+    server.latency = args.latency
+    server.error_rate = args.error_rate
+    server.error_statuses = tuple(int(s) for s in args.error_statuses.split(","))
+    server.timeout_rate = args.timeout_rate
+    server.hang_time = args.hang_time
+    server.duplicate_rate = args.duplicate_rate
+    server.mp4_size = args.mp4_size
+    server.segment_size = args.segment_size
+    server.segments = args.segments
+    server.bandwidth = args.bandwidth
+
+    names = sorted({v["userInfo"]["nickname"] for v in server.member_vods[:20]})
+    sys.stderr.write(
+        "Serving mock Koudai48 API at %s\n" % server.api_base_url
+        + "Run kvm48 with KVM48_API_BASE_URL=%s\n" % server.api_base_url
+        + "Some member names: %s\n"
+        % ", ".join(n.split("-", 1)[1] for n in names[:5])
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
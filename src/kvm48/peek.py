@@ -1,12 +1,18 @@
-from typing import Iterator, Optional, Tuple
+from typing import Dict, Iterable, Optional, Tuple
 
 import multiprocessing.pool
 import requests
 
+from .session import get_session
+
+
+# Number of concurrent HEAD requests.
+DEFAULT_WORKERS = 16
+
 
 def peek_content_length(url: str) -> Optional[int]:
     try:
-        r = requests.head(url, allow_redirects=True, timeout=3)
+        r = get_session().head(url, allow_redirects=True, timeout=3)
     except (requests.RequestException, OSError):
         return None
     if r.status_code == 200 and "content-length" in r.headers:
@@ -15,16 +21,18 @@ def peek_content_length(url: str) -> Optional[int]:
         return None
 
 
-def peek_total_size(urls: Iterator[str]) -> Tuple[int, int]:
-    with multiprocessing.pool.ThreadPool(processes=16) as pool:
-        it = pool.imap_unordered(peek_content_length, urls)
-        pool.close()
-        pool.join()
-        total_size = 0
-        unknown_files = 0
-        for size in it:
-            if size is None:
-                unknown_files += 1
-            else:
-                total_size += size
-        return total_size, unknown_files
+# Returns a dict mapping URLs to their sizes (None if unknown), peeked
+# concurrently.
+def peek_sizes(urls: Iterable[str]) -> Dict[str, Optional[int]]:
+    urls = list(urls)
+    if not urls:
+        return {}
+    with multiprocessing.pool.ThreadPool(processes=DEFAULT_WORKERS) as pool:
+        return dict(zip(urls, pool.map(peek_content_length, urls)))
+
+
+def peek_total_size(urls: Iterable[str]) -> Tuple[int, int]:
+    sizes = peek_sizes(urls).values()
+    unknown_files = sum(1 for size in sizes if size is None)
+    total_size = sum(size for size in sizes if size is not None)
+    return total_size, unknown_files
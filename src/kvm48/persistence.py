@@ -1,7 +1,10 @@
 import functools
+import json
 import os
 import sqlite3
-from typing import Iterable, List
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 from .dirs import USER_DATA_DIR
 
@@ -38,3 +41,475 @@ def insert_perf_ids(ids: Iterable[str]) -> None:
         perf_id_conn.executemany(
             "INSERT OR IGNORE INTO id(id) VALUES (?)", [(id,) for id in ids]
         )
+
+
+# The member VOD index is a local record of member VODs seen in
+# getLiveList responses, together with the time ranges (per listing
+# scope) that have been fully paged through, so that subsequent
+# listings can stop paging once they reach an already indexed region.
+#
+# Start times are stored as milliseconds since the epoch, same as ctime
+# in API responses.
+vod_index_conn = None
+vod_index_lock = threading.RLock()
+
+
+def ensure_vod_index_database(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        global vod_index_conn
+        with vod_index_lock:
+            if not vod_index_conn:
+                if not os.path.exists(USER_DATA_DIR):
+                    os.makedirs(USER_DATA_DIR, exist_ok=True)
+                vod_index_conn = sqlite3.connect(
+                    os.path.join(USER_DATA_DIR, "vod_index.db"),
+                    check_same_thread=False,
+                )
+                # The index is written to on every listed page. With WAL
+                # and synchronous=NORMAL, commits don't wait for fsync;
+                # the last few commits may be lost on power failure, but
+                # the database stays consistent, which is fine for data
+                # that can always be listed again.
+                vod_index_conn.execute("PRAGMA journal_mode=WAL")
+                vod_index_conn.execute("PRAGMA synchronous=NORMAL")
+                with vod_index_conn:
+                    vod_index_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS member_vod (
+                            id TEXT NOT NULL PRIMARY KEY,
+                            member_id INTEGER NOT NULL,
+                            nickname TEXT NOT NULL,
+                            live_type INTEGER NOT NULL,
+                            title TEXT NOT NULL,
+                            start_time INTEGER NOT NULL
+                        )"""
+                    )
+                    vod_index_conn.execute(
+                        "CREATE INDEX IF NOT EXISTS member_vod_start_time "
+                        "ON member_vod (start_time)"
+                    )
+                    vod_index_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS member_vod_scope (
+                            scope TEXT NOT NULL,
+                            id TEXT NOT NULL,
+                            PRIMARY KEY (scope, id)
+                        )"""
+                    )
+                    vod_index_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS member_vod_coverage (
+                            scope TEXT NOT NULL,
+                            lower INTEGER NOT NULL,
+                            upper INTEGER NOT NULL
+                        )"""
+                    )
+                    vod_index_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS member (
+                            name TEXT NOT NULL PRIMARY KEY,
+                            user_id INTEGER NOT NULL
+                        )"""
+                    )
+                    vod_index_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS list_checkpoint (
+                            kind TEXT NOT NULL,
+                            scope TEXT NOT NULL,
+                            cursor TEXT NOT NULL,
+                            earliest INTEGER NOT NULL,
+                            PRIMARY KEY (kind, scope, cursor)
+                        )"""
+                    )
+                    vod_index_conn.execute(
+                        "CREATE INDEX IF NOT EXISTS list_checkpoint_earliest "
+                        "ON list_checkpoint (kind, scope, earliest)"
+                    )
+                    vod_index_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS member_vod_extension (
+                            type TEXT NOT NULL PRIMARY KEY,
+                            ext TEXT NOT NULL
+                        )"""
+                    )
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+# vod_objs are raw liveList entries of getLiveList responses.
+@ensure_vod_index_database
+def insert_member_vods(scope: str, vod_objs: Iterable[Dict[str, Any]]) -> None:
+    rows = [
+        (
+            v["liveId"],
+            int(v["userInfo"]["userId"]),
+            v["userInfo"]["nickname"],
+            int(v["liveType"]),
+            v["title"],
+            int(v["ctime"]),
+        )
+        for v in vod_objs
+    ]
+    with vod_index_lock, vod_index_conn:
+        vod_index_conn.executemany(
+            "INSERT OR REPLACE INTO member_vod "
+            "(id, member_id, nickname, live_type, title, start_time) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+        vod_index_conn.executemany(
+            "INSERT OR IGNORE INTO member_vod_scope (scope, id) VALUES (?, ?)",
+            [(scope, row[0]) for row in rows],
+        )
+
+
+# Returns indexed VODs of the scope with lower <= start_time <= upper,
+# in reverse chronological order, in the same shape as liveList entries
+# of getLiveList responses.
+@ensure_vod_index_database
+def query_member_vods(scope: str, lower: int, upper: int) -> List[Dict[str, Any]]:
+    with vod_index_lock, vod_index_conn:
+        rows = vod_index_conn.execute(
+            "SELECT v.id, v.member_id, v.nickname, v.live_type, v.title, v.start_time "
+            "FROM member_vod v JOIN member_vod_scope s ON v.id = s.id "
+            "WHERE s.scope = ? AND v.start_time BETWEEN ? AND ? "
+            "ORDER BY v.start_time DESC",
+            (scope, lower, upper),
+        ).fetchall()
+    return [
+        {
+            "liveId": id,
+            "userInfo": {"userId": str(member_id), "nickname": nickname},
+            "liveType": live_type,
+            "title": title,
+            "ctime": str(start_time),
+        }
+        for id, member_id, nickname, live_type, title, start_time in rows
+    ]
+
+
+# Returns the fully indexed interval (lower, upper) of the scope
+# containing the time point, or None.
+@ensure_vod_index_database
+def get_member_vod_coverage(scope: str, time: int) -> Optional[Tuple[int, int]]:
+    with vod_index_lock, vod_index_conn:
+        return vod_index_conn.execute(
+            "SELECT lower, upper FROM member_vod_coverage "
+            "WHERE scope = ? AND lower <= ? AND ? <= upper",
+            (scope, time, time),
+        ).fetchone()
+
+
+# Marks [lower, upper] of the scope as fully indexed, merging with
+# existing overlapping or adjacent intervals.
+@ensure_vod_index_database
+def add_member_vod_coverage(scope: str, lower: int, upper: int) -> None:
+    if lower > upper:
+        return
+    with vod_index_lock, vod_index_conn:
+        overlapping = vod_index_conn.execute(
+            "SELECT rowid, lower, upper FROM member_vod_coverage "
+            "WHERE scope = ? AND lower <= ? AND ? <= upper",
+            (scope, upper + 1, lower - 1),
+        ).fetchall()
+        for rowid, other_lower, other_upper in overlapping:
+            lower = min(lower, other_lower)
+            upper = max(upper, other_upper)
+        vod_index_conn.executemany(
+            "DELETE FROM member_vod_coverage WHERE rowid = ?",
+            [(rowid,) for rowid, _, _ in overlapping],
+        )
+        vod_index_conn.execute(
+            "INSERT INTO member_vod_coverage (scope, lower, upper) VALUES (?, ?, ?)",
+            (scope, lower, upper),
+        )
+
+
+# Cache of resolved VOD URLs (and danmaku URLs for member VODs), keyed
+# by VOD ID. kind is either "member" or "perf". resolved_at is a Unix
+# timestamp.
+resolved_url_conn = None
+resolved_url_lock = threading.RLock()
+
+
+def ensure_resolved_url_database(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        global resolved_url_conn
+        with resolved_url_lock:
+            if not resolved_url_conn:
+                if not os.path.exists(USER_DATA_DIR):
+                    os.makedirs(USER_DATA_DIR, exist_ok=True)
+                resolved_url_conn = sqlite3.connect(
+                    os.path.join(USER_DATA_DIR, "resolved_url.db"),
+                    check_same_thread=False,
+                )
+                with resolved_url_conn:
+                    resolved_url_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS resolved_url (
+                            id TEXT NOT NULL,
+                            kind TEXT NOT NULL,
+                            vod_url TEXT NOT NULL,
+                            danmaku_url TEXT,
+                            resolved_at INTEGER NOT NULL,
+                            PRIMARY KEY (kind, id)
+                        )"""
+                    )
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+# Returns a dict mapping VOD IDs to (vod_url, danmaku_url) pairs for
+# cached IDs. Entries older than ttl seconds (if specified) are ignored.
+@ensure_resolved_url_database
+def get_resolved_urls(
+    kind: str, ids: Iterable[str], *, ttl: Optional[float] = None
+) -> Dict[str, Tuple[str, Optional[str]]]:
+    ids = list(ids)
+    min_resolved_at = int(time.time() - ttl) if ttl else 0
+    result = {}
+    with resolved_url_lock, resolved_url_conn:
+        # Stay well below SQLITE_MAX_VARIABLE_NUMBER.
+        for i in range(0, len(ids), 500):
+            chunk = ids[i : i + 500]
+            rows = resolved_url_conn.execute(
+                "SELECT id, vod_url, danmaku_url FROM resolved_url "
+                "WHERE kind = ? AND resolved_at >= ? AND id IN (%s)"
+                % ",".join("?" * len(chunk)),
+                (kind, min_resolved_at, *chunk),
+            ).fetchall()
+            for id, vod_url, danmaku_url in rows:
+                result[id] = (vod_url, danmaku_url)
+    return result
+
+
+# entries is an iterable of (id, vod_url, danmaku_url) tuples.
+@ensure_resolved_url_database
+def insert_resolved_urls(
+    kind: str, entries: Iterable[Tuple[str, str, Optional[str]]]
+) -> None:
+    resolved_at = int(time.time())
+    with resolved_url_lock, resolved_url_conn:
+        resolved_url_conn.executemany(
+            "INSERT OR REPLACE INTO resolved_url "
+            "(id, kind, vod_url, danmaku_url, resolved_at) VALUES (?, ?, ?, ?, ?)",
+            [
+                (id, kind, vod_url, danmaku_url, resolved_at)
+                for id, vod_url, danmaku_url in entries
+            ],
+        )
+
+
+# Drops cached URLs of the given IDs, or all cached URLs if ids is None.
+@ensure_resolved_url_database
+def invalidate_resolved_urls(kind: str, ids: Optional[Iterable[str]] = None) -> None:
+    with resolved_url_lock, resolved_url_conn:
+        if ids is None:
+            resolved_url_conn.execute(
+                "DELETE FROM resolved_url WHERE kind = ?", (kind,)
+            )
+        else:
+            resolved_url_conn.executemany(
+                "DELETE FROM resolved_url WHERE kind = ? AND id = ?",
+                [(kind, id) for id in ids],
+            )
+
+
+# Source extensions (with leading dot) last observed for each member VOD
+# type (直播 or 电台), used for predicting target paths of unresolved
+# VODs. Stored alongside the member VOD index.
+@ensure_vod_index_database
+def get_observed_extensions() -> Dict[str, str]:
+    with vod_index_lock, vod_index_conn:
+        return dict(
+            vod_index_conn.execute(
+                "SELECT type, ext FROM member_vod_extension"
+            ).fetchall()
+        )
+
+
+@ensure_vod_index_database
+def update_observed_extensions(exts: Dict[str, str]) -> None:
+    with vod_index_lock, vod_index_conn:
+        vod_index_conn.executemany(
+            "INSERT OR REPLACE INTO member_vod_extension (type, ext) VALUES (?, ?)",
+            exts.items(),
+        )
+
+
+# Directory of member names and user IDs, learned from userInfo in
+# getLiveList responses, so that members can be listed by memberId.
+# entries is an iterable of (name, user_id) pairs.
+@ensure_vod_index_database
+def update_member_directory(entries: Iterable[Tuple[str, int]]) -> None:
+    with vod_index_lock, vod_index_conn:
+        vod_index_conn.executemany(
+            "INSERT OR REPLACE INTO member (name, user_id) VALUES (?, ?)", entries
+        )
+
+
+# Returns a dict mapping names to user IDs, for known names.
+@ensure_vod_index_database
+def get_member_ids(names: Iterable[str]) -> Dict[str, int]:
+    names = list(names)
+    with vod_index_lock, vod_index_conn:
+        return dict(
+            vod_index_conn.execute(
+                "SELECT name, user_id FROM member WHERE name IN (%s)"
+                % ",".join("?" * len(names)),
+                names,
+            ).fetchall()
+        )
+
+
+# Cursor checkpoints of listings (getLiveList and getOpenLiveList,
+# distinguished by kind, "member" or "perf"), per listing scope: each
+# checkpoint maps the "next" cursor returned with a page to the earliest
+# start time on that page, i.e., paging from the cursor only yields VODs
+# starting no later than that. Cursors are stored JSON-encoded, since
+# they are passed back to the API verbatim.
+@ensure_vod_index_database
+def add_list_checkpoint(kind: str, scope: str, cursor: Any, earliest: int) -> None:
+    with vod_index_lock, vod_index_conn:
+        vod_index_conn.execute(
+            "INSERT OR REPLACE INTO list_checkpoint (kind, scope, cursor, earliest) "
+            "VALUES (?, ?, ?, ?)",
+            (kind, scope, json.dumps(cursor), earliest),
+        )
+
+
+# Returns the (cursor, earliest) checkpoint of the scope with the
+# smallest earliest start time no less than `time`, or None.
+@ensure_vod_index_database
+def find_list_checkpoint(kind: str, scope: str, time: int) -> Optional[Tuple[Any, int]]:
+    with vod_index_lock, vod_index_conn:
+        row = vod_index_conn.execute(
+            "SELECT cursor, earliest FROM list_checkpoint "
+            "WHERE kind = ? AND scope = ? AND earliest >= ? "
+            "ORDER BY earliest LIMIT 1",
+            (kind, scope, time),
+        ).fetchone()
+    return (json.loads(row[0]), row[1]) if row else None
+
+
+@ensure_vod_index_database
+def remove_list_checkpoint(kind: str, scope: str, cursor: Any) -> None:
+    with vod_index_lock, vod_index_conn:
+        vod_index_conn.execute(
+            "DELETE FROM list_checkpoint WHERE kind = ? AND scope = ? AND cursor = ?",
+            (kind, scope, json.dumps(cursor)),
+        )
+
+
+# Progress of backfill runs (see `kvm48 backfill`), one row per date
+# window. scope identifies what is being backfilled (mode, group and
+# monitored members), so that windows completed for one set of members
+# aren't skipped for another. lower and upper are the first and last
+# days of the window, in YYYY-MM-DD format. status is one of "started",
+# "done" and "failed"; only "done" windows are skipped on reruns.
+#
+# The target paths (relative to the download directory) planned for the
+# VODs of each window are recorded in backfill_file, so that filenames
+# in other windows can be deduplicated against them.
+backfill_conn = None
+backfill_lock = threading.RLock()
+
+
+def ensure_backfill_database(f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        global backfill_conn
+        with backfill_lock:
+            if not backfill_conn:
+                if not os.path.exists(USER_DATA_DIR):
+                    os.makedirs(USER_DATA_DIR, exist_ok=True)
+                backfill_conn = sqlite3.connect(
+                    os.path.join(USER_DATA_DIR, "backfill.db"),
+                    check_same_thread=False,
+                )
+                with backfill_conn:
+                    backfill_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS backfill_window (
+                            scope TEXT NOT NULL,
+                            lower TEXT NOT NULL,
+                            upper TEXT NOT NULL,
+                            status TEXT NOT NULL,
+                            vods INTEGER NOT NULL,
+                            downloaded INTEGER NOT NULL,
+                            failed INTEGER NOT NULL,
+                            updated_at INTEGER NOT NULL,
+                            PRIMARY KEY (scope, lower, upper)
+                        )"""
+                    )
+                    backfill_conn.execute(
+                        """CREATE TABLE IF NOT EXISTS backfill_file (
+                            scope TEXT NOT NULL,
+                            lower TEXT NOT NULL,
+                            upper TEXT NOT NULL,
+                            filepath TEXT NOT NULL,
+                            PRIMARY KEY (scope, lower, upper, filepath)
+                        )"""
+                    )
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+# Returns a dict mapping (lower, upper) of recorded windows of the scope
+# to dicts with keys status, vods, downloaded and failed.
+@ensure_backfill_database
+def get_backfill_windows(scope: str) -> Dict[Tuple[str, str], Dict[str, Any]]:
+    with backfill_lock, backfill_conn:
+        rows = backfill_conn.execute(
+            "SELECT lower, upper, status, vods, downloaded, failed "
+            "FROM backfill_window WHERE scope = ?",
+            (scope,),
+        ).fetchall()
+    return {
+        (lower, upper): dict(
+            status=status, vods=vods, downloaded=downloaded, failed=failed
+        )
+        for lower, upper, status, vods, downloaded, failed in rows
+    }
+
+
+@ensure_backfill_database
+def set_backfill_window(
+    scope: str,
+    lower: str,
+    upper: str,
+    status: str,
+    *,
+    vods: int = 0,
+    downloaded: int = 0,
+    failed: int = 0,
+    filepaths: Iterable[str] = None,
+) -> None:
+    with backfill_lock, backfill_conn:
+        backfill_conn.execute(
+            "INSERT OR REPLACE INTO backfill_window "
+            "(scope, lower, upper, status, vods, downloaded, failed, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (scope, lower, upper, status, vods, downloaded, failed, int(time.time())),
+        )
+        if filepaths is not None:
+            backfill_conn.execute(
+                "DELETE FROM backfill_file WHERE scope = ? AND lower = ? AND upper = ?",
+                (scope, lower, upper),
+            )
+            backfill_conn.executemany(
+                "INSERT OR IGNORE INTO backfill_file VALUES (?, ?, ?, ?)",
+                ((scope, lower, upper, filepath) for filepath in filepaths),
+            )
+
+
+# Returns a dict mapping (lower, upper) of recorded windows of the scope
+# to sets of target paths planned for them.
+@ensure_backfill_database
+def get_backfill_filepaths(scope: str) -> Dict[Tuple[str, str], Set[str]]:
+    with backfill_lock, backfill_conn:
+        rows = backfill_conn.execute(
+            "SELECT lower, upper, filepath FROM backfill_file WHERE scope = ?",
+            (scope,),
+        ).fetchall()
+    filepaths = {}  # type: Dict[Tuple[str, str], Set[str]]
+    for lower, upper, filepath in rows:
+        filepaths.setdefault((lower, upper), set()).add(filepath)
+    return filepaths
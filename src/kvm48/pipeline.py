@@ -0,0 +1,190 @@
+import heapq
+import queue
+import threading
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+# Default capacity of queues between stages. Producers block when the
+# downstream stage falls behind, so memory use stays bounded regardless
+# of the size of the input.
+DEFAULT_QUEUE_SIZE = 64
+
+# Marks the end of a stream.
+_END = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+# A staged producer/consumer pipeline. Items from the source iterable
+# flow through each stage in turn; a stage is a function taking an item
+# and returning an iterable (possibly empty) of items for the next
+# stage, executed by a number of worker threads. Stages are connected by
+# bounded queues, so that all stages run concurrently.
+#
+# Iterating over the pipeline yields items produced by the last stage in
+# order of completion (which is not necessarily the source order when
+# stages have multiple workers). Threads are started as soon as iter()
+# is called on the pipeline. If the source or any stage raises, the
+# pipeline is torn down and the exception is re-raised from iteration.
+#
+# A pipeline without stages simply consumes its source in a background
+# thread, ahead of the consumer.
+#
+# Example:
+#
+#   p = Pipeline(range(10))
+#   p.add_stage(lambda x: [x * 2], workers=4)
+#   for y in p:
+#       ...
+class Pipeline:
+    def __init__(self, source: Iterable[Any], *, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self._source = source
+        self._queue_size = queue_size
+        self._stages = []  # type: List[Tuple[Callable[[Any], Iterable[Any]], int]]
+        self._exc = None  # type: Optional[BaseException]
+        self._aborted = threading.Event()
+        self._started = False
+
+    def add_stage(
+        self, func: Callable[[Any], Iterable[Any]], *, workers: int = 1
+    ) -> "Pipeline":
+        if self._started:
+            raise RuntimeError("cannot add stage to a running pipeline")
+        self._stages.append((func, max(workers, 1)))
+        return self
+
+    def __iter__(self) -> Iterator[Any]:
+        if self._started:
+            raise RuntimeError("pipeline can only be iterated once")
+        self._started = True
+
+        queues = [queue.Queue(self._queue_size) for _ in range(len(self._stages) + 1)]
+        threads = [
+            threading.Thread(target=self._produce, args=(queues[0],), daemon=True)
+        ]
+        for i, (func, workers) in enumerate(self._stages):
+            remaining = [workers]
+            lock = threading.Lock()
+            for _ in range(workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(func, queues[i], queues[i + 1], remaining, lock),
+                        daemon=True,
+                    )
+                )
+        for thread in threads:
+            thread.start()
+        return self._consume(queues[-1], threads)
+
+    def _consume(self, q: queue.Queue, threads: List[threading.Thread]) -> Iterator[Any]:
+        try:
+            while True:
+                try:
+                    item = self._get(q)
+                except PipelineAborted:
+                    break
+                if item is _END:
+                    break
+                yield item
+        finally:
+            # Either done, failed, or the consumer stopped early; in the
+            # latter two cases, make sure all threads wind down.
+            self._aborted.set()
+            for thread in threads:
+                thread.join()
+        if self._exc is not None:
+            raise self._exc
+
+    def _produce(self, outq: queue.Queue) -> None:
+        try:
+            for item in self._source:
+                self._put(outq, item)
+        except PipelineAborted:
+            pass
+        except BaseException as exc:
+            self._fail(exc)
+        finally:
+            self._put_end(outq)
+
+    def _work(
+        self,
+        func: Callable[[Any], Iterable[Any]],
+        inq: queue.Queue,
+        outq: queue.Queue,
+        remaining: List[int],
+        lock: threading.Lock,
+    ) -> None:
+        try:
+            while True:
+                item = self._get(inq)
+                if item is _END:
+                    # Let sibling workers see the end, too.
+                    self._put_end(inq)
+                    break
+                for output in func(item):
+                    self._put(outq, output)
+        except PipelineAborted:
+            pass
+        except BaseException as exc:
+            self._fail(exc)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._put_end(outq)
+
+    def _fail(self, exc: BaseException) -> None:
+        if self._exc is None:
+            self._exc = exc
+        self._aborted.set()
+
+    def _get(self, q: queue.Queue) -> Any:
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self._aborted.is_set():
+                    if self._exc is not None:
+                        raise PipelineAborted
+                    return _END
+
+    def _put(self, q: queue.Queue, item: Any) -> None:
+        while True:
+            if self._aborted.is_set():
+                raise PipelineAborted
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    # Unlike _put, always succeeds (eventually), unless aborted.
+    def _put_end(self, q: queue.Queue) -> None:
+        while not self._aborted.is_set():
+            try:
+                q.put(_END, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+# Merge sorted iterables into a single sorted iterator, like
+# heapq.merge, except that each iterable is consumed concurrently by its
+# own thread (see Pipeline), so that slow sources, e.g., paginated API
+# listings, are advanced in parallel rather than one after another.
+def merge_concurrently(
+    sources: Iterable[Iterable[Any]],
+    *,
+    key: Callable[[Any], Any] = None,
+    reverse: bool = False,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+) -> Iterator[Any]:
+    iterators = [iter(Pipeline(source, queue_size=queue_size)) for source in sources]
+    try:
+        yield from heapq.merge(*iterators, key=key, reverse=reverse)
+    finally:
+        for it in iterators:
+            it.close()
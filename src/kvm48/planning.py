@@ -0,0 +1,145 @@
+import glob
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from . import persistence
+from .config import Config
+from .koudai import VOD
+from .utils import extension_from_url
+
+
+# Source extensions of member VOD types known a priori. 直播 VODs are
+# either MP4 or M3U8 (remuxed to MP4), so the output path is the same
+# either way.
+KNOWN_SOURCE_EXTENSIONS = {"直播": ".mp4"}
+
+
+# Returns the output extension (with leading dot) for a source
+# extension. M3U8 streams are remuxed to MP4; otherwise, the source
+# extension is used as the output extension.
+def output_extension(src_ext: str) -> str:
+    return ".mp4" if src_ext == ".m3u8" else src_ext
+
+
+# Compute the target path (relative to conf.directory) of each VOD, in
+# order, deduplicating filenames by appending numbers. The source
+# extension of a VOD is taken from its vod_url if resolved, or from
+# source_exts (a dict mapping VOD IDs to predicted source extensions)
+# otherwise. VODs with neither are skipped. reserved_filepaths, if
+# specified, are paths taken by VODs planned separately (e.g. in other
+# backfill windows), which filenames are deduplicated against as well.
+#
+# Returns a list of (vod, src_ext, filepath) tuples.
+def plan_filepaths(
+    conf: Config,
+    vods: List[VOD],
+    *,
+    source_exts: Dict[str, str] = None,
+    reserved_filepaths: Set[str] = None,
+) -> List[Tuple[VOD, str, str]]:
+    plan = []
+    existing_filepaths = set(reserved_filepaths or ())
+    for vod in vods:
+        if vod.vod_url:
+            src_ext = extension_from_url(vod.vod_url, dot=True)
+        elif source_exts and vod.id in source_exts:
+            src_ext = source_exts[vod.id]
+        else:
+            continue
+        base, _ = os.path.splitext(conf.filepath(vod, ext=src_ext[1:]))
+        ext = output_extension(src_ext)
+
+        # Filename deduplication
+        filepath = base + ext
+        number = 0
+        while filepath in existing_filepaths:
+            number += 1
+            filepath = "%s (%d)%s" % (base, number, ext)
+        existing_filepaths.add(filepath)
+
+        plan.append((vod, src_ext, filepath))
+    return plan
+
+
+# Predict source extensions (with leading dot) of unresolved member VODs
+# without hitting the API: from the resolved URL cache if available
+# (in which case vod_url is populated as well), otherwise from the
+# extension last observed for the same VOD type, or the known extension
+# of the type. VODs whose extensions cannot be predicted are left out of
+# the returned dict.
+def predict_source_extensions(
+    vods: List[VOD], *, cache_ttl: Optional[float] = None
+) -> Dict[str, str]:
+    cached = persistence.get_resolved_urls(
+        "member", (vod.id for vod in vods), ttl=cache_ttl
+    )
+    observed = persistence.get_observed_extensions()
+    exts = {}
+    for vod in vods:
+        if vod.id in cached:
+            vod.vod_url, vod.danmaku_url = cached[vod.id]
+            exts[vod.id] = extension_from_url(vod.vod_url, dot=True)
+        elif vod.type in observed:
+            exts[vod.id] = observed[vod.type]
+        elif vod.type in KNOWN_SOURCE_EXTENSIONS:
+            exts[vod.id] = KNOWN_SOURCE_EXTENSIONS[vod.type]
+    return exts
+
+
+# Remember source extensions of resolved member VODs by VOD type, for
+# use in predict_source_extensions.
+def record_source_extensions(vods: List[VOD]) -> None:
+    persistence.update_observed_extensions(
+        {
+            vod.type: extension_from_url(vod.vod_url, dot=True)
+            for vod in vods
+            if vod.vod_url
+        }
+    )
+
+
+# Returns IDs of VODs whose (predicted) targets are already fully
+# downloaded, and hence need not be resolved. The check is conservative:
+# a target with an aria2 control file is unfinished regardless of its
+# predicted source extension, and a VOD sharing its base name with an
+# unpredictable VOD is never considered finished since its deduplicated
+# filename cannot be determined. reserved_filepaths is as in
+# plan_filepaths.
+def find_finished_vods(
+    conf: Config,
+    vods: List[VOD],
+    source_exts: Dict[str, str],
+    *,
+    reserved_filepaths: Set[str] = None,
+) -> Set[str]:
+    unknown_bases = set(
+        os.path.splitext(conf.filepath(vod, ext="mp4"))[0]
+        for vod in vods
+        if not vod.vod_url and vod.id not in source_exts
+    )
+    finished_ids = set()
+    for vod, src_ext, filepath in plan_filepaths(
+        conf, vods, source_exts=source_exts, reserved_filepaths=reserved_filepaths
+    ):
+        if os.path.splitext(conf.filepath(vod, ext=src_ext[1:]))[0] in unknown_bases:
+            continue
+        fullpath = os.path.join(conf.directory, filepath)
+        if os.path.exists(fullpath) and not os.path.exists(fullpath + ".aria2"):
+            finished_ids.add(vod.id)
+    return finished_ids
+
+
+# Returns whether the target of a single VOD may already exist, without
+# knowing the rest of the VODs: deduplication could append a number to
+# the filename, so any file whose name starts with the base name and
+# ends with the output extension counts. The exact answer, which
+# requires the full list of VODs, is given by find_finished_vods.
+#
+# src_ext may be None if unknown, in which case any extension counts.
+def may_be_finished(conf: Config, vod: VOD, src_ext: Optional[str]) -> bool:
+    base, _ = os.path.splitext(conf.filepath(vod, ext=(src_ext or ".mp4")[1:]))
+    ext = output_extension(src_ext) if src_ext else ""
+    pattern = os.path.join(
+        glob.escape(conf.directory), glob.escape(base) + "*" + glob.escape(ext)
+    )
+    return bool(glob.glob(pattern))
@@ -0,0 +1,206 @@
+import collections
+import threading
+import time
+from typing import Optional
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Deadlines below are time.monotonic() values; None means wait forever.
+def _wait(cond: threading.Condition, deadline: Optional[float], cap: float = None):
+    if deadline is None:
+        cond.wait(cap)
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise RateLimitTimeout("timed out waiting for rate limiter")
+    cond.wait(min(remaining, cap) if cap is not None else remaining)
+
+
+# Classic token bucket: tokens accumulate at `rate` per second up to
+# `burst`, and each request takes one. A rate of None disables limiting.
+class TokenBucket(object):
+    def __init__(self, rate: Optional[float], burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.waits = 0  # number of acquisitions that had to wait
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def acquire(self, deadline: float = None) -> None:
+        if self.rate is None:
+            return
+        with self._cond:
+            waited = False
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    if waited:
+                        self.waits += 1
+                    return
+                waited = True
+                _wait(self._cond, deadline, (1 - self._tokens) / self.rate)
+
+    # Non-blocking version of acquire; returns whether a token was taken.
+    def try_acquire(self) -> bool:
+        if self.rate is None:
+            return True
+        with self._cond:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+# AIMD (additive increase, multiplicative decrease) concurrency limiter,
+# the same control law as TCP congestion avoidance.
+#
+# At most int(window) requests are in flight at any time. Each request
+# that succeeds within latency_threshold seconds grows the window by
+# 1/window (i.e., about one slot per window's worth of requests), while
+# a congestion signal (timeout, 429 or 5xx) multiplies the window by
+# `backoff`. Signals from requests sent before the last decrease are
+# ignored, so that a burst of failures of concurrent requests caused by
+# a single overload episode only shrinks the window once.
+class AIMDLimiter(object):
+    def __init__(
+        self,
+        initial: float,
+        *,
+        minimum: float = 1,
+        maximum: float = 64,
+        backoff: float = 0.5,
+        latency_threshold: float = 2,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_threshold = latency_threshold
+        self.window = min(max(initial, minimum), maximum)
+        self.in_flight = 0
+        self.decreases = 0
+        self._last_decrease = float("-inf")
+        self._cond = threading.Condition()
+
+    # Returns the start time of the request, to be passed to release.
+    def acquire(self, deadline: float = None) -> float:
+        with self._cond:
+            while self.in_flight >= int(self.window):
+                _wait(self._cond, deadline)
+            self.in_flight += 1
+            return time.monotonic()
+
+    # Non-blocking version of acquire; returns None if the window is full.
+    def try_acquire(self) -> Optional[float]:
+        with self._cond:
+            if self.in_flight >= int(self.window):
+                return None
+            self.in_flight += 1
+            return time.monotonic()
+
+    # `congested` is whether the request ended in a congestion signal;
+    # None if the outcome says nothing about server load (e.g., a client
+    # side error).
+    def release(self, start: float, congested: Optional[bool]) -> None:
+        latency = time.monotonic() - start
+        with self._cond:
+            self.in_flight -= 1
+            if congested:
+                if start >= self._last_decrease:
+                    self.window = max(self.minimum, self.window * self.backoff)
+                    self._last_decrease = time.monotonic()
+                    self.decreases += 1
+            elif congested is not None and latency <= self.latency_threshold:
+                self.window = min(self.maximum, self.window + 1 / self.window)
+            self._cond.notify_all()
+
+
+# Latency percentiles over a sliding window of the most recent samples.
+class LatencyTracker(object):
+    def __init__(self, size: int = 200):
+        self._samples = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._samples.append(latency)
+
+    # Returns None if there are no samples.
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+
+# Circuit breaker of a single endpoint. After `threshold` consecutive
+# failures the circuit opens, and requests are rejected immediately
+# with CircuitOpenError for `cooldown` seconds. Then a single trial
+# request is let through (half-open state): success closes the circuit,
+# failure opens it for another cooldown.
+class CircuitBreaker(object):
+    def __init__(self, threshold: int = 5, cooldown: float = 30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0  # consecutive
+        self.rejections = 0
+        self._opened_at = None  # type: Optional[float]
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.cooldown:
+                return "open"
+            return "half-open"
+
+    def before_request(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if (
+                time.monotonic() - self._opened_at >= self.cooldown
+                and not self._trial_in_flight
+            ):
+                self._trial_in_flight = True
+                return
+            self.rejections += 1
+            raise CircuitOpenError(
+                "circuit open after %d consecutive failures" % self.failures
+            )
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            self._trial_in_flight = False
+            if success:
+                self.failures = 0
+                self._opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self._opened_at = time.monotonic()
+
@@ -0,0 +1,57 @@
+import collections
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .koudai import VOD
+
+# Policies for the order in which targets are handed to download
+# backends. Backends work through targets in that order (a few at a
+# time), so when a run is interrupted or time-boxed, the order decides
+# which files are finished and which are left half-done.
+#
+# chronological: oldest VOD first (the order VODs are listed in).
+# smallest-first: smallest file first (by peeked size; files of unknown
+#   size, e.g. M3U8 VODs, go last), which maximizes the number of files
+#   finished early on.
+# newest-first: latest VOD first.
+# fair: round-robin across members (stages, in perf mode), oldest VOD
+#   of each first, so that no member's VODs wait for all of another's.
+CHRONOLOGICAL = "chronological"
+SMALLEST_FIRST = "smallest-first"
+NEWEST_FIRST = "newest-first"
+FAIR = "fair"
+POLICIES = (CHRONOLOGICAL, SMALLEST_FIRST, NEWEST_FIRST, FAIR)
+
+
+# Orders targets ((url, filepath) pairs, in chronological order) by
+# policy. vods maps targets to their VODs; sizes maps URLs to sizes
+# (None if unknown).
+def schedule(
+    targets: List[Tuple[str, str]],
+    policy: str,
+    *,
+    vods: Dict[Tuple[str, str], VOD],
+    sizes: Dict[str, Optional[int]] = None,
+) -> List[Tuple[str, str]]:
+    if policy == SMALLEST_FIRST:
+        sizes = sizes or {}
+        return sorted(
+            targets,
+            key=lambda target: (
+                sizes.get(target[0]) is None,
+                sizes.get(target[0]) or 0,
+            ),
+        )
+    if policy == NEWEST_FIRST:
+        return sorted(targets, key=lambda target: vods[target].start_time, reverse=True)
+    if policy == FAIR:
+        queues = collections.OrderedDict()  # type: Dict[str, Deque]
+        for target in targets:
+            queues.setdefault(vods[target].name, collections.deque()).append(target)
+        ordered = []
+        while queues:
+            for name in list(queues):
+                ordered.append(queues[name].popleft())
+                if not queues[name]:
+                    del queues[name]
+        return ordered
+    return list(targets)
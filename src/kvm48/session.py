@@ -0,0 +1,40 @@
+import threading
+
+import requests
+import requests.adapters
+
+
+# Number of per-host connection pools to keep, and the maximum number of
+# keep-alive connections in each pool. POOL_MAXSIZE should be no less
+# than the number of threads concurrently talking to a single host.
+POOL_CONNECTIONS = 8
+POOL_MAXSIZE = 32
+
+_session = None
+_session_lock = threading.Lock()
+
+
+# Returns the module-level requests.Session shared by all HTTP traffic
+# of a run (API calls, HEAD requests, etc.), so that connections to the
+# same host are pooled and kept alive instead of being reestablished for
+# every request.
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def close_session() -> None:
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,155 @@
+import re
+import subprocess
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+
+# Output of concurrently running tasks is interleaved on stderr line by
+# line, each line prefixed with the name of its task, e.g. "[aria2] ".
+_output_lock = threading.Lock()
+
+# Subprocesses started through call() that are still running. Once
+# terminate_all() is called, no more subprocesses are started.
+_processes = set()  # type: set
+_processes_lock = threading.Lock()
+_terminated = False
+
+
+def log(msg: str, prefix: Optional[str] = None) -> None:
+    if not prefix:
+        with _output_lock:
+            sys.stderr.write(msg)
+            sys.stderr.flush()
+        return
+    lines = msg.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    with _output_lock:
+        for line in lines:
+            sys.stderr.write("[%s] %s\n" % (prefix, line) if line else "\n")
+        sys.stderr.flush()
+
+
+# Runs a command to completion and returns its exit status. If prefix is
+# specified, stdout and stderr of the command are relayed to our stderr
+# line by line with the prefix (carriage returns, which progress bars
+# are usually drawn with, also end lines); if quiet, output is captured
+# but not relayed. Otherwise the command inherits our stdio, so that it
+# can draw progress on the terminal as usual. on_line, if specified, is
+# called with each line of captured output. If timeout (in seconds) is
+# specified, the command is terminated once it has run for that long,
+# and subprocess.TimeoutExpired is raised after it exits.
+#
+# FileNotFoundError is raised if the command is not found, and
+# KeyboardInterrupt if terminate_all() has been called.
+def call(
+    args: List[str],
+    prefix: Optional[str] = None,
+    *,
+    on_line: Optional[Callable[[str], None]] = None,
+    quiet: bool = False,
+    timeout: Optional[float] = None,
+) -> int:
+    log(" ".join(args) + "\n", prefix)
+    capture = bool(prefix or quiet)
+    relay_prefix = None if quiet else prefix
+    with _processes_lock:
+        if _terminated:
+            raise KeyboardInterrupt
+        if not capture:
+            proc = subprocess.Popen(args)
+        else:
+            proc = subprocess.Popen(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+            )
+        _processes.add(proc)
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, expire) if timeout is not None else None
+    if timer:
+        timer.daemon = True
+        timer.start()
+    try:
+        if capture:
+            buf = b""
+            for chunk in iter(lambda: proc.stdout.read1(65536), b""):
+                *lines, buf = re.split(rb"[\r\n]", buf + chunk)
+                for line in lines:
+                    _relay(line, relay_prefix, on_line)
+            _relay(buf, relay_prefix, on_line)
+        returncode = proc.wait()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(args, timeout)
+        return returncode
+    finally:
+        if timer:
+            timer.cancel()
+        with _processes_lock:
+            _processes.discard(proc)
+
+
+def _relay(line: bytes, prefix: Optional[str], on_line) -> None:
+    if not line.strip():
+        return
+    text = line.decode("utf-8", errors="replace")
+    if prefix:
+        log(text + "\n", prefix)
+    if on_line:
+        on_line(text)
+
+
+def terminate_all() -> None:
+    global _terminated
+    with _processes_lock:
+        _terminated = True
+        processes = list(_processes)
+    for proc in processes:
+        try:
+            proc.terminate()
+        except OSError:
+            pass
+
+
+# Runs tasks (a dict mapping names to functions taking no arguments)
+# concurrently, each in its own thread, and returns a dict mapping names
+# to return values once all of them are finished. If any task raises,
+# the first exception (in the order of tasks) is re-raised after all
+# tasks are finished. If interrupted, running subprocesses started
+# through call() are terminated before KeyboardInterrupt is re-raised.
+def run_concurrently(tasks: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+    results = {}  # type: Dict[str, Any]
+    errors = {}  # type: Dict[str, BaseException]
+
+    def run(name, task):
+        try:
+            results[name] = task()
+        except BaseException as exc:
+            errors[name] = exc
+
+    threads = [
+        threading.Thread(target=run, args=(name, task), name=name, daemon=True)
+        for name, task in tasks.items()
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        terminate_all()
+        raise
+    for name in tasks:
+        if name in errors:
+            raise errors[name]
+    return results
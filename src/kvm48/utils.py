@@ -10,6 +10,7 @@ __all__ = [
     "sanitize_filename",
     "sanitize_filepath",
     "read_keypress_with_timeout",
+    "format_size",
 ]
 
 
@@ -132,3 +133,12 @@ else:
 
     def read_keypress_with_timeout(timeout: float) -> None:
         time.sleep(timeout)
+
+
+# Human readable size in binary units, e.g. 1.5 MiB.
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024
+    return "%.1f GiB" % size
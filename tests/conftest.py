@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+
+import pytest
+
+from kvm48.mockapi import MockAPIServer, make_member_vod_obj, make_perf_vod_obj
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    from kvm48 import persistence
+
+    monkeypatch.setattr(persistence, "USER_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setattr(persistence, "perf_id_conn", None)
+    monkeypatch.setattr(persistence, "vod_index_conn", None)
+    monkeypatch.setattr(persistence, "resolved_url_conn", None)
+    monkeypatch.setattr(persistence, "backfill_conn", None)
+    yield tmp_path / "data"
+
+
+@pytest.fixture(autouse=True)
+def api_flow_control():
+    from kvm48 import koudai
+
+    koudai.reset_api_flow_control()
+    yield
+    koudai.reset_api_flow_control()
+
+
+@pytest.fixture
+def stub_api():
+    from kvm48 import koudai
+
+    with MockAPIServer() as server:
+        koudai.set_api_base_url(server.api_base_url)
+        try:
+            yield server
+        finally:
+            koudai.set_api_base_url(None)
+
+
+# Stand-in for ffmpeg(1) on PATH, which copies the input (-i) to the
+# output (the last argument) as is, and records its arguments. Yields a
+# function returning the argument lists of calls so far.
+FAKE_FFMPEG = """#!%s
+import json, shutil, sys
+args = sys.argv[1:]
+with open(%r, "a") as fp:
+    fp.write(json.dumps(args) + "\\n")
+shutil.copyfile(args[args.index("-i") + 1], args[-1])
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    from kvm48 import hls
+
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls_file = tmp_path / "ffmpeg-calls"
+    ffmpeg = bin_dir / "ffmpeg"
+    ffmpeg.write_text(FAKE_FFMPEG % (sys.executable, str(calls_file)))
+    ffmpeg.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setattr(hls, "FFMPEG", "ffmpeg")
+
+    def calls():
+        if not calls_file.exists():
+            return []
+        return [json.loads(line) for line in calls_file.read_text().splitlines()]
+
+    yield calls
@@ -0,0 +1,234 @@
+import http.server
+import json
+import os
+import socketserver
+import threading
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional, Set
+
+
+# A minimal stand-in for an aria2c RPC daemon (aria2c --enable-rpc),
+# implementing the JSON-RPC methods used by kvm48 (aria2.addUri,
+# aria2.tellStatus, aria2.forceRemove, aria2.removeDownloadResult,
+# aria2.changeGlobalOption, aria2.getVersion and system.multicall) at
+# /jsonrpc. As with aria2, a download into a path that an active download
+# is still writing fails with errorCode 11, and a force-removed download
+# stays active until it has actually stopped. Of global options,
+# only max-overall-download-limit (in bytes per second) is honored; all
+# of them are recorded in global_options, and each change is appended to
+# global_option_changes. Downloads are actually carried out,
+# with plain GET requests, so it works together with MockAPIServer.
+# fail_counts maps URIs to the number of upcoming downloads of the URI
+# that should fail, and poll_failures is the number of upcoming
+# system.multicall requests (which kvm48 polls with) to answer with a
+# bare HTTP 500, as if the daemon had gone away.
+class MockAria2Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, *, secret: str = None):
+        super().__init__((host, port), MockAria2RequestHandler)
+        self.secret = secret
+        self.fail_counts = {}  # type: Dict[str, int]
+        self.downloads = {}  # type: Dict[str, Dict[str, Any]]
+        self.paths = {}  # type: Dict[str, str]
+        self.removing = set()  # type: Set[str]
+        self.added_uris = []  # type: List[str]
+        self.poll_failures = 0
+        self.global_options = {}  # type: Dict[str, str]
+        self.global_option_changes = []  # type: List[Dict[str, str]]
+        # Downloads are paced (across all of them) until this
+        # time.monotonic() value, when rate limited.
+        self._paced_until = 0.0
+        self.lock = threading.Lock()
+        self._gids = iter(range(1, 1 << 62))
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def rpc_url(self) -> str:
+        host, port = self.server_address[:2]
+        return "http://%s:%d/jsonrpc" % (host, port)
+
+    def start(self) -> "MockAria2Server":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+    def __enter__(self) -> "MockAria2Server":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def call(self, method: str, params: List[Any]) -> Any:
+        if method == "system.multicall":
+            results = []
+            for call in params[0]:
+                try:
+                    results.append([self.call(call["methodName"], call["params"])])
+                except (KeyError, ValueError) as exc:
+                    results.append({"code": 1, "message": str(exc)})
+            return results
+        if self.secret is not None:
+            if not params or params[0] != "token:%s" % self.secret:
+                raise ValueError("Unauthorized")
+            params = params[1:]
+        if method == "aria2.getVersion":
+            return {"version": "1.35.0", "enabledFeatures": []}
+        elif method == "aria2.addUri":
+            return self._add_uri(params[0][0], params[1] if len(params) > 1 else {})
+        elif method == "aria2.tellStatus":
+            with self.lock:
+                download = self.downloads.get(params[0])
+                if download is None:
+                    raise ValueError("GID %s is not found" % params[0])
+                keys = params[1] if len(params) > 1 else list(download)
+                return {key: download[key] for key in keys if key in download}
+        elif method == "aria2.forceRemove":
+            with self.lock:
+                download = self.downloads.get(params[0])
+                if (
+                    download is None
+                    or download["status"] != "active"
+                    or params[0] in self.removing
+                ):
+                    raise ValueError("GID %s cannot be removed" % params[0])
+                self.removing.add(params[0])
+            return params[0]
+        elif method == "aria2.removeDownloadResult":
+            with self.lock:
+                download = self.downloads.get(params[0])
+                if download is None or download["status"] == "active":
+                    raise ValueError("GID %s is not found" % params[0])
+                del self.downloads[params[0]]
+                self.paths.pop(params[0], None)
+            return "OK"
+        elif method == "aria2.changeGlobalOption":
+            with self.lock:
+                self.global_options.update(params[0])
+                self.global_option_changes.append(dict(params[0]))
+            return "OK"
+        else:
+            raise ValueError("No such method: %s" % method)
+
+    def _add_uri(self, uri: str, options: Dict[str, str]) -> str:
+        path = os.path.join(options.get("dir", "."), options["out"])
+        with self.lock:
+            gid = "%016x" % next(self._gids)
+            self.added_uris.append(uri)
+            clash = any(
+                self.paths.get(other) == path and download["status"] == "active"
+                for other, download in self.downloads.items()
+            )
+            self.paths[gid] = path
+            if clash:
+                self.downloads[gid] = dict(
+                    gid=gid,
+                    status="error",
+                    errorCode="11",
+                    errorMessage="File %s is being downloaded" % path,
+                )
+                return gid
+            fail = self.fail_counts.get(uri, 0) > 0
+            if fail:
+                self.fail_counts[uri] -= 1
+            self.downloads[gid] = dict(
+                gid=gid,
+                status="active",
+                totalLength="0",
+                completedLength="0",
+                downloadSpeed="0",
+            )
+        threading.Thread(
+            target=self._download, args=(gid, uri, path, fail), daemon=True
+        ).start()
+        return gid
+
+    def _download(self, gid: str, uri: str, path: str, fail: bool) -> None:
+        def update(**kwargs):
+            with self.lock:
+                if gid in self.downloads:
+                    self.downloads[gid].update(kwargs)
+
+        def removing():
+            with self.lock:
+                return gid in self.removing
+
+        if fail:
+            update(status="error", errorCode="22", errorMessage="Injected failure")
+            return
+        # Like aria2, keep a control file next to unfinished downloads.
+        open(path + ".aria2", "wb").close()
+        try:
+            received = 0
+            with urllib.request.urlopen(uri) as resp, open(path, "wb") as fp:
+                for data in iter(lambda: resp.read(16384), b""):
+                    self._throttle(len(data))
+                    fp.write(data)
+                    received += len(data)
+                    if removing():
+                        break
+                    update(completedLength=str(received))
+        except Exception as exc:
+            update(status="error", errorCode="1", errorMessage=str(exc))
+            return
+        # A removed download only shows as such once it has stopped.
+        if removing():
+            with self.lock:
+                self.removing.discard(gid)
+            update(status="removed")
+            return
+        os.unlink(path + ".aria2")
+        size = str(received)
+        update(status="complete", totalLength=size, completedLength=size)
+
+    def _throttle(self, n: int) -> None:
+        with self.lock:
+            limit = int(self.global_options.get("max-overall-download-limit") or 0)
+            if not limit:
+                return
+            now = time.monotonic()
+            self._paced_until = max(self._paced_until, now) + n / limit
+            wait = self._paced_until - now
+        time.sleep(wait)
+
+
+class MockAria2RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length))
+        server = self.server
+        if request.get("method") == "system.multicall":
+            with server.lock:
+                fail = server.poll_failures > 0
+                if fail:
+                    server.poll_failures -= 1
+            if fail:
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        try:
+            result = self.server.call(request["method"], request.get("params", []))
+            status, obj = 200, {"result": result}
+        except (KeyError, IndexError, ValueError) as exc:
+            status, obj = 400, {"error": {"code": 1, "message": str(exc)}}
+        obj.update(jsonrpc="2.0", id=request.get("id"))
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json-rpc")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
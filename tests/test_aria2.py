@@ -0,0 +1,220 @@
+import shutil
+
+import pytest
+
+from kvm48 import aria2, bandwidth, jobs
+from kvm48.mockapi import blob_bytes
+
+from mockaria2 import MockAria2Server
+
+
+@pytest.fixture
+def aria2_server():
+    with MockAria2Server(secret="s3cret") as server:
+        yield server
+
+
+def test_rpc_client(aria2_server):
+    rpc = aria2.RPCClient(aria2_server.rpc_url, "s3cret")
+    assert "version" in rpc.call("aria2.getVersion")
+    results = rpc.multicall(
+        [("aria2.getVersion", []), ("aria2.tellStatus", ["nonexistent", []])]
+    )
+    assert "version" in results[0]
+    assert isinstance(results[1], aria2.RPCError)
+    with pytest.raises(aria2.RPCError):
+        aria2.RPCClient(aria2_server.rpc_url, "wrong").call("aria2.getVersion")
+
+
+def test_download_with_rpc_retries_failed_gids(stub_api, aria2_server, tmp_path):
+    stub_api.mp4_size = 10000
+    urls = [stub_api.base_url + "/resource/live/%s.mp4" % id for id in "abcd"]
+    urls.append(stub_api.base_url + "/nonexistent.mp4")
+    targets = [(url, "sub/%d.mp4" % i) for i, url in enumerate(urls)]
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "3.mp4").touch()  # already downloaded
+    aria2_server.fail_counts = {urls[1]: 1, urls[2]: 5}
+    messages = []
+
+    queue = jobs.RetryQueue(targets, backoff_base=0.01)
+    aria2.download_with_rpc(
+        aria2.RPCClient(aria2_server.rpc_url, "s3cret"),
+        queue,
+        target_directory=str(tmp_path),
+        log=messages.append,
+        poll_interval=0.01,
+    )
+    assert queue.finished()
+    assert [job.target for job in queue.failed()] == [targets[2], targets[4]]
+    # Only failed downloads are resubmitted, and 404 isn't worth retrying.
+    assert sorted(aria2_server.added_uris) == sorted(
+        [urls[0]] + [urls[1]] * 2 + [urls[2]] * 3 + [urls[4]]
+    )
+    assert "404" in queue.jobs[4].error
+    assert (tmp_path / "sub" / "0.mp4").read_bytes() == blob_bytes("a", 10000)
+    assert (tmp_path / "sub" / "1.mp4").read_bytes() == blob_bytes("b", 10000)
+    assert not (tmp_path / "sub" / "2.mp4").exists()
+    assert sum("Injected failure" in msg for msg in messages) == 4
+    # Finished downloads are cleared from the daemon.
+    assert aria2_server.downloads == {}
+
+
+def test_get_rpc_client_reuses_existing_daemon(aria2_server, monkeypatch):
+    monkeypatch.setattr(aria2, "_rpc_client", None)
+    rpc = aria2.get_rpc_client(aria2_server.rpc_url, "s3cret")
+    assert aria2.get_rpc_client(aria2_server.rpc_url, "s3cret") is rpc
+
+
+def test_output_errors():
+    errors = aria2.OutputErrors()
+    for line in [
+        "[ERROR] CUID#7 - Download aborted. URI=http://example.com/a.mp4",
+        "Exception: [AbstractCommand.cc:351] errorCode=3 URI=http://example.com/a.mp4",
+        "  -> [HttpSkipResponseCommand.cc:232] errorCode=3 Resource not found",
+        "[ERROR] CUID#8 - Download aborted. URI=http://example.com:443/b.mp4",
+        "  -> [AbstractCommand.cc:351] errorCode=22 Bad HTTP response status=503",
+    ]:
+        errors.feed(line)
+    assert errors.errors == {
+        "http://example.com/a.mp4": (3, "Resource not found"),
+        "http://example.com:443/b.mp4": (22, "Bad HTTP response status=503"),
+    }
+    assert aria2.is_permanent_error(3, "Resource not found")
+    assert not aria2.is_permanent_error(22, "Bad HTTP response status=503")
+    assert aria2.is_permanent_error(22, "Bad HTTP response status=403")
+
+
+def test_split_options():
+    MiB = aria2.MIB
+    # Small files don't get split; large ones get up to 16 connections.
+    assert aria2.split_options(3 * MiB) == {
+        "split": "1",
+        "max-connection-per-server": "1",
+        "min-split-size": "3M",
+    }
+    assert aria2.split_options(100 * MiB)["split"] == "7"
+    assert aria2.split_options(100 * MiB)["min-split-size"] == "14M"
+    assert aria2.split_options(2048 * MiB) == {
+        "split": "16",
+        "max-connection-per-server": "16",
+        "min-split-size": "128M",
+    }
+    assert aria2.split_options(None)["split"] == "16"
+    assert aria2.split_options(100 * 1024)["min-split-size"] == "1M"
+    # 5 concurrent downloads share the cap.
+    assert aria2.split_options(2048 * MiB, max_connections=20)["split"] == "4"
+    assert aria2.split_options(2048 * MiB, max_connections=3)["split"] == "1"
+
+
+def test_write_manifest_with_sizes(tmp_path):
+    manifest = tmp_path / "aria2.txt"
+    targets = [
+        ("http://example.com/a.mp4", "a.mp4"),
+        ("http://example.com/b.mp4", "b.mp4"),
+    ]
+    aria2.write_manifest(
+        targets,
+        str(manifest),
+        target_directory=str(tmp_path),
+        sizes={"http://example.com/a.mp4": 1024 * aria2.MIB},
+    )
+    lines = manifest.read_text().splitlines()
+    assert lines[:6] == [
+        "http://example.com/a.mp4",
+        "\tdir=%s" % tmp_path,
+        "\tout=a.mp4",
+        "\tsplit=16",
+        "\tmax-connection-per-server=16",
+        "\tmin-split-size=64M",
+    ]
+    assert "\tsplit=16" in lines[6:]  # unknown size
+
+
+def test_download_with_rpc_applies_bandwidth_limit(stub_api, aria2_server, tmp_path):
+    stub_api.mp4_size = 10000
+    targets = [(stub_api.base_url + "/resource/live/a.mp4", "a.mp4")]
+    share = bandwidth.Budget(bandwidth.Schedule(1048576)).join()
+    messages = []
+    aria2.download_with_rpc(
+        aria2.RPCClient(aria2_server.rpc_url, "s3cret"),
+        jobs.RetryQueue(targets),
+        target_directory=str(tmp_path),
+        log=messages.append,
+        poll_interval=0.01,
+        limiter=share,
+    )
+    assert aria2_server.global_options == {"max-overall-download-limit": "1048576"}
+    assert messages.count("Bandwidth limit: 1.0 MiB/s\n") == 1
+
+
+def test_download_with_rpc_survives_poll_failures(stub_api, aria2_server, tmp_path):
+    stub_api.mp4_size = 10000
+    urls = [stub_api.base_url + "/resource/live/%s.mp4" % id for id in "ab"]
+    targets = [(url, "%d.mp4" % i) for i, url in enumerate(urls)]
+    aria2_server.poll_failures = 1
+    messages = []
+    queue = jobs.RetryQueue(targets, backoff_base=0.01)
+    aria2.download_with_rpc(
+        aria2.RPCClient(aria2_server.rpc_url, "s3cret"),
+        queue,
+        target_directory=str(tmp_path),
+        log=messages.append,
+        poll_interval=0.01,
+    )
+    assert queue.failed() == []
+    assert all(job.attempts == 2 for job in queue.jobs)
+    assert sum(msg.startswith("[ERROR] failed to poll aria2") for msg in messages) == 1
+    assert (tmp_path / "0.mp4").read_bytes() == blob_bytes("a", 10000)
+    assert (tmp_path / "1.mp4").read_bytes() == blob_bytes("b", 10000)
+
+
+def test_download_with_rpc_removes_downloads_it_lost_track_of(
+    stub_api, aria2_server, tmp_path
+):
+    # The download is still running on the daemon when polling fails;
+    # resubmitting it without removing it first would fail permanently
+    # with errorCode 11.
+    stub_api.mp4_size = 100000
+    stub_api.bandwidth = 200000
+    url = stub_api.base_url + "/resource/live/a.mp4"
+    aria2_server.poll_failures = 1
+    queue = jobs.RetryQueue([(url, "a.mp4")], backoff_base=0.01)
+    aria2.download_with_rpc(
+        aria2.RPCClient(aria2_server.rpc_url, "s3cret"),
+        queue,
+        target_directory=str(tmp_path),
+        log=lambda _: None,
+        poll_interval=0.01,
+    )
+    assert queue.failed() == []
+    assert queue.jobs[0].attempts == 2
+    assert (tmp_path / "a.mp4").read_bytes() == blob_bytes("a", 100000)
+
+
+def test_output_errors_read_error_log(tmp_path):
+    log_file = tmp_path / "aria2.log"
+    log_file.write_text(
+        "2019-01-02 20:00:00.000000 [ERROR] [AbstractCommand.cc:349] CUID#7 - "
+        "Download aborted. URI=http://example.com/a.mp4\n"
+        "Exception: [AbstractCommand.cc:351] errorCode=3 URI=http://example.com/a.mp4\n"
+        "  -> [HttpSkipResponseCommand.cc:218] errorCode=3 Resource not found\n"
+    )
+    errors = aria2.OutputErrors()
+    errors.read(str(log_file))
+    errors.read(str(tmp_path / "nonexistent.log"))
+    assert errors.errors == {"http://example.com/a.mp4": (3, "Resource not found")}
+
+
+@pytest.mark.skipif(shutil.which("aria2c") is None, reason="aria2c not found")
+def test_download_logs_errors(stub_api, tmp_path):
+    stub_api.mp4_size = 1000
+    urls = [stub_api.base_url + path for path in ("/resource/live/a.mp4", "/gone.mp4")]
+    targets = [(url, "%d.mp4" % i) for i, url in enumerate(urls)]
+    manifest = str(tmp_path / "aria2.txt")
+    log_file = str(tmp_path / "aria2.log")
+    aria2.write_manifest(targets, manifest, target_directory=str(tmp_path))
+    assert aria2.download(manifest, log_file=log_file) != 0
+    errors = aria2.OutputErrors()
+    errors.read(log_file)
+    assert errors.errors == {urls[1]: (3, "Resource not found")}
+    assert aria2.is_finished(str(tmp_path / "0.mp4"))
@@ -0,0 +1,111 @@
+import datetime
+import time
+
+import pytest
+
+from kvm48 import bandwidth, httpdl
+from kvm48.config import Config, ConfigError
+from kvm48.mockapi import blob_bytes
+
+
+def test_parse_rate():
+    assert bandwidth.parse_rate(None) is None
+    assert bandwidth.parse_rate(0) is None
+    assert bandwidth.parse_rate("unlimited") is None
+    assert bandwidth.parse_rate(2097152) == 2097152
+    assert bandwidth.parse_rate("2M") == 2097152
+    assert bandwidth.parse_rate("2 MB/s") == 2097152
+    assert bandwidth.parse_rate("1.5KiB") == 1536
+    for value in ("fast", "-1", -1, "2X", True, [1]):
+        with pytest.raises(ValueError):
+            bandwidth.parse_rate(value)
+
+
+def test_schedule():
+    schedule = bandwidth.Schedule(
+        bandwidth.parse_rate("2M"),
+        [
+            bandwidth.parse_window("01:00-08:00 unlimited"),
+            bandwidth.parse_window("22:30-00:30 500K"),
+        ],
+    )
+    assert schedule.enabled
+    assert schedule.limit_at(datetime.time(0, 29)) == 512000
+    assert schedule.limit_at(datetime.time(0, 59)) == 2097152
+    assert schedule.limit_at(datetime.time(1, 0)) is None
+    assert schedule.limit_at(datetime.time(7, 59)) is None
+    assert schedule.limit_at(datetime.time(8, 0)) == 2097152
+    assert schedule.limit_at(datetime.time(22, 30)) == 512000
+    assert schedule.limit_at(datetime.time(0, 0)) == 512000
+    assert not bandwidth.Schedule(None, [(60, 480, None)]).enabled
+    for window in ("01:00-01:00 1M", "1-8 1M", "01:00-25:00 1M", "01:00-08:00"):
+        with pytest.raises(ValueError):
+            bandwidth.parse_window(window)
+
+
+def test_schedule_seconds_to_change(monkeypatch):
+    schedule = bandwidth.Schedule(
+        bandwidth.parse_rate("2M"),
+        [
+            bandwidth.parse_window("01:00-08:00 unlimited"),
+            bandwidth.parse_window("22:30-00:30 500K"),
+        ],
+    )
+
+    def seconds_to_change(*now):
+        monkeypatch.setattr(bandwidth, "_now", lambda: datetime.datetime(*now))
+        return schedule.seconds_to_change()
+
+    assert seconds_to_change(2019, 1, 2, 7, 59, 30) == 30
+    assert seconds_to_change(2019, 1, 2, 12, 0) == 10.5 * 3600
+    assert seconds_to_change(2019, 1, 2, 23, 0) == 1.5 * 3600
+    assert seconds_to_change(2019, 1, 2, 0, 45) == 15 * 60
+    # Adjacent windows with the same limit are skipped.
+    schedule.windows.append(bandwidth.parse_window("08:00-09:00 unlimited"))
+    assert seconds_to_change(2019, 1, 2, 7, 0) == 2 * 3600
+    assert bandwidth.Schedule(1024).seconds_to_change() is None
+
+
+def test_budget_is_split_between_shares(monkeypatch):
+    now = [0.0]
+    sleeps = []
+    monkeypatch.setattr(bandwidth.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(bandwidth.time, "sleep", sleeps.append)
+    budget = bandwidth.Budget(bandwidth.Schedule(1000))
+    s1 = budget.join()
+    with budget.join() as s2:
+        assert s1.limit() == s2.limit() == 500
+        s1.consume(250)
+        assert sleeps == [0.5]
+        now[0] = 1.0
+        s1.consume(250)
+        assert sleeps == [0.5]
+    assert budget.shares == 1
+    assert s1.limit() == 1000
+    assert bandwidth.format_limit(s1) == " (limit 1000.0 B/s)"
+
+
+def test_download_is_throttled(stub_api, tmp_path):
+    stub_api.mp4_size = 100000
+    url = stub_api.base_url + "/resource/live/a.mp4"
+    path = str(tmp_path / "a.mp4")
+    share = bandwidth.Budget(bandwidth.Schedule(200000)).join()
+    start = time.monotonic()
+    httpdl.download(url, path, chunk_size=16384, limiter=share)
+    assert time.monotonic() - start >= 0.4
+    with open(path, "rb") as fp:
+        assert fp.read() == blob_bytes("a", 100000)
+
+
+def test_bandwidth_config(tmp_path):
+    config_file = tmp_path / "config.yml"
+    conf = Config()
+    config_file.write_text(
+        "bandwidth_limit: 2M\n" "bandwidth_schedule:\n" "  - 01:00-08:00 unlimited\n"
+    )
+    conf.load(str(config_file))
+    assert conf.bandwidth.default == 2097152
+    assert conf.bandwidth.windows == [(60, 480, None)]
+    config_file.write_text("bandwidth_schedule:\n  - 01:00-08:00\n")
+    with pytest.raises(ConfigError):
+        conf.load(str(config_file))
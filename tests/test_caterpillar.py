@@ -0,0 +1,25 @@
+from kvm48 import caterpillar
+
+
+def test_output_errors():
+    targets = [
+        ("http://example.com/a.m3u8", "dir/a.mp4"),
+        ("http://example.com/b.m3u8", "dir/b.mp4"),
+    ]
+    errors = caterpillar.OutputErrors(targets)
+    for line in [
+        "Downloading http://example.com/a.m3u8 to dir/a.mp4...",
+        "[ERROR] HTTP error 404 Not Found",
+        "[ERROR] failed to download b.mp4",
+    ]:
+        errors.feed(line)
+    # Errors naming no target aren't pinned on the last one mentioned.
+    assert errors.errors == {
+        "http://example.com/b.m3u8": "[ERROR] failed to download b.mp4"
+    }
+
+    errors = caterpillar.OutputErrors(targets[:1])
+    errors.feed("[ERROR] HTTP error 404 Not Found")
+    assert errors.errors == {
+        "http://example.com/a.m3u8": "[ERROR] HTTP error 404 Not Found"
+    }
@@ -0,0 +1,56 @@
+import pytest
+
+from kvm48.config import Config, ConfigError
+
+
+@pytest.mark.parametrize(
+    "option",
+    [
+        "resolve_workers: 0",
+        "api_deadline: 0",
+        "resolve_cache_ttl: 0",
+        "watch_interval: 0",
+        "aria2_max_connections: 0",
+        "caterpillar_jobs: 0",
+        "direct_downloader: off",
+        "m3u8_downloader: off",
+        "download_order: off",
+        "bandwidth_schedule: off",
+    ],
+)
+def test_configured_zero_or_off_is_validated(tmp_path, option):
+    config_file = tmp_path / "config.yml"
+    config_file.write_text("group_id: 10\n%s\n" % option)
+    with pytest.raises(ConfigError):
+        Config().load(str(config_file))
+
+
+@pytest.mark.parametrize(
+    "option",
+    [
+        "resolve_workers: [1]",
+        "api_deadline: {seconds: 1}",
+        "resolve_cache_ttl: [1]",
+        "watch_interval: [1]",
+        "aria2_max_connections: [1]",
+        "caterpillar_jobs: [1]",
+    ],
+)
+def test_configured_non_scalars_are_rejected(tmp_path, option):
+    config_file = tmp_path / "config.yml"
+    config_file.write_text("group_id: 10\n%s\n" % option)
+    with pytest.raises(ConfigError):
+        Config().load(str(config_file))
+
+
+def test_unset_options_fall_back_to_defaults(tmp_path):
+    config_file = tmp_path / "config.yml"
+    config_file.write_text(
+        "group_id: 10\n" "api_deadline:\n" "caterpillar_jobs:\n" "aria2_rpc: off\n"
+    )
+    conf = Config()
+    conf.load(str(config_file))
+    assert conf.api_deadline is None
+    assert conf.caterpillar_jobs == 1
+    assert conf.aria2_rpc is False
+    assert conf.direct_downloader == "aria2"
@@ -0,0 +1,123 @@
+import os
+
+import pytest
+import requests
+
+from kvm48 import hls
+from kvm48.mockapi import blob_bytes
+
+
+@pytest.fixture(autouse=True)
+def no_ffmpeg(monkeypatch):
+    monkeypatch.setattr(hls, "FFMPEG", "nonexistent-ffmpeg")
+
+
+def expected_stream(stub_api, live_id):
+    return b"".join(
+        blob_bytes("hls/%s/%d.ts" % (live_id, seq), stub_api.segment_size)
+        for seq in range(stub_api.segments)
+    )
+
+
+def test_parse_playlist():
+    master = hls.parse_playlist(
+        "#EXTM3U\n"
+        "#EXT-X-STREAM-INF:BANDWIDTH=640000,RESOLUTION=640x360\n"
+        "low/index.m3u8\n"
+        '#EXT-X-STREAM-INF:BANDWIDTH=1280000,CODECS="avc1.4d401f,mp4a.40.2"\n'
+        "http://cdn.example.com/high/index.m3u8\n",
+        "http://example.com/vod/master.m3u8",
+    )
+    assert max(master.variants) == (
+        1280000,
+        "http://cdn.example.com/high/index.m3u8",
+    )
+    assert min(master.variants)[1] == "http://example.com/vod/low/index.m3u8"
+
+    media = hls.parse_playlist(
+        "#EXTM3U\n"
+        '#EXT-X-MAP:URI="init.mp4"\n'
+        "#EXTINF:10.0,\n"
+        "0.m4s\n"
+        "#EXTINF:10.0,\n"
+        "/abs/1.m4s\n"
+        "#EXT-X-ENDLIST\n",
+        "http://example.com/vod/media.m3u8",
+    )
+    assert media.fragmented_mp4
+    assert media.segments == [
+        "http://example.com/vod/init.mp4",
+        "http://example.com/vod/0.m4s",
+        "http://example.com/abs/1.m4s",
+    ]
+
+    with pytest.raises(hls.UnsupportedStreamError):
+        hls.parse_playlist(
+            '#EXTM3U\n#EXT-X-KEY:METHOD=AES-128,URI="key"\n#EXTINF:10,\n0.ts\n',
+            "http://example.com/vod/media.m3u8",
+        )
+
+
+def test_download_from_master_playlist(stub_api, tmp_path):
+    url = stub_api.base_url + "/resource/hls/x/master.m3u8"
+    path = tmp_path / "x.ts"
+    messages = []
+    size = hls.download(url, str(path), workers=4, log=messages.append)
+    assert path.read_bytes() == expected_stream(stub_api, "x")
+    assert size == stub_api.segments * stub_api.segment_size
+    assert [p.name for p in tmp_path.iterdir()] == ["x.ts"]
+    assert messages[-1].startswith("Downloaded x.ts")
+
+
+def test_download_remuxes_into_mp4(stub_api, tmp_path, fake_ffmpeg):
+    url = stub_api.base_url + "/resource/hls/x/media.m3u8"
+    path = tmp_path / "out" / "x.mp4"
+    path.parent.mkdir()
+    hls.download(url, str(path))
+    assert path.read_bytes() == expected_stream(stub_api, "x")
+    assert [p.name for p in path.parent.iterdir()] == ["x.mp4"]
+    [args] = fake_ffmpeg()
+    work_dir = str(path) + hls.WORK_DIR_SUFFIX
+    assert args[args.index("-i") + 1] == os.path.join(work_dir, "concat")
+    assert args[args.index("-c") + 1] == "copy"
+    assert args[-3:] == ["-f", "mp4", str(path) + ".part"]
+
+
+def test_download_into_mp4_requires_ffmpeg(stub_api, tmp_path):
+    url = stub_api.base_url + "/resource/hls/x/media.m3u8"
+    path = tmp_path / "x.mp4"
+    with pytest.raises(hls.UnsupportedStreamError, match="ffmpeg"):
+        hls.download(url, str(path))
+    assert list(tmp_path.iterdir()) == []
+    # Only the playlist was fetched.
+    assert stub_api.resource_requests == 1
+
+
+def test_interrupted_download_resumes(stub_api, tmp_path):
+    url = stub_api.base_url + "/resource/hls/x/media.m3u8"
+    path = tmp_path / "x.ts"
+
+    # Segments from 4 on fail.
+    class FlakySession(requests.Session):
+        def get(self, url, **kwargs):
+            if url.endswith(".ts") and int(url.rsplit("/", 1)[1][:-3]) >= 4:
+                raise requests.ConnectionError("connection reset")
+            return super().get(url, **kwargs)
+
+    with pytest.raises(requests.ConnectionError):
+        hls.download(url, str(path), workers=1, session=FlakySession())
+    assert not path.exists()
+    work_dir = tmp_path / ("x.ts" + hls.WORK_DIR_SUFFIX)
+    assert sorted(p.name for p in work_dir.iterdir()) == [
+        "000000",
+        "000001",
+        "000002",
+        "000003",
+        "state.json",
+    ]
+
+    stub_api.resource_requests = 0
+    hls.download(url, str(path))
+    assert stub_api.resource_requests == 1 + stub_api.segments - 4
+    assert path.read_bytes() == expected_stream(stub_api, "x")
+    assert not work_dir.exists()
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+import requests
+
+from kvm48 import httpdl, jobs
+from kvm48.mockapi import blob_bytes
+
+
+def test_ranged_download(stub_api, tmp_path):
+    stub_api.mp4_size = 100000
+    url = stub_api.base_url + "/resource/live/a.mp4"
+    path = str(tmp_path / "a.mp4")
+    messages = []
+    assert httpdl.download(url, path, chunk_size=16384, log=messages.append) == 100000
+    with open(path, "rb") as fp:
+        assert fp.read() == blob_bytes("a", 100000)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.mp4"]
+    assert messages[-1].startswith("Downloaded a.mp4")
+    # 1 probe + 7 chunks
+    assert stub_api.resource_requests == 8
+
+
+def test_interrupted_download_resumes(stub_api, tmp_path, monkeypatch):
+    stub_api.mp4_size = 100000
+    url = stub_api.base_url + "/resource/live/a.mp4"
+    path = str(tmp_path / "a.mp4")
+
+    # Ranges from 50000 on fail.
+    class FlakySession(requests.Session):
+        def get(self, url, **kwargs):
+            range_header = kwargs.get("headers", {}).get("Range", "")
+            if range_header.startswith("bytes=") and range_header != "bytes=0-0":
+                if int(range_header[6:].split("-")[0]) >= 50000:
+                    raise requests.ConnectionError("connection reset")
+            return super().get(url, **kwargs)
+
+    with pytest.raises(requests.ConnectionError):
+        httpdl.download(
+            url, path, chunk_size=10000, workers=1, session=FlakySession()
+        )
+    with open(path + httpdl.STATE_SUFFIX, encoding="utf-8") as fp:
+        assert json.load(fp)["done"] == [0, 1, 2, 3, 4]
+
+    stub_api.resource_bytes = 0
+    httpdl.download(url, path, chunk_size=10000)
+    assert stub_api.resource_bytes == 1 + 50000
+    with open(path, "rb") as fp:
+        assert fp.read() == blob_bytes("a", 100000)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.mp4"]
+
+
+def test_not_found(stub_api, tmp_path):
+    with pytest.raises(httpdl.DownloadError) as excinfo:
+        httpdl.download(stub_api.base_url + "/nonexistent.mp4", str(tmp_path / "a"))
+    assert jobs.is_permanent_error(str(excinfo.value))
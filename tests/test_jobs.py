@@ -0,0 +1,77 @@
+import pytest
+
+from kvm48 import jobs
+
+
+def test_retry_queue_states(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(jobs.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(jobs.random, "uniform", lambda a, b: b)
+    queue = jobs.RetryQueue(
+        [("u1", "f1"), ("u2", "f2"), ("u3", "f3")],
+        max_attempts=3,
+        backoff_base=5,
+        backoff_cap=8,
+    )
+    j1, j2, j3 = queue.jobs
+    assert queue.take_ready() == [j1, j2, j3]
+    assert queue.take_ready() == []
+    assert queue.wait_time() is None
+    assert not queue.finished()
+
+    queue.succeed(j1)
+    queue.fail(j2, "HTTP Error 404: Not Found", permanent=True)
+    queue.fail(j3, "timed out")
+    assert [j.state for j in queue.jobs] == [
+        jobs.DONE,
+        jobs.FAILED_PERMANENT,
+        jobs.FAILED_RETRYABLE,
+    ]
+    assert queue.wait_time() == 5
+    assert queue.take_ready() == []
+
+    now[0] = 5
+    assert queue.take_ready() == [j3]
+    queue.fail(j3, "timed out")
+    assert queue.wait_time() == 8  # backoff doubled, but capped
+    now[0] = 20
+    assert queue.take_ready() == [j3]
+    queue.fail(j3, "timed out again")
+    assert j3.state == jobs.FAILED_PERMANENT
+    assert j3.attempts == 3
+    assert queue.finished()
+    assert queue.failed() == [j2, j3]
+    assert jobs.format_failures([j3]) == "\tu3\tf3\n\t\ttimed out again (3 attempts)\n"
+
+
+@pytest.mark.parametrize(
+    "message,permanent",
+    [
+        ("HTTP Error 404: Not Found", True),
+        ("Bad HTTP response status=403", True),
+        ("Server returned 410 Gone", True),
+        ("No space left on device", True),
+        ("Bad HTTP response status=503", False),
+        ("Bad HTTP response status=429", False),
+        ("connect to example.com port 443 failed", False),
+        ("Connection reset by peer", False),
+    ],
+)
+def test_is_permanent_error(message, permanent):
+    assert jobs.is_permanent_error(message) is permanent
+
+
+def test_format_completions(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(jobs.time, "monotonic", lambda: now[0])
+    queue = jobs.RetryQueue([("u1", "f1"), ("u2", "f2"), ("u3", "f3")])
+    j1, j2, j3 = queue.take_ready()
+    now[0] = 130.0
+    queue.succeed(j1)
+    now[0] = 190.0
+    queue.succeed(j2)
+    queue.fail(j3, "HTTP Error 404: Not Found", permanent=True)
+    now[0] = 220.0
+    assert jobs.format_completions(queue) == (
+        "2 of 3 files completed in 2m00s (1.00 files/min, mean time to completion 1m00s)"
+    )
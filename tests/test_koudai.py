@@ -0,0 +1,449 @@
+import time
+
+import arrow
+
+from kvm48 import koudai, persistence
+from kvm48.koudai import MemberVOD, PerfVOD
+
+from conftest import make_member_vod_obj, make_perf_vod_obj
+
+
+def make_member_vods(n):
+    return [
+        MemberVOD("%024d" % i, 35, "直播", "莫寒", "标题", arrow.get(0)) for i in range(n)
+    ]
+
+
+def test_resolve_member_vods(stub_api):
+    vods = make_member_vods(5)
+    errors = koudai.resolve_member_vods(vods, workers=3)
+    assert errors == []
+    resource_url = stub_api.base_url + "/resource/"
+    for vod in vods:
+        assert vod.vod_url == resource_url + "live/%s.mp4" % vod.id
+        assert vod.danmaku_url == resource_url + "lrc/%s.lrc" % vod.id
+
+
+def test_resolve_perf_vods(stub_api):
+    vods = [PerfVOD("324479006241787906", [], "标题", None, arrow.get(0))]
+    assert koudai.resolve_perf_vods(vods) == []
+    assert vods[0].vod_url == (
+        stub_api.base_url + "/resource/hls/324479006241787906/master.m3u8"
+    )
+
+
+def test_resolve_relative_resource_url():
+    assert koudai._resolve_resource_url("/mediasource/live/1.mp4") == (
+        "https://source.48.cn/mediasource/live/1.mp4"
+    )
+    assert koudai._resolve_resource_url("https://mp4.48.cn/live/1.mp4") == (
+        "https://mp4.48.cn/live/1.mp4"
+    )
+
+
+def test_resolve_collects_errors_in_order(stub_api):
+    vods = make_member_vods(6)
+    stub_api.failing_ids = {vods[1].id, vods[4].id}
+    errors = koudai.resolve_member_vods(vods, workers=4)
+    assert [vod.id for vod, _ in errors] == [vods[1].id, vods[4].id]
+    assert all(isinstance(exc, koudai.APIException) for _, exc in errors)
+    assert vods[1].vod_url is None
+    assert vods[4].vod_url is None
+    assert all(vod.vod_url for i, vod in enumerate(vods) if i not in (1, 4))
+
+
+def test_resolve_wall_clock_scales_with_workers(stub_api):
+    stub_api.latency = 0.2
+    elapsed = {}
+    for workers in (1, 8):
+        vods = make_member_vods(8)
+        start = time.time()
+        assert koudai.resolve_member_vods(vods, workers=workers) == []
+        elapsed[workers] = time.time() - start
+    assert elapsed[1] >= 8 * 0.2
+    assert elapsed[8] < elapsed[1] / 3
+
+
+def test_call_api_retries_server_errors(stub_api, monkeypatch):
+    monkeypatch.setattr(koudai, "API_BACKOFF_BASE", 0.01)
+    stub_api.transient_failures = 2
+    vods = make_member_vods(1)
+    assert koudai.resolve_member_vods(vods) == []
+    assert vods[0].vod_url
+    assert stub_api.request_count == 3
+
+
+def test_call_api_gives_up_after_max_attempts(stub_api, monkeypatch):
+    monkeypatch.setattr(koudai, "API_BACKOFF_BASE", 0.01)
+    stub_api.transient_failures = koudai.API_MAX_ATTEMPTS
+    errors = koudai.resolve_member_vods(make_member_vods(1))
+    assert len(errors) == 1
+    assert stub_api.request_count == koudai.API_MAX_ATTEMPTS
+
+
+def test_call_api_deadline(stub_api, monkeypatch):
+    monkeypatch.setattr(koudai, "API_BACKOFF_BASE", 0.01)
+    koudai.set_api_deadline(1e-6)
+    try:
+        time.sleep(0.01)
+        errors = koudai.resolve_member_vods(make_member_vods(1))
+    finally:
+        koudai.set_api_deadline(None)
+    assert len(errors) == 1
+    assert stub_api.request_count == 0
+
+
+def test_connections_are_reused(stub_api):
+    vods = make_member_vods(40)
+    assert koudai.resolve_member_vods(vods, workers=4) == []
+    assert stub_api.request_count == 40
+    assert len(stub_api.client_ports) <= 4
+
+
+def test_list_member_vods_incremental_with_index(stub_api):
+    day_ms = 86400 * 1000
+    now_ms = int(time.time() * 1000)
+    # Two VODs a day for the past 30 days, starting a day ago so that
+    # all of them are settled.
+    stub_api.member_vods = [
+        make_member_vod_obj("%024d" % i, now_ms - day_ms - i * day_ms // 2)
+        for i in range(60)
+    ]
+    to_ = arrow.get(now_ms / 1000)
+    from_ = to_.shift(days=-20)
+
+    def list_ids():
+        return [
+            vod.id
+            for vod in koudai.list_member_vods(from_, to_, group_id=10, use_index=True)
+        ]
+
+    from_ms = from_.float_timestamp * 1000
+    expected = [v["liveId"] for v in stub_api.member_vods if int(v["ctime"]) >= from_ms]
+    assert len(expected) == 39
+    assert list_ids() == expected
+    assert stub_api.list_requests == 2
+
+    stub_api.list_requests = 0
+    assert list_ids() == expected
+    assert stub_api.list_requests == 1
+
+    # New VODs show up at the front.
+    stub_api.member_vods.insert(0, make_member_vod_obj("new", now_ms - 3600 * 1000))
+    stub_api.list_requests = 0
+    assert list_ids() == ["new"] + expected
+    assert stub_api.list_requests == 1
+
+
+def test_list_member_vods_without_index(stub_api):
+    now_ms = int(time.time() * 1000)
+    stub_api.member_vods = [
+        make_member_vod_obj("%024d" % i, now_ms - i * 3600 * 1000) for i in range(30)
+    ]
+    to_ = arrow.get(now_ms / 1000 + 1)
+    from_ = to_.shift(days=-2)
+    for _ in range(2):
+        stub_api.list_requests = 0
+        assert len(list(koudai.list_member_vods(from_, to_, group_id=10))) == 30
+        assert stub_api.list_requests == 3
+
+
+def test_resolve_cache(stub_api):
+    vods = make_member_vods(4)
+    assert koudai.resolve_member_vods(vods[:2], use_cache=True) == []
+    assert stub_api.request_count == 2
+
+    stub_api.request_count = 0
+    vods = make_member_vods(4)
+    assert koudai.resolve_member_vods(vods, use_cache=True) == []
+    assert stub_api.request_count == 2
+    assert all(vod.vod_url and vod.danmaku_url for vod in vods)
+
+    stub_api.request_count = 0
+    assert koudai.resolve_member_vods(make_member_vods(4), use_cache=True) == []
+    assert stub_api.request_count == 0
+
+    # Failures are not cached.
+    stub_api.failing_ids = {"%024d" % 4}
+    assert len(koudai.resolve_member_vods(make_member_vods(5), use_cache=True)) == 1
+    assert len(koudai.resolve_member_vods(make_member_vods(5), use_cache=True)) == 1
+
+
+def test_resolve_cache_ttl_and_invalidation(stub_api, monkeypatch):
+    assert koudai.resolve_member_vods(make_member_vods(2), use_cache=True) == []
+    stub_api.request_count = 0
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 3600)
+    vods = make_member_vods(2)
+    assert koudai.resolve_member_vods(vods, use_cache=True, cache_ttl=60) == []
+    assert stub_api.request_count == 2
+
+    stub_api.request_count = 0
+    persistence.invalidate_resolved_urls("member", [vods[0].id])
+    assert koudai.resolve_member_vods(make_member_vods(2), use_cache=True) == []
+    assert stub_api.request_count == 1
+
+
+def test_list_vods_of_members(stub_api):
+    now_ms = int(time.time() * 1000)
+    stub_api.member_vods = [
+        make_member_vod_obj(
+            "%024d" % i,
+            now_ms - i * 3600 * 1000,
+            member_id=100 + i % 3,
+            nickname="SNH48-成员%d" % (i % 3),
+        )
+        for i in range(60)
+    ]
+    to_ = arrow.get(now_ms / 1000 + 1)
+    from_ = to_.shift(days=-1)
+    vods = list(koudai.list_member_vods(from_, to_))
+    assert len(vods) == 24
+    assert persistence.get_member_ids(["成员0", "成员2", "成员3"]) == {
+        "成员0": 100,
+        "成员2": 102,
+    }
+
+    vods = list(koudai.list_vods_of_members(from_, to_, [100, 102]))
+    assert [vod.id for vod in vods] == [
+        "%024d" % i for i in range(24) if i % 3 in (0, 2)
+    ]
+
+
+
+def test_list_vods_of_members_streams(stub_api):
+    now_ms = int(time.time() * 1000)
+    stub_api.member_vods = [
+        make_member_vod_obj("%024d" % i, now_ms - i * 60 * 1000, member_id=100 + i % 3)
+        for i in range(300)
+    ]
+    stub_api.page_size = 10
+    stub_api.latency = 0.05
+    to_ = arrow.get(now_ms / 1000 + 1)
+    vods = koudai.list_vods_of_members(to_.shift(days=-1), to_, [100, 101, 102])
+    # The first VOD comes out once the first page of each member is in,
+    # long before listings are complete (10 full pages and an empty one
+    # for each member).
+    assert next(vods).id == "%024d" % 0
+    assert stub_api.list_requests < 33 / 2
+    assert [vod.id for vod in vods] == ["%024d" % i for i in range(1, 300)]
+    assert stub_api.list_requests == 33
+
+
+def test_list_perf_vods_dedups_overlapping_pages(stub_api):
+    now_ms = int(time.time() * 1000)
+    stub_api.perf_vods = [
+        make_perf_vod_obj("%018d" % i, now_ms - i * 3600 * 1000) for i in range(50)
+    ]
+    stub_api.duplicate_rate = 1
+    to_ = arrow.get(now_ms / 1000 + 1)
+    vods = list(koudai.list_perf_vods(to_.shift(days=-10), to_))
+    assert [vod.id for vod in vods] == ["%018d" % i for i in range(50)]
+    assert all(vod.name == "美丽48区" for vod in vods)
+
+
+def test_list_member_vods_with_injected_errors(stub_api, monkeypatch):
+    monkeypatch.setattr(koudai, "API_BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(koudai, "API_MAX_ATTEMPTS", 20)
+    now_ms = int(time.time() * 1000)
+    stub_api.member_vods = [
+        make_member_vod_obj("%024d" % i, now_ms - i * 3600 * 1000) for i in range(100)
+    ]
+    stub_api.error_rate = 0.3
+    to_ = arrow.get(now_ms / 1000 + 1)
+    vods = list(koudai.list_member_vods(to_.shift(days=-10), to_))
+    assert len(vods) == 100
+    # 5 full pages and an empty one, plus retries.
+    assert stub_api.request_count > 6
+
+
+def test_call_api_adapts_to_throttling(stub_api, monkeypatch):
+    monkeypatch.setattr(koudai, "API_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(koudai, "API_MAX_ATTEMPTS", 20)
+    monkeypatch.setattr(koudai, "API_RATE_LIMIT", None)
+    koudai.reset_api_flow_control()
+    stub_api.error_statuses = (429,)
+    stub_api.error_rate = 0.5
+    assert koudai.resolve_member_vods(make_member_vods(40), workers=8) == []
+    stats = koudai.get_api_stats()
+    assert stats["throttled"] > 0
+    assert stats["window_decreases"] > 0
+    assert stats["window"] < koudai.API_WINDOW_INITIAL
+    assert stats["open_circuits"] == []
+
+    # Window grows back while the server is healthy.
+    stub_api.error_rate = 0
+    window = stats["window"]
+    assert koudai.resolve_member_vods(make_member_vods(40), workers=8) == []
+    assert koudai.get_api_stats()["window"] > window
+
+
+def test_call_api_circuit_breaker(stub_api, monkeypatch):
+    monkeypatch.setattr(koudai, "API_BACKOFF_BASE", 0.001)
+    monkeypatch.setattr(koudai, "API_CIRCUIT_THRESHOLD", 3)
+    koudai.reset_api_flow_control()
+    stub_api.transient_failures = 100
+    errors = koudai.resolve_member_vods(make_member_vods(5), workers=1)
+    assert len(errors) == 5
+    assert all(isinstance(exc._exc, koudai.APICircuitOpen) for _, exc in errors)
+    assert stub_api.request_count == 3
+    stats = koudai.get_api_stats()
+    assert stats["circuit_rejections"] == 5
+    assert stats["open_circuits"] == [koudai.MEMBER_VOD_RESOLVE_URL]
+
+
+def test_hedged_resolution_cuts_stragglers(stub_api, monkeypatch):
+    monkeypatch.setattr(koudai, "API_RATE_LIMIT", None)
+    # Room for hedges alongside stalled requests, whatever the order in
+    # which requests complete.
+    monkeypatch.setattr(koudai, "API_WINDOW_INITIAL", koudai.API_WINDOW_MAX)
+    monkeypatch.setattr(koudai, "API_HEDGE_MAX_RATIO", 1)
+    koudai.reset_api_flow_control()
+
+    # Fixed latency estimate, so that hedges are sent after 0.5 seconds
+    # regardless of the measured latency of the mock server.
+    class FixedLatency(koudai.LatencyTracker):
+        def __len__(self):
+            return koudai.API_HEDGE_MIN_SAMPLES
+
+        def percentile(self, p):
+            return 0.5
+
+    monkeypatch.setattr(koudai, "_api_latency", lambda endpoint: FixedLatency())
+
+    # Losing requests are waited for before resolution returns.
+    stragglers = []
+    join_api_stragglers = koudai._join_api_stragglers
+
+    def join_and_record_stragglers():
+        stragglers.extend(koudai._api_stragglers)
+        join_api_stragglers()
+
+    monkeypatch.setattr(koudai, "_join_api_stragglers", join_and_record_stragglers)
+
+    stub_api.hang_time = 2
+    stalled = (10, 30, 50, 70, 90)
+    for hedging in (False, True):
+        koudai.set_api_hedging(hedging)
+        vods = make_member_vods(100)
+        stub_api.stalled_ids = {vods[i].id for i in stalled}
+        assert koudai.resolve_member_vods(vods, workers=4) == []
+        assert stub_api.stalled_ids == set()
+        stats = koudai.get_api_stats()
+        if not hedging:
+            assert stats["hedgeable"] == stats["hedged"] == 0
+    koudai.set_api_hedging(True)
+
+    # Each stalled request was hedged, and the hedge answered first.
+    assert stats["hedgeable"] == 100
+    assert stats["hedged"] >= len(stalled)
+    assert stats["hedge_wins"] >= len(stalled)
+    assert len(stragglers) >= 2 * len(stalled)
+    assert not any(thread.is_alive() for thread in stragglers)
+
+
+def test_list_member_vods_fans_out_groups(stub_api):
+    now_ms = int(time.time() * 1000)
+    stub_api.member_vods = [
+        make_member_vod_obj(
+            "%024d" % i, now_ms - i * 600 * 1000, group_id=10 + i % 5, team_id=0
+        )
+        for i in range(200)
+    ]
+    stub_api.latency = 0.05
+    to_ = arrow.get(now_ms / 1000 + 1)
+    from_ = to_.shift(days=-2)
+    expected = ["%024d" % i for i in range(200)]
+
+    start = time.time()
+    vods = list(koudai.list_member_vods(from_, to_, fan_out=False))
+    serial = time.time() - start
+    assert [vod.id for vod in vods] == expected
+
+    stub_api.list_requests = 0
+    start = time.time()
+    vods = list(koudai.list_member_vods(from_, to_))
+    parallel = time.time() - start
+    assert [vod.id for vod in vods] == expected
+    # 2 full pages and an empty one for each group.
+    assert stub_api.list_requests == 15
+    assert parallel < serial / 2
+
+
+def test_list_perf_vods_fans_out_groups_without_duplicates(stub_api):
+    now_ms = int(time.time() * 1000)
+    stub_api.perf_vods = [
+        make_perf_vod_obj("%018d" % i, now_ms - i * 3600 * 1000, group_id=10 + i % 5)
+        for i in range(100)
+    ]
+    # A joint performance listed under two groups.
+    joint = dict(stub_api.perf_vods[50], groupId="11")
+    stub_api.perf_vods.insert(51, joint)
+    stub_api.duplicate_rate = 0.5
+    to_ = arrow.get(now_ms / 1000 + 1)
+    vods = list(koudai.list_perf_vods(to_.shift(days=-10), to_))
+    assert [vod.id for vod in vods] == ["%018d" % i for i in range(100)]
+
+
+def test_list_member_vods_seeks_cursor_checkpoints(stub_api):
+    hour_ms = 3600 * 1000
+    now_ms = int(time.time() * 1000)
+    stub_api.member_vods = [
+        make_member_vod_obj("%024d" % i, now_ms - i * hour_ms) for i in range(500)
+    ]
+
+    def list_ids(from_ms, to_ms):
+        return [
+            vod.id
+            for vod in koudai.list_member_vods(
+                arrow.get(from_ms / 1000), arrow.get(to_ms / 1000), group_id=10
+            )
+        ]
+
+    def expected_ids(from_ms, to_ms):
+        return [
+            v["liveId"]
+            for v in stub_api.member_vods
+            if from_ms <= int(v["ctime"]) < to_ms
+        ]
+
+    # The first listing of the past 20 days pages from the top.
+    assert list_ids(now_ms - 480 * hour_ms, now_ms + 1000) == expected_ids(
+        now_ms - 480 * hour_ms, now_ms + 1000
+    )
+    assert stub_api.list_requests == 25
+
+    # New VODs don't invalidate checkpoints.
+    stub_api.member_vods.insert(0, make_member_vod_obj("new", now_ms + hour_ms))
+
+    # A day, 15 days ago, takes pages proportional to the window.
+    from_ms, to_ms = now_ms - 360 * hour_ms, now_ms - 336 * hour_ms
+    stub_api.list_requests = 0
+    assert list_ids(from_ms, to_ms) == expected_ids(from_ms, to_ms)
+    assert stub_api.list_requests <= 3
+
+    # Stale checkpoints (cursors no longer recognized) are discarded.
+    checkpoint = persistence.find_list_checkpoint("member", "0:0:10", to_ms)
+    stub_api.member_vods = [
+        v for v in stub_api.member_vods if v["liveId"] != checkpoint[0]
+    ]
+    stub_api.list_requests = 0
+    assert list_ids(from_ms, to_ms) == expected_ids(from_ms, to_ms)
+    assert stub_api.list_requests > 3
+    assert persistence.find_list_checkpoint("member", "0:0:10", to_ms) != checkpoint
+
+
+def test_list_perf_vods_seeks_cursor_checkpoints(stub_api):
+    day_ms = 86400 * 1000
+    now_ms = int(time.time() * 1000)
+    stub_api.perf_vods = [
+        make_perf_vod_obj("%018d" % i, now_ms - i * day_ms) for i in range(300)
+    ]
+    to_ = arrow.get(now_ms / 1000 + 1)
+    assert len(list(koudai.list_perf_vods(to_.shift(days=-300), to_, group_id=10))) == 300
+    stub_api.list_requests = 0
+    vods = list(
+        koudai.list_perf_vods(to_.shift(days=-250), to_.shift(days=-240), group_id=10)
+    )
+    assert [vod.id for vod in vods] == ["%018d" % i for i in range(240, 250)]
+    assert stub_api.list_requests <= 2
@@ -0,0 +1,519 @@
+import datetime
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import arrow
+import pytest
+
+from kvm48 import aria2, bandwidth, caterpillar, jobs, kvm48, persistence
+from kvm48.config import Config
+
+from conftest import make_member_vod_obj
+from mockaria2 import MockAria2Server
+
+
+def day(s):
+    return arrow.get(s, tzinfo="Asia/Shanghai")
+
+
+def day_ms(s, hour=20):
+    return int(day(s).shift(hours=hour).float_timestamp * 1000)
+
+
+@pytest.fixture
+def conf(tmp_path):
+    conf = Config()
+    conf._group_id = 10
+    conf._directory = str(tmp_path / "downloads")
+    conf.names = ["莫寒"]
+    os.makedirs(conf._directory)
+    return conf
+
+
+# Stand-in for aria2c: creates the files listed in the manifest, unless
+# the manifest name contains one of the failing tags.
+@pytest.fixture
+def fake_aria2(monkeypatch):
+    manifests = []
+    failing_tags = set()
+
+    def download(manifest, *, log_prefix=None, log_file=None):
+        manifests.append(os.path.basename(manifest))
+        if any(tag in manifest for tag in failing_tags):
+            return 1
+        with open(manifest, encoding="utf-8") as fp:
+            lines = fp.read().splitlines()
+        directory = None
+        for line in lines:
+            if line.startswith("\tdir="):
+                directory = line[5:]
+            elif line.startswith("\tout="):
+                with open(os.path.join(directory, line[5:]), "wb"):
+                    pass
+        return 0
+
+    monkeypatch.setattr(aria2, "download", download)
+    monkeypatch.setattr(jobs.time, "sleep", lambda _: None)
+    return manifests, failing_tags
+
+
+def test_plan_backfill_windows():
+    windows = kvm48.plan_backfill_windows(day("2019-01-01"), day("2019-01-17"), 7)
+    assert [(str(a.date()), str(b.date())) for a, b in windows] == [
+        ("2019-01-01", "2019-01-07"),
+        ("2019-01-08", "2019-01-14"),
+        ("2019-01-15", "2019-01-17"),
+    ]
+    windows = kvm48.plan_backfill_windows(day("2019-01-01"), day("2019-01-01"), 7)
+    assert len(windows) == 1
+
+
+def test_backfill_resumes_at_incomplete_windows(stub_api, conf, fake_aria2):
+    manifests, failing_tags = fake_aria2
+    stub_api.member_vods = [
+        make_member_vod_obj("c" * 24, day_ms("2019-01-16")),
+        make_member_vod_obj("b" * 24, day_ms("2019-01-09")),
+        make_member_vod_obj("x" * 24, day_ms("2019-01-05"), 36, "SNH48-张语格"),
+        make_member_vod_obj("a" * 24, day_ms("2019-01-02")),
+    ]
+    from_, to_ = day("2019-01-01"), day("2019-01-17")
+
+    failing_tags.add("20190108")
+    assert kvm48.backfill(conf, from_, to_, window_days=7) == 1
+    assert manifests[0] == "aria2-20190101-20190107.txt"
+    assert len(os.listdir(conf.directory)) == 3  # 2 files + failed manifest
+    windows = persistence.get_backfill_windows(kvm48.backfill_scope(conf))
+    assert {key: window["status"] for key, window in windows.items()} == {
+        ("2019-01-01", "2019-01-07"): "done",
+        ("2019-01-08", "2019-01-14"): "failed",
+        ("2019-01-15", "2019-01-17"): "done",
+    }
+    assert windows[("2019-01-01", "2019-01-07")]["vods"] == 1
+
+    failing_tags.clear()
+    manifests.clear()
+    stub_api.list_requests = 0
+    assert kvm48.backfill(conf, from_, to_, window_days=7) == 0
+    assert manifests == ["aria2-20190108-20190114.txt"]
+    assert stub_api.list_requests == 1
+    assert sorted(os.listdir(conf.directory)) == [
+        "20190102 莫寒口袋直播 直播 aaaaaaaaaaaaaaaaaaaaaaaa.mp4",
+        "20190109 莫寒口袋直播 直播 bbbbbbbbbbbbbbbbbbbbbbbb.mp4",
+        "20190116 莫寒口袋直播 直播 cccccccccccccccccccccccc.mp4",
+    ]
+
+    # Backfill progress is per set of monitored members.
+    conf.names = ["莫寒", "张语格"]
+    assert persistence.get_backfill_windows(kvm48.backfill_scope(conf)) == {}
+
+
+def test_backfill_deduplicates_filenames_across_windows(stub_api, conf, fake_aria2):
+    manifests, failing_tags = fake_aria2
+    conf.naming = "%(name)s %(type)s.%(ext)s"
+    stub_api.member_vods = [
+        make_member_vod_obj("b" * 24, day_ms("2019-01-09")),
+        make_member_vod_obj("a" * 24, day_ms("2019-01-02")),
+    ]
+    from_, to_ = day("2019-01-01"), day("2019-01-14")
+
+    failing_tags.add("20190101")
+    assert kvm48.backfill(conf, from_, to_, window_days=7) == 1
+    assert sorted(os.listdir(conf.directory)) == [
+        "aria2-20190101-20190107.txt",
+        "莫寒 直播 (1).mp4",
+    ]
+    assert persistence.get_backfill_filepaths(kvm48.backfill_scope(conf)) == {
+        ("2019-01-01", "2019-01-07"): {"莫寒 直播.mp4"},
+        ("2019-01-08", "2019-01-14"): {"莫寒 直播 (1).mp4"},
+    }
+
+    # The rerun plans the failed window against the filename taken by
+    # the completed one, instead of mistaking it for its own download.
+    failing_tags.clear()
+    manifests.clear()
+    assert kvm48.backfill(conf, from_, to_, window_days=7) == 0
+    assert manifests == ["aria2-20190101-20190107.txt"]
+    assert sorted(os.listdir(conf.directory)) == ["莫寒 直播 (1).mp4", "莫寒 直播.mp4"]
+
+
+def test_finished_vods_are_determined_without_unresolved_vods(
+    stub_api, conf, fake_aria2
+):
+    conf.naming = "%(name)s %(type)s.%(ext)s"
+    stub_api.member_vods = [
+        make_member_vod_obj("b" * 24, day_ms("2019-01-03")),
+        make_member_vod_obj("a" * 24, day_ms("2019-01-02")),
+    ]
+    stub_api.failing_ids.add("a" * 24)
+    # The target of bbbb... if aaaa... were downloaded as well.
+    open(os.path.join(conf.directory, "莫寒 直播 (1).mp4"), "wb").close()
+
+    from_, to_ = day("2019-01-01"), day("2019-01-07")
+    vod_list, source_exts, resolve_errors, peeked_sizes = kvm48.search_member_vods(
+        conf, from_, to_
+    )
+    assert [vod.id for vod, _ in resolve_errors] == ["a" * 24]
+    assert [vod.id for vod in vod_list] == ["b" * 24]
+    assert vod_list[0].vod_url is not None
+    _, _, downloaded_files = kvm48.download_vods(
+        conf, vod_list, source_exts=source_exts, peeked_sizes=peeked_sizes
+    )
+    assert downloaded_files == [os.path.join(conf.directory, "莫寒 直播.mp4")]
+
+
+def test_backfill_dry_run_records_nothing(stub_api, conf, fake_aria2):
+    manifests, _ = fake_aria2
+    stub_api.member_vods = [make_member_vod_obj("a" * 24, day_ms("2019-01-02"))]
+    from_, to_ = day("2019-01-01"), day("2019-01-14")
+    assert kvm48.backfill(conf, from_, to_, window_days=7, dry=True) == 0
+    assert manifests == []
+    assert persistence.get_backfill_windows(kvm48.backfill_scope(conf)) == {}
+
+
+def test_watch_polls_only_new_vods(stub_api, conf, fake_aria2):
+    manifests, failing_tags = fake_aria2
+    now_ms = int(arrow.now().float_timestamp * 1000)
+    hour_ms = 3600 * 1000
+    stub_api.member_vods = [make_member_vod_obj("a" * 24, now_ms - 3 * hour_ms)]
+    state = kvm48.WatchState(arrow.now("Asia/Shanghai").shift(days=-1))
+
+    kvm48.watch_poll(conf, state)
+    assert manifests == ["aria2-watch.txt"]
+    assert list(state.seen) == ["a" * 24]
+    assert state.lower_bound() > state.since
+
+    # Nothing new, nothing to download.
+    kvm48.watch_poll(conf, state)
+    assert len(manifests) == 1
+
+    # Failed downloads are retried in the next poll.
+    stub_api.member_vods.insert(0, make_member_vod_obj("b" * 24, now_ms - hour_ms))
+    failing_tags.add("watch")
+    kvm48.watch_poll(conf, state)
+    assert len(manifests) == 4  # 3 attempts
+    assert list(state.seen) == ["a" * 24]
+    failing_tags.clear()
+    kvm48.watch_poll(conf, state)
+    assert len(manifests) == 5
+    assert sorted(state.seen) == ["a" * 24, "b" * 24]
+    assert len(os.listdir(conf.directory)) == 2
+
+
+def test_watch_exits_on_sigterm(stub_api, conf, tmp_path, monkeypatch):
+    config_file = tmp_path / "config.yml"
+    config_file.write_text("names:\n- 莫寒\ndirectory: %s\n" % conf.directory)
+    conf.watch_interval = 0.2
+    polls = []
+
+    def watch_poll(conf, state, *, dry=False):
+        polls.append(conf.watch_interval)
+        if len(polls) == 1:
+            # Config changes are picked up in the next poll.
+            config_file.write_text(config_file.read_text() + "watch_interval: 0.1\n")
+            os.utime(config_file, (0, 0))
+        elif len(polls) == 3:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    monkeypatch.setattr(kvm48, "watch_poll", watch_poll)
+    handler = signal.getsignal(signal.SIGTERM)
+    try:
+        assert kvm48.watch(conf, str(config_file), arrow.now(), dry=True) == 0
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+    assert polls == [0.2, 0.1, 0.1]
+
+
+def test_direct_and_m3u8_downloads_run_concurrently(stub_api, conf, monkeypatch):
+    # Each fake backend waits for the other one to start.
+    barrier = threading.Barrier(2, timeout=5)
+    prefixes = []
+
+    def download(manifest, *, log_prefix=None, on_line=None, log_file=None):
+        prefixes.append(log_prefix)
+        barrier.wait()
+        with open(manifest, encoding="utf-8") as fp:
+            for line in fp:
+                if line.startswith("http") and "\t" in line:
+                    _, filepath = line.rstrip("\n").split("\t")
+                    open(filepath, "wb").close()
+                elif line.startswith("\tout="):
+                    open(os.path.join(conf.directory, line[5:].strip()), "wb").close()
+        return 0
+
+    monkeypatch.setattr(aria2, "download", download)
+    monkeypatch.setattr(caterpillar, "download", download)
+    monkeypatch.setattr(caterpillar, "check_caterpillar_requirement", lambda: True)
+    stub_api.member_vods = [
+        make_member_vod_obj("b" * 24, day_ms("2019-01-02", 21), live_type=2),
+        make_member_vod_obj("a" * 24, day_ms("2019-01-02")),
+    ]
+    vod_list, source_exts, _, peeked_sizes = kvm48.search_member_vods(
+        conf, day("2019-01-02"), day("2019-01-02")
+    )
+    a2_failed, m3u8_failed, downloaded_files = kvm48.download_vods(
+        conf, vod_list, source_exts=source_exts, peeked_sizes=peeked_sizes
+    )
+    assert sorted(prefixes) == ["aria2", "caterpillar"]
+    assert a2_failed == m3u8_failed == []
+    assert [os.path.basename(path) for path in downloaded_files] == [
+        "20190102 莫寒口袋直播 直播 aaaaaaaaaaaaaaaaaaaaaaaa.mp4",
+        "20190102 莫寒口袋电台 直播 bbbbbbbbbbbbbbbbbbbbbbbb.mp4",
+    ]
+
+
+def test_download_vods_with_aria2_rpc(stub_api, conf, monkeypatch):
+    monkeypatch.setattr(aria2, "_rpc_client", None)
+    monkeypatch.setattr(aria2, "RPC_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(jobs, "BACKOFF_BASE", 0.01)
+    stub_api.member_vods = [
+        make_member_vod_obj("b" * 24, day_ms("2019-01-02", 21)),
+        make_member_vod_obj("a" * 24, day_ms("2019-01-02")),
+    ]
+    vod_list, source_exts, _, peeked_sizes = kvm48.search_member_vods(
+        conf, day("2019-01-02"), day("2019-01-02")
+    )
+    with MockAria2Server() as aria2_server:
+        aria2_server.fail_counts = {vod_list[1].vod_url: 3}
+        conf.aria2_rpc = aria2_server.rpc_url
+        a2_failed, _, downloaded_files = kvm48.download_vods(
+            conf, vod_list, source_exts=source_exts, peeked_sizes=peeked_sizes
+        )
+    assert [url for url, _ in a2_failed] == [vod_list[1].vod_url]
+    assert [os.path.basename(path) for path in downloaded_files] == [
+        "20190102 莫寒口袋直播 直播 aaaaaaaaaaaaaaaaaaaaaaaa.mp4"
+    ]
+    # The failed download is left in the manifest for manual retries.
+    with open(os.path.join(conf.directory, "aria2.txt"), encoding="utf-8") as fp:
+        assert fp.readline().strip() == vod_list[1].vod_url
+
+
+def test_aria2_targets_are_retried_individually(stub_api, conf, monkeypatch):
+    stub_api.member_vods = [
+        make_member_vod_obj("c" * 24, day_ms("2019-01-02", 22)),
+        make_member_vod_obj("b" * 24, day_ms("2019-01-02", 21)),
+        make_member_vod_obj("a" * 24, day_ms("2019-01-02")),
+    ]
+    vod_list, source_exts, _, peeked_sizes = kvm48.search_member_vods(
+        conf, day("2019-01-02"), day("2019-01-02")
+    )
+    gone_url, flaky_url = vod_list[1].vod_url, vod_list[2].vod_url
+    rounds = []
+
+    # The first VOD downloads fine; the second one is gone; the third
+    # one fails once without any error attributed to it.
+    def download(manifest, *, log_prefix=None, log_file=None):
+        with open(manifest, encoding="utf-8") as fp:
+            lines = fp.read().splitlines()
+        urls = [line for line in lines if not line.startswith("\t")]
+        rounds.append(urls)
+        directory = None
+        for line in lines:
+            if line.startswith("http"):
+                url = line
+            elif line.startswith("\tdir="):
+                directory = line[5:]
+            elif line.startswith("\tout="):
+                if url == gone_url:
+                    with open(log_file, "a", encoding="utf-8") as fp:
+                        fp.write(
+                            "[ERROR] CUID#7 - Download aborted. URI=%s\n"
+                            "  -> [Http.cc:1] errorCode=3 Resource not found\n" % url
+                        )
+                elif url == flaky_url and len(rounds) == 1:
+                    pass
+                else:
+                    open(os.path.join(directory, line[5:]), "wb").close()
+        return 3
+
+    monkeypatch.setattr(aria2, "download", download)
+    monkeypatch.setattr(jobs.time, "sleep", lambda _: None)
+    a2_failed, _, downloaded_files = kvm48.download_vods(
+        conf, vod_list, source_exts=source_exts, peeked_sizes=peeked_sizes
+    )
+    # Only the flaky VOD is retried; the gone one isn't.
+    assert len(rounds) == 2
+    assert rounds[1] == [flaky_url]
+    assert [url for url, _ in a2_failed] == [gone_url]
+    assert len(downloaded_files) == 2
+    # The error log is read and removed after each round.
+    assert not os.path.exists(os.path.join(conf.directory, "aria2.log"))
+
+
+def test_download_vods_with_builtin_downloaders(
+    stub_api, conf, monkeypatch, fake_ffmpeg
+):
+    conf.direct_downloader = "builtin"
+    conf.m3u8_downloader = "builtin"
+    stub_api.member_vods = [
+        make_member_vod_obj("c" * 24, day_ms("2019-01-02", 22), live_type=2),
+        make_member_vod_obj("b" * 24, day_ms("2019-01-02", 21)),
+        make_member_vod_obj("a" * 24, day_ms("2019-01-02")),
+    ]
+    vod_list, source_exts, _, peeked_sizes = kvm48.search_member_vods(
+        conf, day("2019-01-02"), day("2019-01-02")
+    )
+    # Manifests left by an earlier failed run are removed on success.
+    for name in ("aria2.txt", "m3u8.txt"):
+        open(os.path.join(conf.directory, name), "w").close()
+    a2_failed, m3u8_failed, downloaded_files = kvm48.download_vods(
+        conf, vod_list, source_exts=source_exts, peeked_sizes=peeked_sizes
+    )
+    assert a2_failed == m3u8_failed == []
+    assert sorted(os.listdir(conf.directory)) == [
+        "20190102 莫寒口袋电台 直播 cccccccccccccccccccccccc.mp4",
+        "20190102 莫寒口袋直播 直播 aaaaaaaaaaaaaaaaaaaaaaaa.mp4",
+        "20190102 莫寒口袋直播 直播 bbbbbbbbbbbbbbbbbbbbbbbb.mp4",
+    ]
+    assert len(downloaded_files) == 3
+
+
+def test_caterpillar_jobs_run_concurrently(conf, monkeypatch):
+    conf.caterpillar_jobs = 3
+    targets = [("http://example.com/%d.m3u8" % i, "%d.mp4" % i) for i in range(4)]
+    manifest = os.path.join(conf.directory, "m3u8.txt")
+    barrier = threading.Barrier(3, timeout=5)
+    lock = threading.Lock()
+    calls = []
+
+    # Each process downloads its own target; the first three wait for
+    # each other; 3.mp4 keeps failing.
+    def download(
+        manifest, *, log_prefix=None, on_line=None, log_file=None, timeout=None
+    ):
+        with open(manifest, encoding="utf-8") as fp:
+            lines = fp.read().splitlines()
+        assert len(lines) == 1
+        url, filepath = lines[0].split("\t")
+        with lock:
+            calls.append(url)
+        with open(log_file, "w", encoding="utf-8") as fp:
+            fp.write("log of %s\n" % url)
+        if url.endswith("3.m3u8"):
+            on_line("[ERROR] HTTP error 404 Not Found")
+            return 1
+        barrier.wait()
+        open(filepath, "wb").close()
+        return 0
+
+    monkeypatch.setattr(caterpillar, "download", download)
+    monkeypatch.setattr(caterpillar, "check_caterpillar_requirement", lambda: True)
+    monkeypatch.setattr(jobs.time, "sleep", lambda _: None)
+    failed, downloaded = kvm48.caterpillar_phase(conf, targets, manifest)
+    assert failed == [targets[3]]
+    # Errors scraped from caterpillar output are reported, but never
+    # taken as permanent.
+    assert len(calls) == 3 + jobs.DEFAULT_MAX_ATTEMPTS
+    assert sorted(os.path.basename(path) for path in downloaded) == [
+        "0.mp4",
+        "1.mp4",
+        "2.mp4",
+    ]
+    # The work directory with per-target manifests and logs is kept for
+    # inspection, as is the manifest of failed targets.
+    assert sorted(os.listdir(os.path.join(conf.directory, "m3u8.d"))) == [
+        "0001.log",
+        "0001.txt",
+        "0002.log",
+        "0002.txt",
+        "0003.log",
+        "0003.txt",
+        "0004.log",
+        "0004.txt",
+    ]
+    with open(manifest, encoding="utf-8") as fp:
+        assert fp.read().startswith(targets[3][0])
+
+
+def test_bandwidth_budget_spans_concurrent_downloads(
+    stub_api, conf, monkeypatch, fake_ffmpeg
+):
+    monkeypatch.setattr(aria2, "_rpc_client", None)
+    monkeypatch.setattr(aria2, "RPC_POLL_INTERVAL", 0.01)
+    stub_api.mp4_size = 256 * 1024
+    stub_api.segment_size = 32 * 1024
+    stub_api.segments = 8
+    limit = 512 * 1024
+    conf.m3u8_downloader = "builtin"
+    conf.bandwidth = bandwidth.Schedule(limit)
+    stub_api.member_vods = [
+        make_member_vod_obj("b" * 24, day_ms("2019-01-02", 21), live_type=2),
+        make_member_vod_obj("a" * 24, day_ms("2019-01-02")),
+    ]
+    vod_list, source_exts, _, peeked_sizes = kvm48.search_member_vods(
+        conf, day("2019-01-02"), day("2019-01-02")
+    )
+    with MockAria2Server() as aria2_server:
+        conf.aria2_rpc = aria2_server.rpc_url
+        start = time.monotonic()
+        a2_failed, m3u8_failed, downloaded_files = kvm48.download_vods(
+            conf, vod_list, source_exts=source_exts, peeked_sizes=peeked_sizes
+        )
+        elapsed = time.monotonic() - start
+    assert a2_failed == m3u8_failed == []
+    assert len(downloaded_files) == 2
+    # aria2 and the builtin HLS downloader split the budget, so that
+    # together they download no faster than the limit.
+    assert aria2_server.global_option_changes[0] == {
+        "max-overall-download-limit": str(limit // 2)
+    }
+    assert (256 * 1024 * 2) / elapsed < limit * 1.2
+
+
+def test_caterpillar_phase_within_bandwidth_budget(
+    stub_api, conf, monkeypatch, fake_ffmpeg
+):
+    conf.bandwidth = bandwidth.Schedule(
+        64 * 1024 * 1024, [bandwidth.parse_window("01:00-08:00 unlimited")]
+    )
+    manifest = os.path.join(conf.directory, "m3u8.txt")
+    calls = []
+
+    now = datetime.datetime(2019, 1, 2, 12, 0)
+    timeouts = []
+
+    # Interrupted after 60 seconds if the limit would take effect by then.
+    def download(
+        manifest, *, log_prefix=None, on_line=None, log_file=None, timeout=None
+    ):
+        nonlocal now
+        with open(manifest, encoding="utf-8") as fp:
+            url, filepath = fp.read().strip().split("\t")
+        calls.append(url)
+        timeouts.append(timeout)
+        if timeout is not None and timeout <= 60:
+            now += datetime.timedelta(seconds=timeout)
+            raise subprocess.TimeoutExpired(["caterpillar"], timeout)
+        open(filepath, "wb").close()
+        return 0
+
+    monkeypatch.setattr(caterpillar, "download", download)
+    monkeypatch.setattr(caterpillar, "check_caterpillar_requirement", lambda: True)
+    monkeypatch.setattr(bandwidth, "_now", lambda: now)
+    urls = [stub_api.base_url + "/resource/hls/%s/media.m3u8" % id for id in "xyz"]
+
+    # With a limit in effect, caterpillar is passed over.
+    failed, downloaded = kvm48.caterpillar_phase(conf, [(urls[0], "x.mp4")], manifest)
+    assert failed == [] and len(downloaded) == 1
+    assert calls == []
+    assert os.path.getsize(downloaded[0]) == stub_api.segment_size * stub_api.segments
+
+    # At full speed, caterpillar is used, until the limit takes effect.
+    now = datetime.datetime(2019, 1, 2, 2, 0)
+    failed, downloaded = kvm48.caterpillar_phase(conf, [(urls[1], "y.mp4")], manifest)
+    assert failed == [] and len(downloaded) == 1
+    assert calls == [urls[1]]
+    assert timeouts == [6 * 3600]
+
+    # caterpillar is terminated once the limit takes effect, and the
+    # download is finished by the builtin downloader, without counting
+    # the interrupted attempt.
+    now = datetime.datetime(2019, 1, 2, 7, 59, 30)
+    failed, downloaded = kvm48.caterpillar_phase(conf, [(urls[2], "z.mp4")], manifest)
+    assert failed == [] and len(downloaded) == 1
+    assert calls == [urls[1], urls[2]]
+    assert timeouts[1:] == [30]
+    assert now == datetime.datetime(2019, 1, 2, 8, 0)
+    assert os.path.getsize(downloaded[0]) == stub_api.segment_size * stub_api.segments
@@ -0,0 +1,36 @@
+import requests
+
+from kvm48.mockapi import blob_bytes
+
+
+def test_mp4_ranges(stub_api):
+    stub_api.mp4_size = 100000
+    url = stub_api.base_url + "/resource/live/abc.mp4"
+    r = requests.head(url)
+    assert int(r.headers["Content-Length"]) == 100000
+    assert r.headers["Accept-Ranges"] == "bytes"
+
+    expected = blob_bytes("abc", 100000)
+    assert requests.get(url).content == expected
+    r = requests.get(url, headers={"Range": "bytes=5000-70000"})
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == "bytes 5000-70000/100000"
+    assert r.content == expected[5000:70001]
+    r = requests.get(url, headers={"Range": "bytes=99000-"})
+    assert r.content == expected[99000:]
+
+
+def test_hls_playlists(stub_api):
+    stub_api.segments = 3
+    base = stub_api.base_url + "/resource/hls/123/"
+    master = requests.get(base + "master.m3u8").text
+    assert master.startswith("#EXTM3U") and "media.m3u8" in master
+    media = requests.get(base + "media.m3u8").text
+    assert [l for l in media.splitlines() if not l.startswith("#")] == [
+        "0.ts",
+        "1.ts",
+        "2.ts",
+    ]
+    assert media.rstrip().endswith("#EXT-X-ENDLIST")
+    assert len(requests.get(base + "2.ts").content) == stub_api.segment_size
+    assert requests.get(base + "3.ts").status_code == 404
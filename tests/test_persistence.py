@@ -0,0 +1,31 @@
+from kvm48 import persistence
+
+
+def test_member_vod_coverage_merging():
+    scope = "0:0:10"
+    persistence.add_member_vod_coverage(scope, 100, 200)
+    persistence.add_member_vod_coverage(scope, 300, 400)
+    assert persistence.get_member_vod_coverage(scope, 150) == (100, 200)
+    assert persistence.get_member_vod_coverage(scope, 250) is None
+    persistence.add_member_vod_coverage(scope, 201, 299)
+    assert persistence.get_member_vod_coverage(scope, 250) == (100, 400)
+    assert persistence.get_member_vod_coverage("0:0:11", 250) is None
+
+
+def test_member_vod_query_is_scoped():
+    v1 = {
+        "liveId": "a",
+        "title": "t",
+        "liveType": 1,
+        "ctime": "1000",
+        "userInfo": {"userId": "35", "nickname": "SNH48-莫寒"},
+    }
+    v2 = dict(v1, liveId="b", ctime="2000")
+    persistence.insert_member_vods("0:0:10", [v1, v2])
+    persistence.insert_member_vods("0:0:11", [v1])
+    assert [v["liveId"] for v in persistence.query_member_vods("0:0:10", 0, 3000)] == [
+        "b",
+        "a",
+    ]
+    assert persistence.query_member_vods("0:0:11", 0, 3000) == [v1]
+    assert persistence.query_member_vods("0:0:10", 1500, 3000) == [v2]
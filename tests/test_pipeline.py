@@ -0,0 +1,60 @@
+import threading
+import time
+
+import pytest
+
+from kvm48.pipeline import Pipeline
+
+
+def test_pipeline():
+    p = Pipeline(range(100))
+    p.add_stage(lambda x: [x, -x] if x % 2 == 0 else [], workers=3)
+    p.add_stage(lambda x: [x * 10], workers=2)
+    assert sorted(p) == sorted(
+        y for x in range(100) if x % 2 == 0 for y in (x * 10, -x * 10)
+    )
+
+
+def test_pipeline_stages_overlap():
+    def slow_source():
+        for i in range(5):
+            time.sleep(0.1)
+            yield i
+
+    def slow_stage(x):
+        time.sleep(0.1)
+        return [x]
+
+    start = time.time()
+    assert sorted(Pipeline(slow_source()).add_stage(slow_stage, workers=5)) == list(
+        range(5)
+    )
+    # Serial execution would take 1 second.
+    assert time.time() - start < 0.8
+
+
+def test_pipeline_bounded_queues():
+    produced = []
+
+    def source():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    it = iter(Pipeline(source(), queue_size=4).add_stage(lambda x: [x]))
+    next(it)
+    time.sleep(0.3)
+    assert len(produced) < 20
+    it.close()
+
+
+def test_pipeline_error_propagation():
+    def stage(x):
+        if x == 50:
+            raise ValueError("boom")
+        return [x]
+
+    threads_before = threading.active_count()
+    with pytest.raises(ValueError, match="boom"):
+        list(Pipeline(range(1000), queue_size=2).add_stage(stage, workers=4))
+    assert threading.active_count() == threads_before
@@ -0,0 +1,72 @@
+import arrow
+import pytest
+
+from kvm48 import persistence, planning
+from kvm48.config import Config
+from kvm48.koudai import MemberVOD
+
+
+def make_vod(id, type="直播", title="标题", vod_url=None):
+    return MemberVOD(
+        id,
+        35,
+        type,
+        "莫寒",
+        title,
+        arrow.get("2018-02-11T18:57:32+08:00"),
+        vod_url=vod_url,
+    )
+
+
+@pytest.fixture
+def conf(tmp_path):
+    conf = Config()
+    conf._directory = str(tmp_path)
+    return conf
+
+
+def test_plan_filepaths_deduplication(conf):
+    vods = [
+        make_vod("a", vod_url="https://mp4.48.cn/live/a.mp4"),
+        make_vod("b", vod_url="https://ts.48.cn/live/b.m3u8"),
+        make_vod("c", type="电台"),
+    ]
+    plan = planning.plan_filepaths(conf, vods, source_exts={"c": ".mp4"})
+    assert [(vod.id, src_ext, path) for vod, src_ext, path in plan] == [
+        ("a", ".mp4", "20180211 莫寒口袋直播 标题.mp4"),
+        ("b", ".m3u8", "20180211 莫寒口袋直播 标题 (1).mp4"),
+        ("c", ".mp4", "20180211 莫寒口袋电台 标题.mp4"),
+    ]
+
+
+def test_predict_source_extensions():
+    vods = [make_vod("a"), make_vod("b", type="电台"), make_vod("c", type="电台")]
+    persistence.insert_resolved_urls(
+        "member", [("c", "https://mp4.48.cn/live/c.m4a", None)]
+    )
+    assert planning.predict_source_extensions(vods) == {"a": ".mp4", "c": ".m4a"}
+    assert vods[2].vod_url == "https://mp4.48.cn/live/c.m4a"
+
+    planning.record_source_extensions(vods)
+    assert planning.predict_source_extensions(vods) == {
+        "a": ".mp4",
+        "b": ".m4a",
+        "c": ".m4a",
+    }
+
+
+def test_find_finished_vods(conf, tmp_path):
+    vods = [make_vod("a"), make_vod("b"), make_vod("c", title="其他")]
+    tmp_path.joinpath("20180211 莫寒口袋直播 标题.mp4").touch()
+    tmp_path.joinpath("20180211 莫寒口袋直播 其他.mp4").touch()
+    tmp_path.joinpath("20180211 莫寒口袋直播 其他.mp4.aria2").touch()
+    source_exts = planning.predict_source_extensions(vods)
+    assert planning.find_finished_vods(conf, vods, source_exts) == {"a"}
+
+
+def test_find_finished_vods_with_unpredictable_namesake(conf, tmp_path):
+    # The first VOD can't be predicted, so the second VOD, which shares
+    # the same base name, may or may not be deduplicated.
+    vods = [make_vod("a", type="电台"), make_vod("b", type="电台")]
+    tmp_path.joinpath("20180211 莫寒口袋电台 标题.mp4").touch()
+    assert planning.find_finished_vods(conf, vods, {"b": ".mp4"}) == set()
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from kvm48.ratelimit import (
+    AIMDLimiter,
+    CircuitBreaker,
+    CircuitOpenError,
+    RateLimitTimeout,
+    TokenBucket,
+)
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(50, 5)
+    start = time.monotonic()
+    for _ in range(30):
+        bucket.acquire()
+    assert time.monotonic() - start >= 25 / 50 * 0.9
+    assert bucket.waits > 0
+
+    bucket = TokenBucket(0.1, 1)
+    bucket.acquire()
+    with pytest.raises(RateLimitTimeout):
+        bucket.acquire(deadline=time.monotonic() + 0.05)
+
+
+def test_aimd_window():
+    limiter = AIMDLimiter(8, minimum=1, maximum=10)
+    starts = [limiter.acquire() for _ in range(8)]
+    assert limiter.in_flight == 8
+    with pytest.raises(RateLimitTimeout):
+        limiter.acquire(deadline=time.monotonic() + 0.05)
+    # Concurrent failures caused by the same episode shrink the window once.
+    for start in starts:
+        limiter.release(start, True)
+    assert limiter.window == 4
+    assert limiter.decreases == 1
+    # Additive increase: roughly one slot per window of successes.
+    for _ in range(4 + 5):
+        limiter.release(limiter.acquire(), False)
+    assert 5.5 < limiter.window < 6
+    for _ in range(100):
+        limiter.release(limiter.acquire(), False)
+    assert limiter.window == 10
+
+
+def test_aimd_bounds_concurrency():
+    limiter = AIMDLimiter(3, maximum=3)
+    peak = 0
+    lock = threading.Lock()
+
+    def worker():
+        nonlocal peak
+        start = limiter.acquire()
+        with lock:
+            peak = max(peak, limiter.in_flight)
+        time.sleep(0.02)
+        limiter.release(start, False)
+
+    threads = [threading.Thread(target=worker) for _ in range(12)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak == 3
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(threshold=3, cooldown=0.1)
+    for _ in range(3):
+        breaker.before_request()
+        breaker.record(False)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    assert breaker.rejections == 1
+    time.sleep(0.1)
+    assert breaker.state == "half-open"
+    breaker.before_request()
+    # Only one trial request at a time.
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    breaker.before_request()
@@ -0,0 +1,54 @@
+import arrow
+import pytest
+
+from kvm48 import scheduling
+from kvm48.config import Config, ConfigError
+from kvm48.koudai import MemberVOD
+
+
+def make_targets(*specs):
+    vods = {}
+    targets = []
+    for i, (name, day) in enumerate(specs):
+        vod = MemberVOD(
+            str(i), i, "直播", name, "title", arrow.get("2026-10-%02d" % day)
+        )
+        target = ("https://example.com/%d.mp4" % i, "%s-%d.mp4" % (name, i))
+        vods[target] = vod
+        targets.append(target)
+    return targets, vods
+
+
+def test_schedule_policies():
+    targets, vods = make_targets(("A", 1), ("A", 2), ("B", 3), ("A", 4), ("C", 5))
+    t0, t1, t2, t3, t4 = targets
+    sizes = {t0[0]: 300, t1[0]: None, t2[0]: 100, t3[0]: 200}
+
+    assert scheduling.schedule(targets, "chronological", vods=vods) == targets
+    assert scheduling.schedule(targets, "smallest-first", vods=vods, sizes=sizes) == [
+        t2,
+        t3,
+        t0,
+        t1,
+        t4,
+    ]
+    assert scheduling.schedule(targets, "smallest-first", vods=vods) == targets
+    assert scheduling.schedule(targets, "newest-first", vods=vods) == [
+        t4,
+        t3,
+        t2,
+        t1,
+        t0,
+    ]
+    assert scheduling.schedule(targets, "fair", vods=vods) == [t0, t2, t4, t1, t3]
+
+
+def test_download_order_config(tmp_path):
+    config_file = tmp_path / "config.yml"
+    conf = Config()
+    config_file.write_text("group_id: 10\ndownload_order: smallest-first\n")
+    conf.load(str(config_file))
+    assert conf.download_order == "smallest-first"
+    config_file.write_text("group_id: 10\ndownload_order: random\n")
+    with pytest.raises(ConfigError):
+        conf.load(str(config_file))
@@ -0,0 +1,85 @@
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from kvm48 import supervisor
+
+
+def test_call_relays_prefixed_output(capsys):
+    script = (
+        "import sys; print('line 1'); "
+        "sys.stdout.write('progress 1%\\rprogress 2%\\r'); sys.stdout.flush(); "
+        "sys.stderr.write('error\\n'); sys.exit(3)"
+    )
+    assert supervisor.call([sys.executable, "-c", script], "test") == 3
+    lines = capsys.readouterr().err.splitlines()
+    assert all(line.startswith("[test] ") for line in lines)
+    assert lines[1:] == [
+        "[test] line 1",
+        "[test] progress 1%",
+        "[test] progress 2%",
+        "[test] error",
+    ]
+
+
+def test_call_quietly(capsys):
+    script = "print('line 1'); print('line 2')"
+    lines = []
+    assert (
+        supervisor.call(
+            [sys.executable, "-c", script], "test", on_line=lines.append, quiet=True
+        )
+        == 0
+    )
+    assert lines == ["line 1", "line 2"]
+    assert "[test] line" not in capsys.readouterr().err
+
+
+def test_call_timeout():
+    script = "import time; print('started', flush=True); time.sleep(60)"
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        supervisor.call([sys.executable, "-c", script], "test", timeout=0.5)
+    assert time.monotonic() - start < 30
+    assert supervisor.call([sys.executable, "-c", "pass"], "test", timeout=30) == 0
+
+
+def test_call_command_not_found():
+    with pytest.raises(FileNotFoundError):
+        supervisor.call(["kvm48-nonexistent-command"], "test")
+
+
+def test_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def task(value):
+        barrier.wait()
+        return value
+
+    assert supervisor.run_concurrently(
+        {"a": lambda: task(1), "b": lambda: task(2)}
+    ) == {"a": 1, "b": 2}
+
+    finished = []
+
+    def fail():
+        raise RuntimeError("failed")
+
+    def slow():
+        finished.append(True)
+
+    with pytest.raises(RuntimeError):
+        supervisor.run_concurrently({"fail": fail, "slow": slow})
+    assert finished == [True]
+
+
+def test_call_inherits_stdio_without_prefix(capfd):
+    script = "print('out')"
+    lines = []
+    assert supervisor.call([sys.executable, "-c", script], on_line=lines.append) == 0
+    # Output goes straight to our stdout, uncaptured.
+    assert "out" in capfd.readouterr().out
+    assert lines == []